@@ -0,0 +1,186 @@
+import asyncio
+import heapq
+from bisect import bisect_left
+import db_module
+import get_weather_module
+from cache_module import TTLCache
+from city_index_module import normalize_city
+from config import *
+
+
+def city_display_name(name: str, state: str, country: str) -> str:
+    """
+    Format a city the way the city buttons show it.
+
+    Parameters:
+    - name (str): The name of the city
+    - state (str): The state or region, may be empty
+    - country (str): The country code
+
+    Returns:
+    - display_name (str): e.g. "Paris, Ile-de-France, FR" or "Paris, FR"
+    """
+    return ", ".join(part for part in (name, state, country) if part)
+
+
+class CityAutocomplete:
+    """
+    In-memory prefix index suggesting cities while a user types an inline query.
+
+    The index is rebuilt periodically from the geocoding cache and the cities
+    users are subscribed to, weighted by their number of subscribers. Queries
+    it cannot fill are completed from the offline city index when one is
+    loaded. Results are cached per normalised query, and every suggestion is
+    remembered by its display name so the city can be resolved once the user
+    sends it.
+
+    Parameters:
+    - cache_size (int): The number of cached query results and remembered suggestions
+    - cache_ttl (float): The number of seconds query results are cached
+    - debounce (float): Seconds a user must stop typing before an uncached query is answered
+    """
+
+    def __init__(self, cache_size: int = AUTOCOMPLETE_CACHE_SIZE, cache_ttl: float = AUTOCOMPLETE_CACHE_TTL,
+                 debounce: float = AUTOCOMPLETE_DEBOUNCE):
+        self.debounce = debounce
+        self._keys = []
+        self._entries = []
+        self._by_name = {}
+        self.results = TTLCache(cache_size, cache_ttl)
+        self._suggested = TTLCache(cache_size, cache_ttl * 10)
+        self._latest_query = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def rebuild(self, candidates) -> int:
+        """
+        Replace the index with new candidates.
+
+        Parameters:
+        - candidates: An iterable of (display name, lat, lon, weight), the heaviest entry of a name wins
+
+        Returns:
+        - count (int): The number of indexed cities
+        """
+        by_name = {}
+        for name, lat, lon, weight in candidates:
+            if name not in by_name or by_name[name][3] < weight:
+                by_name[name] = (name, float(lat), float(lon), weight)
+        entries = sorted((normalize_city(name), entry) for name, entry in by_name.items())
+        self._keys = [key for key, _ in entries]
+        self._entries = [entry for _, entry in entries]
+        self._by_name = by_name
+        self.results.clear()
+        return len(self._keys)
+
+    def cached(self, text: str):
+        """
+        Get the cached suggestions of a query.
+
+        Parameters:
+        - text (str): The query typed by the user
+
+        Returns:
+        - suggestions (list or None): The cached suggestions, or None if the query is not cached
+        """
+        return self.results.get(normalize_city(text))
+
+    def complete(self, text: str, limit: int = AUTOCOMPLETE_RESULTS, scan: int = 1000) -> list:
+        """
+        Suggest cities whose name starts with the query and cache the result.
+
+        Parameters:
+        - text (str): The query typed by the user
+        - limit (int): The maximum number of suggestions
+        - scan (int): The maximum number of matching index entries considered
+
+        Returns:
+        - suggestions (list): (display name, lat, lon) tuples, most popular first
+        """
+        key = normalize_city(text)
+        if not key:
+            return []
+        i = bisect_left(self._keys, key)
+        end = min(i + scan, len(self._keys))
+        matches = []
+        while i < end and self._keys[i].startswith(key):
+            matches.append(self._entries[i])
+            i += 1
+        suggestions = [entry[:3] for entry in heapq.nlargest(limit, matches, key=lambda entry: entry[3])]
+        city_index = get_weather_module.city_index
+        if len(suggestions) < limit and city_index is not None:
+            names = {suggestion[0] for suggestion in suggestions}
+            for city in city_index.prefix(key, limit):
+                name = city_display_name(city["name"], city.get("state", ""), city["country"])
+                if name not in names and len(suggestions) < limit:
+                    names.add(name)
+                    suggestions.append((name, city["lat"], city["lon"]))
+        for suggestion in suggestions:
+            self._suggested.set(suggestion[0], suggestion)
+        self.results.set(key, suggestions)
+        return suggestions
+
+    def resolve(self, name: str):
+        """
+        Get the coordinates of a suggested city from its display name.
+
+        Parameters:
+        - name (str): The display name sent by the user
+
+        Returns:
+        - suggestion (tuple or None): The (display name, lat, lon) tuple, or None if it was not suggested
+        """
+        suggestion = self._suggested.get(name)
+        if suggestion is None and name in self._by_name:
+            suggestion = self._by_name[name][:3]
+        return suggestion
+
+    async def settled(self, user_id: int, query_id: str) -> bool:
+        """
+        Wait for the debounce time and tell whether the query is still the user's latest.
+
+        Parameters:
+        - user_id (int): The Telegram user id
+        - query_id (str): The id of the inline query
+
+        Returns:
+        - latest (bool): False if the user typed on and this query should not be answered
+        """
+        self._latest_query[user_id] = query_id
+        await asyncio.sleep(self.debounce)
+        if self._latest_query.get(user_id) != query_id:
+            return False
+        del self._latest_query[user_id]
+        return True
+
+    def stats(self) -> dict:
+        """
+        Get the index and result cache counters.
+
+        Returns:
+        - stats (dict): Number of indexed cities and the query result cache counters
+        """
+        return {"cities": len(self._keys), "results": self.results.stats()}
+
+
+async def autocomplete_candidates() -> list:
+    """
+    Collect the cities offered by the autocomplete.
+
+    Returns:
+    - candidates (list): (display name, lat, lon, weight) tuples from the geocoding cache and the subscribed cities
+    """
+    candidates = []
+    for geo_data in get_weather_module.geocoding_cache.values():
+        for city in geo_data:
+            candidates.append((city_display_name(city["name"], city.get("state", ""), city["country"]),
+                               city["lat"], city["lon"], 1))
+    # Subscribed cities rank above cities that were only searched
+    for city, lat, lon, subscribers in await db_module.get_subscribed_cities():
+        candidates.append((city, lat, lon, 1 + subscribers))
+    return candidates
+
+
+# Autocomplete shared by all inline queries
+city_autocomplete = CityAutocomplete()
@@ -0,0 +1,490 @@
+"""
+End-to-end benchmark of the bot against local stand-in servers.
+
+Starts the fake OpenWeather API and Telegram Bot API of fake_servers.py with
+the requested latency, error rate and share of 429 responses, points the bot
+at them through OWM_BASE_URL and BOT_API_BASE_URL and replaces the database
+helpers with an in-memory fake. Two scenarios run:
+
+- broadcast: N synthetic subscribers spread over K locations receive their
+  daily update through send_daily_updates, by default after the prefetch job
+- conversation: M users go through the conversation concurrently (/start,
+  Choose city, a city name, its first button, a day, Done), every update
+  being processed by the application built by main.build_application
+
+The report has the throughput, the p50/p95/p99 latency of every handler
+step, the calls received by the stand-in servers and the peak RSS of the
+process, which includes the stand-in servers running in a background thread.
+Bot settings without an option here, e.g. BROADCAST_WORKERS or
+FORECAST_CACHE_TTL, are read from the environment as usual.
+
+Usage: python benchmarks/bench_bot.py [--subscribers N] [--locations K] [--users M] [options]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import resource
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+
+from fake_servers import FakeBotApi, FakeOpenWeather, ServerThread
+
+STEPS = ("start", "choose_city", "search_city", "pick_city", "pick_day", "done")
+
+
+class FakeDatabase:
+    """
+    In-memory stand-in for the db_module helpers used by the handlers and jobs.
+
+    Parameters:
+    - timezone (str): The timezone of new users
+    - delivery_time (str): The "HH:MM" delivery time of new users
+    - latency (float): Seconds every helper waits, like a query round trip
+    """
+
+    HELPERS = ("get_user_city", "get_user_location", "save_user_city", "deactivate_user", "get_user_delivery",
+               "set_user_delivery", "iter_users_with_daily_updates", "get_subscribed_locations",
+               "get_subscribed_cities", "get_delivery_buckets", "count_bucket_subscribers", "intern_location",
+               "get_location", "load_locations", "load_geocoding_cache", "get_geocoding_result",
+               "save_geocoding_result")
+
+    def __init__(self, timezone: str, delivery_time: str, latency: float = 0.0):
+        self.timezone = timezone
+        self.delivery_time = delivery_time
+        self.latency = latency
+        self.users = {}
+        self.locations = {}
+        self.location_ids = {}
+        self.geocoding = {}
+        self.calls = {}
+
+    def install(self, db_module) -> None:
+        """
+        Replace the helpers of db_module with the ones of this fake.
+        """
+        for name in self.HELPERS:
+            setattr(db_module, name, getattr(self, name))
+
+    def add_subscribers(self, count: int, locations: int, first_user_id: int = 1) -> None:
+        """
+        Subscribe synthetic users spread evenly over synthetic locations.
+        """
+        for i in range(count):
+            location = i % locations
+            lat = round(-60 + location * 7.919 % 120, 4)
+            lon = round(-180 + location * 13.37 % 360, 4)
+            self._save(first_user_id + i, lat, lon, f"City {location}, XX")
+
+    def _save(self, user_id: int, lat: float, lon: float, city: str, location_id: int = None) -> None:
+        user = self.users.setdefault(user_id, {"timezone": self.timezone, "delivery_time": self.delivery_time})
+        user.update(lat=float(lat), lon=float(lon), city=city, location_id=location_id, active=True)
+
+    def _subscribers(self, bucket: tuple = None) -> list:
+        return [(user_id, user) for user_id, user in sorted(self.users.items()) if user["active"]
+                and (bucket is None or (user["timezone"], user["delivery_time"]) == tuple(bucket))]
+
+    @staticmethod
+    def _cell(user: dict) -> tuple:
+        # The generated cell_lat and cell_lon columns
+        return round(user["lat"], 2), round(user["lon"], 2)
+
+    async def _query(self, name: str) -> None:
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def get_user_city(self, user_id: int):
+        await self._query("get_user_city")
+        user = self.users.get(user_id)
+        return user["city"] if user else None
+
+    async def get_user_location(self, user_id: int):
+        await self._query("get_user_location")
+        user = self.users.get(user_id)
+        return (user["lat"], user["lon"], user["city"]) if user else None
+
+    async def save_user_city(self, user_id: int, lat: float, lon: float, city: str, location_id: int = None) -> None:
+        await self._query("save_user_city")
+        self._save(user_id, lat, lon, city, location_id)
+
+    async def deactivate_user(self, user_id: int) -> bool:
+        await self._query("deactivate_user")
+        user = self.users.get(user_id)
+        if not user or not user["active"]:
+            return False
+        user["active"] = False
+        return True
+
+    async def get_user_delivery(self, user_id: int):
+        await self._query("get_user_delivery")
+        user = self.users.get(user_id)
+        return (user["timezone"], user["delivery_time"]) if user else None
+
+    async def set_user_delivery(self, user_id: int, timezone: str = None, delivery_time: str = None):
+        await self._query("set_user_delivery")
+        user = self.users.get(user_id)
+        if not user or not user["active"]:
+            return None
+        user["timezone"] = timezone or user["timezone"]
+        user["delivery_time"] = delivery_time or user["delivery_time"]
+        return user["timezone"], user["delivery_time"]
+
+    async def iter_users_with_daily_updates(self, batch_size: int = 1000, bucket: tuple = None, after_user_id: int = -1):
+        rows = [(user_id, user["lat"], user["lon"], user["city"], *self._cell(user))
+                for user_id, user in self._subscribers(bucket) if user_id > after_user_id]
+        for i in range(0, len(rows), batch_size):
+            await self._query("iter_users_with_daily_updates")
+            yield rows[i:i + batch_size]
+
+    async def get_subscribed_locations(self, bucket: tuple = None) -> list:
+        await self._query("get_subscribed_locations")
+        counts = {}
+        for _, user in self._subscribers(bucket):
+            key = (*self._cell(user), user["city"])
+            counts[key] = counts.get(key, 0) + 1
+        return [(*key, subscribers) for key, subscribers in counts.items()]
+
+    async def get_subscribed_cities(self) -> list:
+        await self._query("get_subscribed_cities")
+        counts = {}
+        for _, user in self._subscribers():
+            key = (user["city"], user["lat"], user["lon"])
+            counts[key] = counts.get(key, 0) + 1
+        return [(*key, subscribers) for key, subscribers in counts.items()]
+
+    async def get_delivery_buckets(self) -> list:
+        await self._query("get_delivery_buckets")
+        counts = {}
+        for _, user in self._subscribers():
+            key = (user["timezone"], user["delivery_time"])
+            counts[key] = counts.get(key, 0) + 1
+        return [(*key, subscribers) for key, subscribers in counts.items()]
+
+    async def count_bucket_subscribers(self, timezone: str, delivery_time: str) -> int:
+        await self._query("count_bucket_subscribers")
+        return len(self._subscribers((timezone, delivery_time)))
+
+    async def intern_location(self, name: str, lat: float, lon: float):
+        await self._query("intern_location")
+        key = (name, float(lat), float(lon))
+        if key not in self.location_ids:
+            self.location_ids[key] = len(self.locations) + 1
+            self.locations[self.location_ids[key]] = key
+        return self.location_ids[key]
+
+    async def get_location(self, location_id: int):
+        await self._query("get_location")
+        location = self.locations.get(location_id)
+        return (location_id, *location) if location else None
+
+    async def load_locations(self, limit: int) -> list:
+        await self._query("load_locations")
+        return [(location_id, *location) for location_id, location in list(self.locations.items())[-limit:]]
+
+    async def load_geocoding_cache(self, max_age: float, limit: int) -> list:
+        await self._query("load_geocoding_cache")
+        return []
+
+    async def get_geocoding_result(self, key: str, max_age: float):
+        await self._query("get_geocoding_result")
+        return (self.geocoding[key], 0) if key in self.geocoding else None
+
+    async def save_geocoding_result(self, key: str, data: list) -> None:
+        await self._query("save_geocoding_result")
+        self.geocoding[key] = data
+
+
+def city_name(i: int) -> str:
+    """
+    Name the i-th synthetic city with letters only, as the city prompt accepts.
+    """
+    letters = ""
+    while True:
+        i, rest = divmod(i, 26)
+        letters += chr(ord("a") + rest)
+        if not i:
+            return "Town " + letters.capitalize()
+
+
+def percentiles(samples: list, points: tuple = (50, 95, 99)) -> dict:
+    """
+    Get nearest-rank percentiles of latency samples in milliseconds.
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+    return {f"p{point}": round(ordered[max(0, math.ceil(point / 100 * len(ordered)) - 1)] * 1000, 2)
+            for point in points}
+
+
+def peak_rss_mb() -> float:
+    """
+    Get the peak resident set size of the process so far in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def upstream_calls(*servers) -> dict:
+    calls = {}
+    for server in servers:
+        calls.update(server.stats())
+        server.reset()
+    return calls
+
+
+class SimulatedUser:
+    """
+    Builds the updates one user sends to the bot.
+
+    Parameters:
+    - bot (Bot): The bot the updates are addressed to
+    - user_id (int): The Telegram id of the user, also the id of the private chat
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, bot, user_id: int):
+        self.bot = bot
+        self.user_id = user_id
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+        self.chat = {"id": user_id, "type": "private"}
+
+    def message(self, text: str) -> Update:
+        message = {"message_id": next(self._ids), "date": int(time.time()), "chat": self.chat, "from": self.user,
+                   "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        return Update.de_json({"update_id": next(self._ids), "message": message}, self.bot)
+
+    def press(self, data: str) -> Update:
+        message = {"message_id": next(self._ids), "date": int(time.time()), "chat": self.chat,
+                   "from": self.bot.bot.to_dict(), "text": "Which city is yours?"}
+        query = {"id": str(next(self._ids)), "from": self.user, "chat_instance": str(self.user_id), "data": data,
+                 "message": message}
+        return Update.de_json({"update_id": next(self._ids), "callback_query": query}, self.bot)
+
+
+def button(bot_api: FakeBotApi, chat_id: int, index: int = 0):
+    """
+    Take the callback data of a button of the last inline keyboard sent to a chat.
+    """
+    keyboard = bot_api.keyboards.pop(chat_id, None)
+    buttons = [data for row in keyboard or [] for data in (key.get("callback_data") for key in row) if data]
+    return buttons[min(index, len(buttons) - 1)] if buttons else None
+
+
+async def converse(application, bot_api: FakeBotApi, user_id: int, city: str, latencies: dict) -> bool:
+    """
+    Take one user through the conversation, timing every processed update.
+
+    Returns:
+    - completed (bool): False if the bot did not offer a button the user needed
+    """
+    user = SimulatedUser(application.bot, user_id)
+
+    async def send(step: str, update) -> None:
+        started = time.perf_counter()
+        await application.process_update(update)
+        latencies[step].append(time.perf_counter() - started)
+
+    await send("start", user.message("/start"))
+    await send("choose_city", user.message("Choose city"))
+    bot_api.keyboards.pop(user_id, None)
+    await send("search_city", user.message(city))
+    location = button(bot_api, user_id)
+    if location is None:
+        return False
+    await send("pick_city", user.press(location))
+    # The second day button is tomorrow, a full day of forecast
+    day = button(bot_api, user_id, 1)
+    if day is None:
+        return False
+    await send("pick_day", user.press(day))
+    await send("done", user.message("Done"))
+    return True
+
+
+async def run_conversations(application, bot_api: FakeBotApi, args: argparse.Namespace) -> dict:
+    latencies = {step: [] for step in STEPS}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def simulate(i: int) -> bool:
+        async with semaphore:
+            return await converse(application, bot_api, 10_000_000 + i, city_name(i % args.cities), latencies)
+
+    started = time.perf_counter()
+    completed = sum(await asyncio.gather(*(simulate(i) for i in range(args.users))))
+    duration = time.perf_counter() - started
+    updates = sum(len(samples) for samples in latencies.values())
+    return {
+        "users": args.users,
+        "completed": completed,
+        "updates": updates,
+        "duration": round(duration, 3),
+        "updates_per_second": round(updates / duration, 1) if duration else 0.0,
+        "latency_ms": {**{step: percentiles(samples) for step, samples in latencies.items()},
+                       "all": percentiles([sample for samples in latencies.values() for sample in samples])},
+    }
+
+
+async def run_broadcast(main, application, database: FakeDatabase, args: argparse.Namespace) -> dict:
+    from config import DEFAULT_DELIVERY_TIME, DEFAULT_TIMEZONE
+    from prefetch_module import prefetch_subscribed_locations
+    database.add_subscribers(args.subscribers, args.locations)
+    bucket = (DEFAULT_TIMEZONE, DEFAULT_DELIVERY_TIME)
+    report = {"subscribers": args.subscribers, "locations": args.locations}
+    if not args.no_prefetch:
+        started = time.perf_counter()
+        prefetch = await prefetch_subscribed_locations(bucket)
+        report["prefetch"] = {"duration": round(time.perf_counter() - started, 3),
+                              "warmed_cells": prefetch["warmed_cells"], "rendered": prefetch["rendered"],
+                              "failed": len(prefetch["failed"])}
+    context = SimpleNamespace(bot=application.bot, job=SimpleNamespace(data=bucket), job_queue=application.job_queue)
+    started = time.perf_counter()
+    await main.send_daily_updates(context)
+    duration = time.perf_counter() - started
+    report["duration"] = round(duration, 3)
+    report["messages_per_second"] = round(args.subscribers / duration, 1) if duration else 0.0
+    return report
+
+
+async def benchmark(args: argparse.Namespace, owm: FakeOpenWeather, bot_api: FakeBotApi) -> dict:
+    import db_module
+    import main
+    from config import DEFAULT_DELIVERY_TIME, DEFAULT_TIMEZONE
+
+    database = FakeDatabase(DEFAULT_TIMEZONE, DEFAULT_DELIVERY_TIME, args.db_latency)
+    database.install(db_module)
+    application = main.build_application()
+    errors = {}
+
+    async def count_error(update, context) -> None:
+        name = type(context.error).__name__
+        errors[name] = errors.get(name, 0) + 1
+
+    application.add_error_handler(count_error)
+    await application.initialize()
+    await application.start()
+    report = {}
+    try:
+        if args.scenario in ("broadcast", "all"):
+            report["broadcast"] = await run_broadcast(main, application, database, args)
+            report["broadcast"]["upstream_calls"] = upstream_calls(owm, bot_api)
+            report["broadcast"]["peak_rss_mb"] = peak_rss_mb()
+        if args.scenario in ("conversation", "all"):
+            report["conversation"] = await run_conversations(application, bot_api, args)
+            report["conversation"]["upstream_calls"] = upstream_calls(owm, bot_api)
+            report["conversation"]["handler_errors"] = dict(errors)
+            report["conversation"]["peak_rss_mb"] = peak_rss_mb()
+        report["db_calls"] = dict(sorted(database.calls.items()))
+    finally:
+        await application.stop()
+        await application.shutdown()
+    return report
+
+
+def print_report(report: dict) -> None:
+    if "broadcast" in report:
+        broadcast = report["broadcast"]
+        print(f"broadcast: {broadcast['subscribers']} subscribers over {broadcast['locations']} locations")
+        if "prefetch" in broadcast:
+            prefetch = broadcast["prefetch"]
+            print(f"  prefetch             {prefetch['duration']:8.3f} s   {prefetch['warmed_cells']} cells warmed, "
+                  f"{prefetch['rendered']} messages rendered, {prefetch['failed']} failed")
+        print(f"  send_daily_updates   {broadcast['duration']:8.3f} s   {broadcast['messages_per_second']} messages/s")
+        print(f"  upstream calls       {broadcast['upstream_calls']}")
+        print(f"  peak RSS             {broadcast['peak_rss_mb']} MB")
+    if "conversation" in report:
+        conversation = report["conversation"]
+        print(f"conversation: {conversation['completed']}/{conversation['users']} users completed, "
+              f"{conversation['updates']} updates in {conversation['duration']} s, "
+              f"{conversation['updates_per_second']} updates/s")
+        print(f"  {'latency (ms)':<18} {'p50':>8} {'p95':>8} {'p99':>8}")
+        for step, points in conversation["latency_ms"].items():
+            if points:
+                print(f"  {step:<18} {points['p50']:8.2f} {points['p95']:8.2f} {points['p99']:8.2f}")
+        print(f"  upstream calls       {conversation['upstream_calls']}")
+        print(f"  handler errors       {conversation['handler_errors']}")
+        print(f"  peak RSS             {conversation['peak_rss_mb']} MB")
+    print(f"db helper calls: {report['db_calls']}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the bot against local stand-in servers.")
+    parser.add_argument("--scenario", choices=("broadcast", "conversation", "all"), default="all")
+    parser.add_argument("--subscribers", type=int, default=10000, help="Synthetic subscribers of the broadcast")
+    parser.add_argument("--locations", type=int, default=500, help="Distinct locations of the subscribers")
+    parser.add_argument("--no-prefetch", action="store_true", help="Broadcast without running the prefetch first")
+    parser.add_argument("--users", type=int, default=1000, help="Simulated users going through the conversation")
+    parser.add_argument("--concurrency", type=int, default=100, help="Users in the conversation at the same time")
+    parser.add_argument("--cities", type=int, default=100, help="Distinct city names typed by the users")
+    parser.add_argument("--owm-latency", type=float, default=0.05, help="Seconds every OpenWeather request waits")
+    parser.add_argument("--owm-error-rate", type=float, default=0.0, help="Share of OpenWeather 500 responses")
+    parser.add_argument("--owm-429-rate", type=float, default=0.0, help="Share of OpenWeather 429 responses")
+    parser.add_argument("--bot-latency", type=float, default=0.02, help="Seconds every Bot API request waits")
+    parser.add_argument("--bot-error-rate", type=float, default=0.0, help="Share of Bot API 500 responses")
+    parser.add_argument("--bot-429-rate", type=float, default=0.0, help="Share of Bot API 429 responses")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry delay in seconds sent with a 429")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="Seconds every database helper waits")
+    parser.add_argument("--owm-per-minute", type=float, default=60000,
+                        help="OWM_FORECAST_PER_MINUTE and OWM_GEOCODING_PER_MINUTE of the bot")
+    parser.add_argument("--broadcast-rate", type=float, default=1000, help="BROADCAST_RATE of the bot")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the injected failures")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    return parser.parse_args()
+
+
+def configure(args: argparse.Namespace, owm_url: str, bot_url: str) -> None:
+    """
+    Point the bot at the stand-in servers, before config is imported.
+    """
+    os.environ.update({
+        "BOT_TOKEN": "123456:benchmark",
+        "API_KEY": "benchmark",
+        "OWM_BASE_URL": owm_url,
+        "BOT_API_BASE_URL": bot_url,
+        "OWM_FORECAST_PER_MINUTE": str(args.owm_per_minute),
+        "OWM_GEOCODING_PER_MINUTE": str(args.owm_per_minute),
+        "OWM_BURST": str(max(args.owm_per_minute / 60, 1)),
+        "OWM_CALLS_PER_DAY": str(10 ** 9),
+        "BROADCAST_RATE": str(args.broadcast_rate),
+        "WRITE_BEHIND_ENABLED": "0",
+        "PERSISTENCE_ENABLED": "0",
+        "WEBHOOK_URL": "",
+        "CITY_INDEX_PATH": "",
+    })
+
+
+def main() -> None:
+    args = parse_args()
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.ERROR)
+    owm = FakeOpenWeather(latency=args.owm_latency, error_rate=args.owm_error_rate,
+                          rate_limit_rate=args.owm_429_rate, retry_after=args.retry_after, seed=args.seed)
+    bot_api = FakeBotApi(latency=args.bot_latency, error_rate=args.bot_error_rate,
+                         rate_limit_rate=args.bot_429_rate, retry_after=args.retry_after, seed=args.seed)
+    servers = ServerThread(owm, bot_api)
+    configure(args, *servers.start())
+    try:
+        report = asyncio.run(benchmark(args, owm, bot_api))
+    finally:
+        servers.stop()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Micro-benchmark of forecast decoding and rendering.
+
+Compares decoding the response body with forecast_module.decode_forecast and
+rendering all five days with render_day against decoding the full payload
+with json and five calls of the original parse_weather implementation. Also
+compares the memory held by a decoded payload and a compact forecast.
+
+Usage: python benchmarks/bench_render.py [iterations]
+"""
+
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from forecast_module import FORECAST_DAYS, decode_forecast, loads, render_day
+
+
+def sample_forecast(start_hour: int = 9, entries: int = 40, metric: bool = False) -> dict:
+    """
+    Build a synthetic 5 day / 3 hour forecast payload shaped like the OpenWeather response.
+
+    Parameters:
+    - start_hour (int): The hour (multiple of 3) of the first entry
+    - entries (int): The number of 3-hour entries
+    - metric (bool): Temperatures in Celsius as with units=metric, otherwise in Kelvin
+
+    Returns:
+    - geo_data (dict): The synthetic forecast
+    """
+    start = datetime(2023, 10, 12, start_hour, tzinfo=timezone.utc)
+    forecast = []
+    offset = 0 if metric else 273.15
+    for i in range(entries):
+        moment = start + timedelta(hours=3 * i)
+        # OpenWeather sends metric temperatures with two decimals
+        temp, feels_like = round(17 + (i % 8) * 0.73, 2), round(16.25 + (i % 5) * 0.61, 2)
+        forecast.append({
+            "dt": int(moment.timestamp()),
+            "main": {"temp": temp + offset, "feels_like": feels_like + offset, "humidity": 40 + i % 50},
+            "weather": [{"id": 800, "main": "Clear", "description": "clear sky", "icon": "01d"}],
+            "clouds": {"all": 0},
+            "wind": {"speed": 3.1 + (i % 4) * 0.5, "deg": 250, "gust": 4.2},
+            "visibility": 10000,
+            "pop": 0,
+            "dt_txt": moment.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+    return {"cod": "200", "cnt": entries, "list": forecast, "city": {"name": "Tel Aviv"}}
+
+
+def legacy_parse_weather(geo_data: dict, city: str, n_of_day: int) -> str:
+    """
+    The original parse_weather, kept as the baseline of the benchmark.
+    """
+    geo_data = geo_data['list']
+    first_day_idx = 0
+    while geo_data[first_day_idx]['dt_txt'][11:13] != '21':
+        first_day_idx += 1
+    first_day_idx += 1
+
+    start_idx = first_day_idx + (n_of_day - 1) * 8 if n_of_day != 0 else 0
+    end_idx = start_idx + 8 if n_of_day != 0 else first_day_idx
+    weather_dict = geo_data[start_idx:end_idx]
+    date_only = geo_data[0]['dt_txt'].split()[0]
+    message = f"*Weather Forecast for {city} \n {date_only}* 🌐\n\n"
+    for weather_data in weather_dict:
+        time_only = weather_data['dt_txt'].split()[1]
+        hour_only = time_only.split(":")[0] + ":00"
+        temp = "{:.2f}".format(weather_data['main']['temp'] - 273.15)
+        feels_like = "{:.2f}".format(weather_data['main']['feels_like'] - 273.15)
+        description = weather_data['weather'][0]['description']
+        wind_speed = weather_data['wind']['speed']
+        humidity = weather_data['main']['humidity']
+        message += (
+            f"_• {hour_only}_\n"
+            f"*🌡️  Temperature:* {temp}°C\n"
+            f"*💓  Feels Like:* {feels_like}°C\n"
+            f"*📰  Description:* {description.capitalize()}\n"
+            f"*🌬️  Wind Speed:* {wind_speed} m/s\n"
+            f"*💦  Humidity:* {humidity}%\n\n"
+        )
+    return message
+
+
+def legacy_pipeline(body: bytes) -> list:
+    """
+    Decode the full Kelvin payload and render every day with the original parse_weather.
+    """
+    geo_data = json.loads(body)
+    return [legacy_parse_weather(geo_data, "Tel Aviv", day) for day in range(FORECAST_DAYS)]
+
+
+def slim_pipeline(body: bytes) -> list:
+    """
+    Decode the metric payload into a compact forecast and render every day.
+    """
+    forecast = decode_forecast(body)
+    return [render_day(forecast, "Tel Aviv", day) for day in range(FORECAST_DAYS)]
+
+
+def retained_bytes(decode, body: bytes, count: int = 100) -> int:
+    """
+    Measure the memory held per decoded result while many of them are kept, as in a cache.
+
+    Holding many results makes the memory kept in interpreter free lists negligible.
+    """
+    tracemalloc.start()
+    results = [decode(body) for _ in range(count)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del results
+    return size // count
+
+
+def main() -> None:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    # Both pipelines must produce identical messages for every start hour
+    for start_hour in range(0, 24, 3):
+        expected = legacy_pipeline(json.dumps(sample_forecast(start_hour)).encode())
+        actual = slim_pipeline(json.dumps(sample_forecast(start_hour, metric=True)).encode())
+        assert actual == expected, f"output differs for start hour {start_hour}"
+
+    kelvin_body = json.dumps(sample_forecast()).encode()
+    metric_body = json.dumps(sample_forecast(metric=True)).encode()
+    legacy = timeit.timeit(lambda: legacy_pipeline(kelvin_body), number=iterations)
+    slim = timeit.timeit(lambda: slim_pipeline(metric_body), number=iterations)
+    print(f"JSON decoder:                      {loads.__module__}")
+    print(f"json.loads + parse_weather x5:     {legacy / iterations * 1e6:8.1f} us per forecast")
+    print(f"decode_forecast + render_day x5:   {slim / iterations * 1e6:8.1f} us per forecast")
+    print(f"speedup:                           {legacy / slim:8.2f}x")
+    print(f"decoded payload held:              {retained_bytes(json.loads, kelvin_body):8d} bytes")
+    print(f"compact forecast held:             {retained_bytes(decode_forecast, metric_body):8d} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+"""
+Local stand-ins for the OpenWeather API and the Telegram Bot API.
+
+Both servers speak just enough HTTP/1.1 (keep-alive, Content-Length bodies)
+for httpx, answer with responses shaped like the real APIs and can be made
+slow or unreliable: every request waits for the configured latency, and a
+configurable share of requests is answered with a 429 carrying a retry
+delay or with a 500. Calls are counted per endpoint and response status.
+
+The bot is pointed at them with OWM_BASE_URL and BOT_API_BASE_URL. They can
+also be run on their own:
+
+    python benchmarks/fake_servers.py [--owm-port 8081] [--bot-port 8082] [--latency 0.05] ...
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from functools import lru_cache
+from urllib.parse import parse_qsl, urlsplit
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+
+class FakeServer:
+    """
+    Minimal asyncio HTTP server with injected latency and failures.
+
+    Subclasses name the endpoint of a request path and answer it.
+
+    Parameters:
+    - latency (float): Seconds every request waits before it is answered
+    - jitter (float): Up to this many seconds are randomly added to the latency
+    - error_rate (float): Share of requests answered with a 500
+    - rate_limit_rate (float): Share of requests answered with a 429
+    - retry_after (int): The retry delay in seconds sent with a 429
+    - seed (int): Seed of the random failures, so runs can be repeated
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, retry_after: int = 1, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._server = None
+        self._connections = set()
+        self.calls = {}
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Start listening.
+
+        Parameters:
+        - host (str): The address to listen on
+        - port (int): The port to listen on, 0 for any free port
+
+        Returns:
+        - base_url (str): The URL of the server
+        """
+        self._server = await asyncio.start_server(self._serve, host, port)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def close(self) -> None:
+        """
+        Stop listening and drop the open connections.
+        """
+        self._server.close()
+        for connection in self._connections:
+            connection.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def stats(self) -> dict:
+        """
+        Get the call counters.
+
+        Returns:
+        - stats (dict): Response status counts keyed by endpoint
+        """
+        return {endpoint: dict(statuses) for endpoint, statuses in sorted(self.calls.items())}
+
+    def reset(self) -> None:
+        """
+        Clear the call counters.
+        """
+        self.calls = {}
+
+    def endpoint(self, path: str) -> str:
+        """
+        Name the endpoint of a request path, used to count calls.
+        """
+        return path
+
+    def fails(self, endpoint: str) -> bool:
+        """
+        Tell whether requests to an endpoint may be failed on purpose.
+        """
+        return True
+
+    def handle(self, endpoint: str, query: dict, params: dict) -> tuple:
+        """
+        Answer a request, returning the status and the JSON payload.
+        """
+        return 404, {}
+
+    def failure(self, status: int) -> dict:
+        """
+        Build the JSON payload of an injected failure.
+        """
+        return {}
+
+    async def _respond(self, target: str, headers: dict, body: bytes) -> tuple:
+        url = urlsplit(target)
+        endpoint = self.endpoint(url.path)
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self._random.uniform(0, self.jitter))
+        extra_headers = {}
+        roll = self._random.random() if self.fails(endpoint) else 1.0
+        if roll < self.rate_limit_rate:
+            status, payload = 429, self.failure(429)
+            extra_headers["Retry-After"] = str(self.retry_after)
+        elif roll < self.rate_limit_rate + self.error_rate:
+            status, payload = 500, self.failure(500)
+        else:
+            status, payload = self.handle(endpoint, dict(parse_qsl(url.query)), parse_body(headers, body))
+        statuses = self.calls.setdefault(endpoint, {})
+        statuses[status] = statuses.get(status, 0) + 1
+        content = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        return status, content, extra_headers
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connection = asyncio.current_task()
+        self._connections.add(connection)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                _, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                status, content, extra_headers = await self._respond(target, headers, body)
+                head = [f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}",
+                        "Content-Type: application/json",
+                        f"Content-Length: {len(content)}"]
+                head += [f"{name}: {value}" for name, value in extra_headers.items()]
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + content)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(connection)
+            writer.close()
+
+
+def parse_body(headers: dict, body: bytes) -> dict:
+    """
+    Decode a JSON or form encoded request body.
+
+    Parameters:
+    - headers (dict): The request headers with lowercased names
+    - body (bytes): The request body
+
+    Returns:
+    - params (dict): The decoded parameters, empty for other bodies
+    """
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return dict(parse_qsl(body.decode()))
+    return {}
+
+
+@lru_cache(maxsize=4096)
+def forecast_body(lat: str, lon: str, start: int, entries: int) -> bytes:
+    """
+    Encode the synthetic metric forecast of a location, cached so the stand-in costs little CPU.
+
+    Parameters:
+    - lat (str): The latitude of the location
+    - lon (str): The longitude of the location
+    - start (int): The timestamp of the first 3-hour entry
+    - entries (int): The number of 3-hour entries
+
+    Returns:
+    - body (bytes): The JSON encoded forecast
+    """
+    # Warmer towards the equator, so locations get different forecasts
+    base = 30 - abs(float(lat)) / 2
+    forecast = []
+    for i in range(entries):
+        moment = start + 10800 * i
+        forecast.append({
+            "dt": moment,
+            "main": {"temp": round(base + (i % 8) * 0.73, 2), "feels_like": round(base - 0.75 + (i % 5) * 0.61, 2),
+                     "humidity": 40 + i % 50},
+            "weather": [{"id": 800, "main": "Clear", "description": "clear sky", "icon": "01d"}],
+            "clouds": {"all": 0},
+            "wind": {"speed": round(3.1 + (i % 4) * 0.5, 2), "deg": 250, "gust": 4.2},
+            "visibility": 10000,
+            "pop": 0,
+            "dt_txt": datetime.fromtimestamp(moment, timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        })
+    city = {"name": f"{lat},{lon}", "coord": {"lat": float(lat), "lon": float(lon)}}
+    return json.dumps({"cod": "200", "cnt": entries, "list": forecast, "city": city}).encode()
+
+
+class FakeOpenWeather(FakeServer):
+    """
+    Stand-in for the OpenWeather geocoding and 5 day / 3 hour forecast endpoints.
+
+    Every city name geocodes to the same places on every run, the forecast
+    starts at the current 3 hour slot and is in metric units.
+
+    Parameters:
+    - cities_per_query (int): The number of places returned for a city name
+    - See FakeServer for the others
+    """
+
+    COUNTRIES = ("US", "GB", "FR", "DE", "IL")
+
+    def __init__(self, cities_per_query: int = 3, **kwargs):
+        super().__init__(**kwargs)
+        self.cities_per_query = cities_per_query
+
+    def endpoint(self, path: str) -> str:
+        return {"/geo/1.0/direct": "geocoding", "/data/2.5/forecast": "forecast"}.get(path, path)
+
+    def handle(self, endpoint: str, query: dict, params: dict) -> tuple:
+        if endpoint == "geocoding":
+            name = query.get("q", "")
+            cities = []
+            for i in range(min(self.cities_per_query, int(query.get("limit", "5")))):
+                seed = zlib.crc32(f"{name.casefold()}:{i}".encode())
+                cities.append({
+                    "name": name,
+                    "lat": round(-60 + seed % 12000 / 100, 4),
+                    "lon": round(-180 + seed // 12000 % 36000 / 100, 4),
+                    "country": self.COUNTRIES[i % len(self.COUNTRIES)],
+                    "state": f"Region {i + 1}",
+                })
+            return 200, cities
+        if endpoint == "forecast":
+            start = int(time.time()) // 10800 * 10800
+            return 200, forecast_body(query.get("lat", "0"), query.get("lon", "0"), start, int(query.get("cnt", "40")))
+        return 404, {"cod": "404", "message": "Not found"}
+
+    def failure(self, status: int) -> dict:
+        if status == 429:
+            return {"cod": 429, "message": "Your account is temporary blocked due to exceeding of requests limitation"}
+        return {"cod": status, "message": "Internal error"}
+
+
+class FakeBotApi(FakeServer):
+    """
+    Stand-in for the Telegram Bot API.
+
+    sendMessage answers with a message in the requested chat, and the last
+    inline keyboard sent to every chat is kept so a simulated user can press
+    its buttons. getMe never fails, every other method may.
+
+    Parameters:
+    - See FakeServer
+    """
+
+    BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Weather", "username": "weather_benchmark_bot",
+                "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": True}
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.keyboards = {}
+        self._message_ids = itertools.count(1)
+
+    def endpoint(self, path: str) -> str:
+        return path.rsplit("/", 1)[-1]
+
+    def fails(self, endpoint: str) -> bool:
+        return endpoint != "getMe"
+
+    def handle(self, endpoint: str, query: dict, params: dict) -> tuple:
+        if endpoint == "getMe":
+            return 200, {"ok": True, "result": self.BOT_USER}
+        if endpoint == "sendMessage":
+            chat_id = int(params.get("chat_id", 0))
+            reply_markup = params.get("reply_markup")
+            if isinstance(reply_markup, str):
+                reply_markup = json.loads(reply_markup)
+            if reply_markup and "inline_keyboard" in reply_markup:
+                self.keyboards[chat_id] = reply_markup["inline_keyboard"]
+            return 200, {"ok": True, "result": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": self.BOT_USER,
+                "text": params.get("text", ""),
+            }}
+        if endpoint == "getUpdates":
+            return 200, {"ok": True, "result": []}
+        return 200, {"ok": True, "result": True}
+
+    def failure(self, status: int) -> dict:
+        if status == 429:
+            return {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after}}
+        return {"ok": False, "error_code": status, "description": "Internal Server Error"}
+
+
+class ServerThread:
+    """
+    Runs servers on their own event loop in a background thread.
+
+    Injected latency then never delays the event loop of the code under test.
+
+    Parameters:
+    - servers: The servers to run
+    """
+
+    def __init__(self, *servers: FakeServer):
+        self.servers = servers
+        self.urls = []
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    def start(self) -> list:
+        """
+        Start the servers and wait until they listen.
+
+        Returns:
+        - urls (list): The base URL of every server, in order
+        """
+        self._thread = threading.Thread(target=self._run, name="fake-servers", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self.urls
+
+    async def _start_servers(self) -> list:
+        return list(await asyncio.gather(*(server.start() for server in self.servers)))
+
+    async def _close_servers(self) -> None:
+        await asyncio.wait_for(asyncio.gather(*(server.close() for server in self.servers)), 5)
+
+    def _run(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        try:
+            self.urls = self._loop.run_until_complete(self._start_servers())
+        finally:
+            self._ready.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    def stop(self) -> None:
+        """
+        Stop the servers and the thread.
+        """
+        asyncio.run_coroutine_threadsafe(self._close_servers(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+async def serve_forever(args: argparse.Namespace) -> None:
+    failures = {"latency": args.latency, "jitter": args.jitter, "error_rate": args.error_rate,
+                "rate_limit_rate": args.rate_limit_rate, "retry_after": args.retry_after}
+    owm_url = await FakeOpenWeather(**failures).start(args.host, args.owm_port)
+    bot_url = await FakeBotApi(**failures).start(args.host, args.bot_port)
+    print(f"OWM_BASE_URL={owm_url}\nBOT_API_BASE_URL={bot_url}", flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the stand-in OpenWeather and Telegram Bot API servers.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--owm-port", type=int, default=8081)
+    parser.add_argument("--bot-port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds every request waits")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with a 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry delay in seconds sent with a 429")
+    try:
+        asyncio.run(serve_forever(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
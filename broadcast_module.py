@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from rate_limit_module import TokenBucket
+from metrics_module import Counter, Histogram
+from config import *
+
+logger = logging.getLogger(__name__)
+
+broadcast_queued = Counter("broadcast_queued_total", "Messages queued by broadcasts.")
+broadcast_messages = Counter("broadcast_messages_total", "Processed broadcast messages by outcome, retries included.",
+                             ("outcome",))
+broadcast_flood_waits = Counter("broadcast_flood_waits_total", "Flood waits requested by Telegram while broadcasting.")
+broadcast_seconds = Histogram("broadcast_duration_seconds", "Duration of broadcasts.",
+                              buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+
+
+def group_by_location(users) -> dict:
+    """
+    Group subscribers by the grid cell of their coordinates.
+
+    The cell comes from the cell_lat and cell_lon columns, the ones the
+    prefetch reads, so both use the same database rounding.
+
+    Parameters:
+    - users (list): Rows of (user_id, lat, lon, city, cell lat, cell lon)
+
+    Returns:
+    - locations (dict): Lists of subscriber rows keyed by the (lat, lon) cell
+    """
+    locations = {}
+    for user in users:
+        locations.setdefault((user[4], user[5]), []).append(user)
+    return locations
+
+
+class BroadcastStats:
+    """
+    Progress and completion statistics of a broadcast.
+    """
+
+    def __init__(self):
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retried = 0
+        self.flood_waits = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def duration(self) -> float:
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+    def as_dict(self) -> dict:
+        """
+        Get the statistics as a dictionary.
+
+        Returns:
+        - stats (dict): The broadcast counters, duration and send rate
+        """
+        duration = self.duration
+        return {
+            "queued": self.queued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "retried": self.retried,
+            "flood_waits": self.flood_waits,
+            "duration": round(duration, 3),
+            "rate": round(self.sent / duration, 2) if duration else 0.0,
+        }
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    """
+    Get the flood wait of a RetryAfter error in seconds.
+
+    Parameters:
+    - error (RetryAfter): The error raised by Telegram
+
+    Returns:
+    - seconds (float): The time to wait before sending again
+    """
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class Broadcaster:
+    """
+    Sends many messages concurrently while respecting Telegram rate limits.
+
+    A bounded pool of workers takes (chat_id, text) pairs from a queue. Every
+    send takes a token from a global bucket and waits for the per-chat
+    interval; a RetryAfter response pauses all workers for the requested time
+    and the message is sent again.
+
+    Parameters:
+    - bot (Bot): The bot used to send messages
+    - workers (int): The number of concurrent senders
+    - rate (float): The global number of messages per second
+    - per_chat_interval (float): The minimum number of seconds between messages to one chat
+    - max_retries (int): How many times a message is retried after a flood wait or network error
+    - progress_every (int): Log progress after this many processed messages
+    - send_kwargs: Extra arguments passed to Bot.send_message
+    """
+
+    def __init__(self, bot: Bot, workers: int = BROADCAST_WORKERS, rate: float = BROADCAST_RATE,
+                 per_chat_interval: float = BROADCAST_PER_CHAT_INTERVAL, max_retries: int = BROADCAST_MAX_RETRIES,
+                 progress_every: int = BROADCAST_PROGRESS_EVERY, **send_kwargs):
+        self.bot = bot
+        self.workers = workers
+        self.max_retries = max_retries
+        self.progress_every = progress_every
+        self.per_chat_interval = per_chat_interval
+        self.send_kwargs = send_kwargs
+        self.stats = BroadcastStats()
+        self._bucket = TokenBucket(rate)
+        self._chat_next_send = {}
+        self._paused_until = 0.0
+
+    async def _wait_for_chat(self, chat_id: int) -> None:
+        now = time.monotonic()
+        next_send = self._chat_next_send.get(chat_id, 0.0)
+        self._chat_next_send[chat_id] = max(now, next_send) + self.per_chat_interval
+        if next_send > now:
+            await asyncio.sleep(next_send - now)
+
+    async def _wait_for_flood(self) -> None:
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    async def _send(self, chat_id: int, text: str) -> None:
+        stats = self.stats
+        for attempt in range(self.max_retries + 1):
+            await self._wait_for_flood()
+            await self._wait_for_chat(chat_id)
+            await self._bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, **self.send_kwargs)
+                stats.sent += 1
+                broadcast_messages.inc("sent")
+                return
+            except RetryAfter as e:
+                stats.flood_waits += 1
+                broadcast_flood_waits.inc()
+                delay = _retry_after_seconds(e)
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                logger.warning("Flood wait of %.1fs requested while broadcasting", delay)
+            except Forbidden:
+                # The user blocked the bot or deleted the chat, retrying will not help
+                stats.blocked += 1
+                broadcast_messages.inc("blocked")
+                return
+            except BadRequest as e:
+                logger.warning("Broadcast message to %s rejected: %s", chat_id, e)
+                stats.failed += 1
+                broadcast_messages.inc("failed")
+                return
+            except NetworkError as e:
+                logger.warning("Network error while sending to %s: %s", chat_id, e)
+                await asyncio.sleep(min(2 ** attempt, 30))
+            if attempt < self.max_retries:
+                stats.retried += 1
+                broadcast_messages.inc("retried")
+        stats.failed += 1
+        broadcast_messages.inc("failed")
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                await self._send(*item)
+                processed = self.stats.sent + self.stats.failed + self.stats.blocked
+                if self.progress_every and processed % self.progress_every == 0:
+                    logger.info("Broadcast progress: %s", self.stats.as_dict())
+            except Exception:
+                logger.exception("Unexpected error while broadcasting")
+                self.stats.failed += 1
+                broadcast_messages.inc("failed")
+            finally:
+                queue.task_done()
+
+    async def run(self, messages) -> BroadcastStats:
+        """
+        Send all messages and wait until every one is delivered or has failed.
+
+        Parameters:
+        - messages: An iterable or async iterable of (chat_id, text) pairs
+
+        Returns:
+        - stats (BroadcastStats): The completion statistics
+        """
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+        try:
+            if hasattr(messages, "__aiter__"):
+                async for item in messages:
+                    await queue.put(item)
+                    self.stats.queued += 1
+                    broadcast_queued.inc()
+            else:
+                for item in messages:
+                    await queue.put(item)
+                    self.stats.queued += 1
+                    broadcast_queued.inc()
+        finally:
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+            self.stats.finished_at = time.monotonic()
+            broadcast_seconds.observe(self.stats.duration)
+        logger.info("Broadcast finished: %s", self.stats.as_dict())
+        return self.stats
@@ -0,0 +1,140 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    In-process cache with LRU eviction and a per-entry time to live.
+
+    Expired entries can be kept for max_stale more seconds, during which
+    get_stale still returns them.
+
+    Parameters:
+    - maxsize (int): The maximum number of entries kept in memory
+    - ttl (float): The number of seconds an entry stays fresh
+    - max_stale (float): The number of seconds an expired entry is kept for get_stale
+    """
+
+    def __init__(self, maxsize: int, ttl: float, max_stale: float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key):
+        """
+        Get a fresh value from the cache.
+
+        Parameters:
+        - key: The cache key
+
+        Returns:
+        - value: The cached value, or None if it is missing or expired
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        now = time.monotonic()
+        if expires_at <= now:
+            if expires_at + self.max_stale <= now:
+                del self._data[key]
+                self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def get_stale(self, key):
+        """
+        Get a value that has expired less than max_stale seconds ago.
+
+        Parameters:
+        - key: The cache key
+
+        Returns:
+        - value: The expired value, or None if it is missing, fresh or too old
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        now = time.monotonic()
+        if expires_at > now or expires_at + self.max_stale <= now:
+            return None
+        self.stale_hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        """
+        Store a value in the cache, evicting the least recently used entries if full.
+
+        Parameters:
+        - key: The cache key
+        - value: The value to store
+        - ttl (float): Optional time to live overriding the cache default
+        """
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def values(self) -> list:
+        """
+        Get all values that have not expired yet.
+
+        Returns:
+        - values (list): The cached values, least recently used first
+        """
+        now = time.monotonic()
+        return [value for value, expires_at in self._data.values() if expires_at > now]
+
+    def pop(self, key, default=None):
+        """
+        Remove a key from the cache.
+
+        Parameters:
+        - key: The cache key
+        - default: The value returned if the key is missing
+
+        Returns:
+        - value: The removed value, or default
+        """
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self) -> None:
+        """
+        Remove all entries from the cache.
+        """
+        self._data.clear()
+
+    def stats(self) -> dict:
+        """
+        Get the cache counters.
+
+        Returns:
+        - stats (dict): Size, hits, misses, evictions, expirations and hit ratio
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
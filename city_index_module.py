@@ -0,0 +1,226 @@
+"""
+Offline city index answering city lookups without the geocoding API.
+
+The index is a text file with one city per line, sorted by normalised name:
+
+    normalised name \t name \t state \t country \t lat \t lon \t population
+
+It is built from a GeoNames cities dump (e.g. cities15000.txt from
+https://download.geonames.org/export/dump/) with:
+
+    python city_index_module.py cities15000.txt cities.idx [--min-population N] [--admin1 admin1CodesASCII.txt]
+
+and memory-mapped at runtime, so lookups binary search the mapped file and
+only the line offsets are held in Python objects.
+"""
+
+import argparse
+import heapq
+import mmap
+import os
+import unicodedata
+from array import array
+
+
+def normalize_city(city: str) -> str:
+    """
+    Normalise a city name for use as a cache or index key.
+
+    Case, repeated whitespace and diacritics are ignored, so "Tel  Aviv" and
+    "tel aviv" share one key, as do "Zürich" and "Zurich".
+
+    Parameters:
+    - city (str): The name of the city
+
+    Returns:
+    - key (str): The normalised city name
+    """
+    decomposed = unicodedata.normalize("NFKD", city)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(stripped.casefold().split())
+
+
+class CityIndex:
+    """
+    Memory-mapped sorted city index with exact and prefix lookup.
+
+    Lines with the same normalised name are stored most populous first.
+
+    Parameters:
+    - path (str): The path of the index file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        # An empty file cannot be mapped, e.g. when no city of the dump matched, it is an empty index
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = b""
+        self._offsets = array("Q")
+        position = 0
+        while position < len(self._map):
+            self._offsets.append(position)
+            end = self._map.find(b"\n", position)
+            position = len(self._map) if end == -1 else end + 1
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def close(self) -> None:
+        """
+        Unmap and close the index file.
+        """
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def _line(self, i: int) -> bytes:
+        start = self._offsets[i]
+        end = self._offsets[i + 1] - 1 if i + 1 < len(self._offsets) else len(self._map)
+        return self._map[start:end].rstrip(b"\r\n")
+
+    def _key(self, i: int) -> bytes:
+        start = self._offsets[i]
+        return self._map[start:self._map.find(b"\t", start)]
+
+    def _bisect(self, key: bytes) -> int:
+        # Index of the first line whose key is not smaller than key
+        low, high = 0, len(self._offsets)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _record(self, i: int) -> dict:
+        _, name, state, country, lat, lon, population = self._line(i).decode("utf-8").split("\t")
+        record = {"name": name, "lat": float(lat), "lon": float(lon), "country": country, "population": int(population)}
+        if state:
+            record["state"] = state
+        return record
+
+    def exact(self, key: str, limit: int = 5) -> list:
+        """
+        Find the cities with a normalised name.
+
+        Parameters:
+        - key (str): The normalised city name
+        - limit (int): The maximum number of cities to return
+
+        Returns:
+        - cities (list): Cities shaped like geocoding API results, most populous first
+        """
+        encoded = key.encode("utf-8")
+        cities = []
+        i = self._bisect(encoded)
+        while i < len(self._offsets) and len(cities) < limit and self._key(i) == encoded:
+            cities.append(self._record(i))
+            i += 1
+        if cities:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return cities
+
+    def prefix(self, prefix: str, limit: int = 10, scan: int = 1000) -> list:
+        """
+        Find the most populous cities whose normalised name starts with a prefix.
+
+        Parameters:
+        - prefix (str): The normalised beginning of the city name
+        - limit (int): The maximum number of cities to return
+        - scan (int): The maximum number of matching lines considered
+
+        Returns:
+        - cities (list): Cities shaped like geocoding API results, most populous first
+        """
+        encoded = prefix.encode("utf-8")
+        i = self._bisect(encoded)
+        end = min(i + scan, len(self._offsets))
+        matches = []
+        while i < end and self._key(i).startswith(encoded):
+            matches.append(self._record(i))
+            i += 1
+        return heapq.nlargest(limit, matches, key=lambda city: city["population"])
+
+    def stats(self) -> dict:
+        """
+        Get the index counters.
+
+        Returns:
+        - stats (dict): Number of cities, exact lookup hits and misses
+        """
+        return {"cities": len(self._offsets), "hits": self.hits, "misses": self.misses}
+
+
+def load_admin1_names(path: str) -> dict:
+    """
+    Read GeoNames admin1 names, i.e. the states or regions of each country.
+
+    Parameters:
+    - path (str): The path of admin1CodesASCII.txt
+
+    Returns:
+    - names (dict): Region names keyed by "country.code"
+    """
+    names = {}
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 2:
+                names[fields[0]] = fields[1]
+    return names
+
+
+def build_index(dump_path: str, index_path: str, min_population: int, admin1_path: str = None) -> int:
+    """
+    Build a city index from a GeoNames cities dump.
+
+    Cities are indexed by their name and, if it normalises differently, by
+    their ASCII name.
+
+    Parameters:
+    - dump_path (str): The path of the GeoNames dump
+    - index_path (str): The path of the index file to write
+    - min_population (int): Cities with fewer inhabitants are left out
+    - admin1_path (str): Optional path of admin1CodesASCII.txt to fill in state names
+
+    Returns:
+    - count (int): The number of written lines
+    """
+    admin1 = load_admin1_names(admin1_path) if admin1_path else {}
+    rows = []
+    with open(dump_path, encoding="utf-8") as dump:
+        for line in dump:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 15:
+                continue
+            name, ascii_name, lat, lon, country, admin1_code = fields[1], fields[2], fields[4], fields[5], fields[8], fields[10]
+            population = int(fields[14] or 0)
+            if population < min_population:
+                continue
+            state = admin1.get(f"{country}.{admin1_code}", "")
+            for key in {normalize_city(name), normalize_city(ascii_name)}:
+                if key:
+                    rows.append((key, -population, name, state, country, lat, lon))
+    rows.sort()
+    with open(index_path, "w", encoding="utf-8", newline="\n") as index:
+        for key, population, name, state, country, lat, lon in rows:
+            index.write(f"{key}\t{name}\t{state}\t{country}\t{lat}\t{lon}\t{-population}\n")
+    return len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the offline city index from a GeoNames cities dump.")
+    parser.add_argument("dump", help="GeoNames cities dump, e.g. cities15000.txt")
+    parser.add_argument("index", help="Index file to write")
+    parser.add_argument("--min-population", type=int, default=15000, help="Leave out smaller cities")
+    parser.add_argument("--admin1", help="admin1CodesASCII.txt, used to fill in state names")
+    args = parser.parse_args()
+    print(f"Wrote {build_index(args.dump, args.index, args.min_population, args.admin1)} cities to {args.index}")
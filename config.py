@@ -1,9 +1,115 @@
-import os
-
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-API_KEY = os.getenv("API_KEY")
-DB_NAME = os.getenv("DB_NAME")
-DB_USER = os.getenv("DB_USER")
-DB_PASSWORD = os.getenv("DB_PASSWORD")
-DB_HOST = os.getenv("DB_HOST")
-DB_PORT= os.getenv("DB_PORT")
\ No newline at end of file
+import os
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")
+API_KEY = os.getenv("API_KEY")
+# e.g. a stand-in OpenWeather server used by the benchmarks
+OWM_BASE_URL = os.getenv("OWM_BASE_URL", "https://api.openweathermap.org").rstrip("/")
+DB_NAME = os.getenv("DB_NAME")
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT= os.getenv("DB_PORT")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = float(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PING_IDLE = float(os.getenv("DB_POOL_PING_IDLE", "30"))
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+SUBSCRIBER_BATCH_SIZE = int(os.getenv("SUBSCRIBER_BATCH_SIZE", "1000"))
+SUBSCRIBER_BATCH_RETRIES = int(os.getenv("SUBSCRIBER_BATCH_RETRIES", "3"))
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "0") == "1"
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "1"))
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "500"))
+
+# OpenWeather HTTP client configuration
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+HTTP_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+
+# OpenWeather plan limits and retry policy
+OWM_FORECAST_PER_MINUTE = float(os.getenv("OWM_FORECAST_PER_MINUTE", "45"))
+OWM_GEOCODING_PER_MINUTE = float(os.getenv("OWM_GEOCODING_PER_MINUTE", "15"))
+OWM_BURST = float(os.getenv("OWM_BURST", "5"))
+OWM_CALLS_PER_DAY = int(os.getenv("OWM_CALLS_PER_DAY", "30000"))
+OWM_INTERACTIVE_RESERVE = float(os.getenv("OWM_INTERACTIVE_RESERVE", "0.1"))
+OWM_MAX_RETRIES = int(os.getenv("OWM_MAX_RETRIES", "3"))
+OWM_BACKOFF_BASE = float(os.getenv("OWM_BACKOFF_BASE", "0.5"))
+OWM_BACKOFF_MAX = float(os.getenv("OWM_BACKOFF_MAX", "30"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+
+# Forecast cache configuration
+FORECAST_CACHE_SIZE = int(os.getenv("FORECAST_CACHE_SIZE", "1000"))
+FORECAST_CACHE_TTL = float(os.getenv("FORECAST_CACHE_TTL", "10800"))
+FORECAST_MAX_STALE = float(os.getenv("FORECAST_MAX_STALE", "21600"))
+COORD_PRECISION = int(os.getenv("COORD_PRECISION", "2"))
+
+# Geocoding cache configuration
+GEOCODING_CACHE_SIZE = int(os.getenv("GEOCODING_CACHE_SIZE", "10000"))
+GEOCODING_CACHE_TTL = float(os.getenv("GEOCODING_CACHE_TTL", str(30 * 24 * 3600)))
+
+# Offline city index built with city_index_module.py, lookups missing from it go to the geocoding API
+CITY_INDEX_PATH = os.getenv("CITY_INDEX_PATH", "")
+
+# Inline query city autocomplete
+AUTOCOMPLETE_RESULTS = int(os.getenv("AUTOCOMPLETE_RESULTS", "10"))
+AUTOCOMPLETE_CACHE_SIZE = int(os.getenv("AUTOCOMPLETE_CACHE_SIZE", "10000"))
+AUTOCOMPLETE_CACHE_TTL = float(os.getenv("AUTOCOMPLETE_CACHE_TTL", "300"))
+AUTOCOMPLETE_DEBOUNCE = float(os.getenv("AUTOCOMPLETE_DEBOUNCE", "0.3"))
+AUTOCOMPLETE_REFRESH_INTERVAL = float(os.getenv("AUTOCOMPLETE_REFRESH_INTERVAL", "600"))
+
+# Number of registered locations loaded into memory at startup, others are loaded on first use
+LOCATION_REGISTRY_PRELOAD = int(os.getenv("LOCATION_REGISTRY_PRELOAD", "100000"))
+# Number of locations kept in memory, the least recently used are loaded again from the database when needed
+LOCATION_REGISTRY_SIZE = int(os.getenv("LOCATION_REGISTRY_SIZE", "100000"))
+
+# Daily broadcast configuration
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "16"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", "1"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+BROADCAST_PROGRESS_EVERY = int(os.getenv("BROADCAST_PROGRESS_EVERY", "500"))
+BROADCAST_FETCH_CONCURRENCY = int(os.getenv("BROADCAST_FETCH_CONCURRENCY", "10"))
+
+# Default delivery time zone and "HH:MM" time of the daily updates, users can change their own
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Asia/Tel_Aviv")
+DEFAULT_DELIVERY_TIME = os.getenv("DEFAULT_DELIVERY_TIME", "07:00")
+
+# Pre-broadcast prefetch configuration, messages stay valid PREFETCH_MESSAGE_TTL seconds past delivery
+PREFETCH_LEAD_MINUTES = int(os.getenv("PREFETCH_LEAD_MINUTES", "15"))
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", str(BROADCAST_FETCH_CONCURRENCY)))
+PREFETCH_CACHE_SIZE = int(os.getenv("PREFETCH_CACHE_SIZE", "20000"))
+PREFETCH_MESSAGE_TTL = float(os.getenv("PREFETCH_MESSAGE_TTL", "3600"))
+
+# Forecast browsing configuration
+FORECAST_STORE_SIZE = int(os.getenv("FORECAST_STORE_SIZE", "2000"))
+FORECAST_STORE_TTL = float(os.getenv("FORECAST_STORE_TTL", "3600"))
+BROWSING_STATE_TTL = float(os.getenv("BROWSING_STATE_TTL", "900"))
+# Seconds without activity after which a conversation ends
+CONVERSATION_TIMEOUT = float(os.getenv("CONVERSATION_TIMEOUT", "120"))
+
+# Update delivery configuration, webhook mode is used when WEBHOOK_URL is set
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "1"))
+
+# Shared conversation state configuration
+PERSISTENCE_ENABLED = os.getenv("PERSISTENCE_ENABLED", "0") == "1"
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "1"))
+PERSISTENCE_FLUSH_DELAY = float(os.getenv("PERSISTENCE_FLUSH_DELAY", "0.05"))
+PERSISTENCE_CACHE_SIZE = int(os.getenv("PERSISTENCE_CACHE_SIZE", "10000"))
+PERSISTENCE_CACHE_TTL = float(os.getenv("PERSISTENCE_CACHE_TTL", "2"))
+# Only one worker runs the daily prefetch and broadcast jobs, the others set RUN_JOBS=0
+RUN_JOBS = os.getenv("RUN_JOBS", "1") == "1"
+DELIVERY_SYNC_INTERVAL = float(os.getenv("DELIVERY_SYNC_INTERVAL", "60"))
+
+# Metrics configuration, the /metrics endpoint is served when METRICS_PORT is set
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+SLOW_HANDLER_SECONDS = float(os.getenv("SLOW_HANDLER_SECONDS", "1"))
@@ -1,65 +1,1043 @@
-from psycopg2 import pool
-from config import *
-
-# Connection pool configuration
-POOL_MIN_CONNECTIONS = 1
-POOL_MAX_CONNECTIONS = 5
-
-# Database initialization function
-def init_database():
-    return pool.SimpleConnectionPool(
-        POOL_MIN_CONNECTIONS,
-        POOL_MAX_CONNECTIONS,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
-
-# Global variable to store the connection pool
-db_pool = init_database()
-
-def execute_query(query, params=None) -> list:
-    """
-    Execute a SQL query.
-
-    Parameters:
-    - query (str): The SQL query to execute
-    - params (tuple): The parameters to bind to the query
-
-    Returns:
-    - result (list or None): The result of the query
-    """
-    connection = db_pool.getconn()
-    try:
-        with connection.cursor() as cursor:
-            cursor.execute(query, params)
-
-            # Check if the query is an UPDATE, INSERT, DELETE, etc.
-            if query.strip().upper().startswith("UPDATE") or query.strip().upper().startswith("INSERT") or query.strip().upper().startswith("DELETE"):
-                # For non-select queries, commit the changes and return None
-                connection.commit()
-                return None
-            else:
-                # For SELECT queries, fetch and return the results
-                result = cursor.fetchall()
-                return result if result else None
-
-    except Exception as e:
-        # Handle exceptions, print an error message, or raise an exception as needed
-        print(f"Error executing query: {e}")
-
-    finally:
-        db_pool.putconn(connection)
-
-def get_users_with_daily_updates() -> list:
-    """
-    Retrieve a list of users with daily updates.
-
-    Returns:
-    - result (list): The list of users with daily updates
-    """
-    query = "SELECT * FROM telegram_users.users"
-    result = execute_query(query)
-    return result
+import asyncio
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from psycopg2 import extensions, extras, pool
+from metrics_module import Counter, Gauge, Histogram
+from config import *
+
+logger = logging.getLogger(__name__)
+
+# Connection pool configuration
+POOL_MIN_CONNECTIONS = DB_POOL_MIN
+POOL_MAX_CONNECTIONS = DB_POOL_MAX
+
+# Statement kinds: READ returns rows, WRITE commits, RETURNING commits and returns rows
+READ, WRITE, RETURNING = "read", "write", "returning"
+
+UPSERT_USER_QUERY = ("INSERT INTO telegram_users.users (user_id, lat, lon, city, location_id) VALUES %s "
+                     "ON CONFLICT (user_id) DO UPDATE SET lat = EXCLUDED.lat, lon = EXCLUDED.lon, city = EXCLUDED.city, "
+                     "location_id = EXCLUDED.location_id, active = true")
+
+# Statements prepared once per connection and executed by name
+PREPARED_STATEMENTS = {
+    "select_user_city": ("SELECT city FROM telegram_users.users WHERE user_id = $1", READ),
+    "select_user_location": ("SELECT lat, lon, city FROM telegram_users.users WHERE user_id = $1", READ),
+    "upsert_user": (UPSERT_USER_QUERY.replace("%s", "($1, $2, $3, $4, $5)"), WRITE),
+    "deactivate_user": ("UPDATE telegram_users.users SET active = false WHERE user_id = $1 AND active "
+                        "RETURNING user_id", RETURNING),
+    "select_user_delivery": ("SELECT timezone, to_char(delivery_time, 'HH24:MI') FROM telegram_users.users "
+                             "WHERE user_id = $1", READ),
+    "update_user_delivery": ("UPDATE telegram_users.users SET timezone = COALESCE($2, timezone), "
+                             "delivery_time = COALESCE($3::time, delivery_time) WHERE user_id = $1 AND active "
+                             "RETURNING timezone, to_char(delivery_time, 'HH24:MI')", RETURNING),
+    # The no-op update makes RETURNING yield the id of an existing location too
+    "intern_location": ("INSERT INTO telegram_users.locations (name, lat, lon) VALUES ($1, $2, $3) "
+                        "ON CONFLICT (name, lat, lon) DO UPDATE SET name = EXCLUDED.name RETURNING location_id", RETURNING),
+    "select_location": ("SELECT location_id, name, lat, lon FROM telegram_users.locations WHERE location_id = $1", READ),
+}
+
+
+class PreparingConnection(extensions.connection):
+    """
+    Connection remembering which statements have been prepared on it, when it
+    was opened and when it was last returned to the pool.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.created_at = self.returned_at = time.monotonic()
+
+
+class PoolTimeout(pool.PoolError):
+    """
+    Raised when no pooled connection becomes free in time.
+    """
+
+
+class ConnectionPool:
+    """
+    Thread-safe PostgreSQL connection pool, connecting on first use.
+
+    Idle connections are kept up to max_size and reused most recent first.
+    A connection older than recycle seconds is replaced, and one idle for more
+    than ping_idle seconds is checked with SELECT 1 before it is handed out,
+    so a connection dropped by the server or a failover never reaches a query.
+    Database calls reserve one of max_size slots on the event loop before
+    they are handed to a database thread, and only then take a connection,
+    so the waits and timeouts are those of the calls.
+
+    Parameters:
+    - min_size (int): The number of connections opened on first use
+    - max_size (int): The maximum number of open connections
+    - timeout (float): Seconds to wait for a free slot before PoolTimeout is raised
+    - recycle (float): Maximum age of a connection in seconds, 0 keeps connections forever
+    - ping_idle (float): Idle seconds after which a connection is checked, 0 checks every time
+    - connect_kwargs: The arguments of psycopg2.connect
+    """
+
+    def __init__(self, min_size: int, max_size: int, timeout: float, recycle: float, ping_idle: float, **connect_kwargs):
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_idle = ping_idle
+        self.connect_kwargs = connect_kwargs
+        self.opened = False
+        self.closed = False
+        self._idle = []
+        self._in_use = 0
+        self._lock = threading.Lock()
+        self._slots = asyncio.Semaphore(max_size)
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self.recycled = 0
+        self.dead = 0
+
+    def _connect(self) -> PreparingConnection:
+        return psycopg2.connect(connection_factory=PreparingConnection, **self.connect_kwargs)
+
+    def _open(self) -> None:
+        with self._lock:
+            if self.opened:
+                return
+            if self.closed:
+                raise pool.PoolError("The connection pool is closed")
+            self._idle = [self._connect() for _ in range(self.min_size)]
+            self.opened = True
+            logger.info("Opened database connection pool of %d to %d connections", self.min_size, self.max_size)
+
+    def _usable(self, connection: PreparingConnection) -> bool:
+        if connection.closed:
+            self.dead += 1
+            return False
+        now = time.monotonic()
+        if self.recycle and now - connection.created_at > self.recycle:
+            self.recycled += 1
+            return False
+        if now - connection.returned_at < self.ping_idle:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error as e:
+            logger.warning("Dropping dead database connection: %s", e)
+            self.dead += 1
+            return False
+
+    def _discard(self, connection: PreparingConnection) -> None:
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    async def reserve(self) -> None:
+        """
+        Wait up to timeout seconds for a free slot, to be given back with release.
+        """
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise PoolTimeout(f"No database connection free after {self.timeout} seconds") from None
+        waited = time.perf_counter() - started
+        db_pool_wait_seconds.observe(waited)
+        with self._lock:
+            self.waits += 1
+            self.wait_seconds += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def release(self) -> None:
+        """
+        Give back a slot taken with reserve, from the event loop thread.
+        """
+        self._slots.release()
+
+    def getconn(self) -> PreparingConnection:
+        """
+        Take a healthy connection, opening one if none is idle.
+
+        The caller holds a slot, so no more than max_size connections are in use.
+
+        Returns:
+        - connection (PreparingConnection): The connection, to be given back with putconn
+        """
+        self._open()
+        while True:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                connection = self._connect()
+                break
+            if self._usable(connection):
+                break
+            self._discard(connection)
+        with self._lock:
+            self._in_use += 1
+        return connection
+
+    def putconn(self, connection: PreparingConnection, close: bool = False) -> None:
+        """
+        Give a connection back to the pool.
+
+        Parameters:
+        - connection (PreparingConnection): The connection taken with getconn
+        - close (bool): True to close the connection instead of keeping it
+        """
+        try:
+            if not (close or self.closed or connection.closed):
+                status = connection.info.transaction_status
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+        except psycopg2.Error:
+            close = True
+        try:
+            if close or self.closed or connection.closed:
+                self._discard(connection)
+            else:
+                connection.returned_at = time.monotonic()
+                with self._lock:
+                    self._idle.append(connection)
+        finally:
+            with self._lock:
+                self._in_use -= 1
+
+    def closeall(self) -> None:
+        """
+        Close the idle connections, connections still in use are closed when given back.
+        """
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self._discard(connection)
+
+    def stats(self) -> dict:
+        """
+        Get the pool size and wait counters.
+
+        Returns:
+        - stats (dict): Idle and in use connections, reserved slots, total and longest wait, timeouts, recycled and dead connections
+        """
+        with self._lock:
+            return {
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "max_size": self.max_size,
+                "waits": self.waits,
+                "wait_seconds": round(self.wait_seconds, 3),
+                "max_wait": round(self.max_wait, 3),
+                "timeouts": self.timeouts,
+                "recycled": self.recycled,
+                "dead": self.dead,
+            }
+
+
+db_pool_wait_seconds = Histogram("db_pool_wait_seconds", "Time database calls waited for a pooled connection.")
+db_call_seconds = Histogram("db_call_duration_seconds", "Duration of database calls holding a connection.", ("helper",))
+db_errors = Counter("db_errors_total", "Failed database calls.", ("helper",))
+
+# Connection pool shared by the database threads, nothing connects before the first query
+db_pool = ConnectionPool(
+    POOL_MIN_CONNECTIONS,
+    POOL_MAX_CONNECTIONS,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    DB_POOL_PING_IDLE,
+    dbname=DB_NAME,
+    user=DB_USER,
+    password=DB_PASSWORD,
+    host=DB_HOST,
+    port=DB_PORT,
+    connect_timeout=DB_CONNECT_TIMEOUT,
+)
+
+db_pool_connections = Gauge("db_pool_connections", "Open database connections.", ("state",),
+                            function=lambda: {(state,): db_pool.stats()[state] for state in ("idle", "in_use")})
+
+# Queries run in these threads, one per pool slot, so they never block the event loop and never queue here
+db_executor = ThreadPoolExecutor(max_workers=POOL_MAX_CONNECTIONS, thread_name_prefix="db")
+
+async def _run_in_pool(helper, *args):
+    """
+    Run a query helper in the database thread pool once a pool slot is free, and time it.
+
+    The slot is held until the helper returns, even if the caller is cancelled.
+
+    Parameters:
+    - helper: The blocking query helper
+    - args: The arguments of the helper
+
+    Returns:
+    - result: The return value of the helper
+
+    Raises:
+    - PoolTimeout: If no slot became free within DB_POOL_TIMEOUT seconds
+    """
+    await db_pool.reserve()
+    loop = asyncio.get_running_loop()
+
+    def run():
+        started = time.perf_counter()
+        try:
+            return helper(*args)
+        finally:
+            db_call_seconds.observe(time.perf_counter() - started, helper.__name__)
+
+    try:
+        future = db_executor.submit(run)
+    except BaseException:
+        db_pool.release()
+        raise
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(db_pool.release))
+    return await asyncio.wrap_future(future)
+
+def _timed_out(helper: str, error: PoolTimeout) -> None:
+    """
+    Report a pool timeout of a helper that reports errors instead of raising them.
+
+    Parameters:
+    - helper (str): The name of the helper, for the log and the error counter
+    - error (PoolTimeout): The timeout
+    """
+    logger.error("Error acquiring a database connection for %s: %s", helper, error)
+    db_errors.inc(helper)
+
+def _acquire(helper: str):
+    """
+    Take a pooled connection for a helper that reports errors instead of raising them.
+
+    Parameters:
+    - helper (str): The name of the helper, for the log and the error counter
+
+    Returns:
+    - connection (PreparingConnection or None): The connection, or None if none could be had
+    """
+    try:
+        return db_pool.getconn()
+    except Exception as e:
+        logger.error("Error acquiring a database connection for %s: %s", helper, e)
+        db_errors.inc(helper)
+        return None
+
+def execute_query(query, params=None, kind: str = READ) -> list:
+    """
+    Execute a SQL query.
+
+    Parameters:
+    - query (str): The SQL query to execute
+    - params (tuple): The parameters to bind to the query
+    - kind (str): READ, WRITE or RETURNING
+
+    Returns:
+    - result (list or None): The result of the query, None for WRITE statements or on error
+    """
+    connection = _acquire("execute_query")
+    if connection is None:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            result = cursor.fetchall() if kind != WRITE else None
+            if kind == READ:
+                connection.rollback()
+            else:
+                connection.commit()
+            return result if result else None
+
+    except Exception as e:
+        logger.error("Error executing query: %s", e)
+        db_errors.inc("execute_query")
+        connection.rollback()
+
+    finally:
+        db_pool.putconn(connection)
+
+def execute_prepared(name: str, params: tuple = ()) -> list:
+    """
+    Execute one of the PREPARED_STATEMENTS, preparing it on the connection first if needed.
+
+    Parameters:
+    - name (str): The name of the statement
+    - params (tuple): The parameters to bind to the statement
+
+    Returns:
+    - result (list or None): The result of the statement
+    """
+    statement, kind = PREPARED_STATEMENTS[name]
+    connection = _acquire("execute_prepared")
+    if connection is None:
+        return None
+    broken = False
+    try:
+        with connection.cursor() as cursor:
+            if name not in connection.prepared:
+                cursor.execute(f"PREPARE {name} AS {statement}")
+                connection.prepared.add(name)
+            placeholders = ", ".join(["%s"] * len(params))
+            cursor.execute(f"EXECUTE {name} ({placeholders})" if params else f"EXECUTE {name}", params)
+            result = cursor.fetchall() if kind != WRITE else None
+            if kind == READ:
+                connection.rollback()
+            else:
+                connection.commit()
+            return result if result else None
+
+    except Exception as e:
+        logger.error("Error executing prepared statement %s: %s", name, e)
+        db_errors.inc("execute_prepared")
+        try:
+            connection.rollback()
+            # Prepared statements may survive the rollback, start again from a clean session
+            with connection.cursor() as cursor:
+                cursor.execute("DEALLOCATE ALL")
+            connection.commit()
+            connection.prepared.clear()
+        except Exception:
+            broken = True
+
+    finally:
+        db_pool.putconn(connection, close=broken)
+
+def execute_transaction(work):
+    """
+    Run a function with a cursor inside one transaction.
+
+    Unlike execute_query, errors are raised to the caller after the rollback.
+
+    Parameters:
+    - work: A function taking the cursor, its return value is returned
+
+    Returns:
+    - result: The return value of work
+    """
+    connection = db_pool.getconn()
+    try:
+        with connection.cursor() as cursor:
+            result = work(cursor)
+        connection.commit()
+        return result
+
+    except Exception:
+        db_errors.inc("execute_transaction")
+        connection.rollback()
+        raise
+
+    finally:
+        db_pool.putconn(connection)
+
+async def execute_query_async(query, params=None, kind: str = READ) -> list:
+    """
+    Execute a SQL query in the database thread pool.
+
+    Parameters:
+    - query (str): The SQL query to execute
+    - params (tuple): The parameters to bind to the query
+    - kind (str): READ, WRITE or RETURNING
+
+    Returns:
+    - result (list or None): The result of the query
+    """
+    try:
+        return await _run_in_pool(execute_query, query, params, kind)
+    except PoolTimeout as e:
+        _timed_out("execute_query", e)
+        return None
+
+async def execute_transaction_async(work):
+    """
+    Run a transaction function in the database thread pool.
+
+    Parameters:
+    - work: A function taking the cursor, its return value is returned
+
+    Returns:
+    - result: The return value of work
+    """
+    return await _run_in_pool(execute_transaction, work)
+
+async def execute_prepared_async(name: str, params: tuple = ()) -> list:
+    """
+    Execute one of the PREPARED_STATEMENTS in the database thread pool.
+
+    Parameters:
+    - name (str): The name of the statement
+    - params (tuple): The parameters to bind to the statement
+
+    Returns:
+    - result (list or None): The result of the statement
+    """
+    try:
+        return await _run_in_pool(execute_prepared, name, params)
+    except PoolTimeout as e:
+        _timed_out("execute_prepared", e)
+        return None
+
+def execute_batch(query: str, rows: list) -> bool:
+    """
+    Execute a statement with a single VALUES %s placeholder for many rows at once.
+
+    Parameters:
+    - query (str): The SQL statement
+    - rows (list): The rows to expand into the VALUES list
+
+    Returns:
+    - success (bool): True if the rows were written
+    """
+    connection = _acquire("execute_batch")
+    if connection is None:
+        return False
+    try:
+        with connection.cursor() as cursor:
+            extras.execute_values(cursor, query, rows, page_size=len(rows))
+        connection.commit()
+        return True
+
+    except Exception as e:
+        logger.error("Error executing batch: %s", e)
+        db_errors.inc("execute_batch")
+        connection.rollback()
+        return False
+
+    finally:
+        db_pool.putconn(connection)
+
+async def execute_batch_async(query: str, rows: list) -> bool:
+    """
+    Execute a batch statement in the database thread pool.
+
+    Parameters:
+    - query (str): The SQL statement
+    - rows (list): The rows to expand into the VALUES list
+
+    Returns:
+    - success (bool): True if the rows were written
+    """
+    try:
+        return await _run_in_pool(execute_batch, query, rows)
+    except PoolTimeout as e:
+        _timed_out("execute_batch", e)
+        return False
+
+
+class WriteBehindQueue:
+    """
+    Coalesces city subscription writes and flushes them to the database in batches.
+
+    Only the latest write of each user is kept until the next flush, and
+    reads of pending users are answered from the queue. Flushes run one at a
+    time, and a write discarded while its flush is running is not queued
+    again if that flush fails.
+
+    Parameters:
+    - flush_interval (float): The number of seconds between flushes
+    - max_batch (int): Flush early once this many users are pending
+    """
+
+    def __init__(self, flush_interval: float, max_batch: int):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = {}
+        self._in_flight = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = None
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def put(self, user_id: int, lat: float, lon: float, city: str, location_id: int = None) -> None:
+        """
+        Queue a user's city, replacing any pending write of the same user.
+
+        Parameters:
+        - user_id (int): The Telegram user id
+        - lat (float): The latitude of the city
+        - lon (float): The longitude of the city
+        - city (str): The name of the city
+        - location_id (int): The id of the city in the location registry
+        """
+        self._pending[int(user_id)] = (int(user_id), lat, lon, city, location_id)
+        if len(self._pending) >= self.max_batch and self._wakeup is not None:
+            self._wakeup.set()
+
+    def get(self, user_id: int):
+        """
+        Get a user's pending write.
+
+        Parameters:
+        - user_id (int): The Telegram user id
+
+        Returns:
+        - row (tuple or None): The pending (user_id, lat, lon, city, location_id) row
+        """
+        return self._pending.get(int(user_id))
+
+    async def discard(self, user_id: int) -> bool:
+        """
+        Drop a user's pending write.
+
+        If a flush is writing the user's row, it is waited for, so a statement
+        the caller runs next lands after that write.
+
+        Parameters:
+        - user_id (int): The Telegram user id
+
+        Returns:
+        - discarded (bool): True if a write was pending or being flushed
+        """
+        user_id = int(user_id)
+        discarded = self._pending.pop(user_id, None) is not None
+        if self._in_flight.pop(user_id, None) is not None:
+            async with self._flush_lock:
+                pass
+            discarded = True
+        return discarded
+
+    async def flush(self) -> int:
+        """
+        Write all pending rows to the database.
+
+        Rows that fail to be written are queued again unless a newer write
+        of the same user arrived in the meantime.
+
+        Returns:
+        - count (int): The number of written rows
+        """
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            rows, self._pending = list(self._pending.values()), {}
+            self._in_flight = {row[0]: row for row in rows}
+            try:
+                written = await execute_batch_async(UPSERT_USER_QUERY, rows)
+            finally:
+                in_flight, self._in_flight = self._in_flight, {}
+            if written:
+                return len(rows)
+            # Rows discarded during the flush are not in in_flight anymore
+            for row in in_flight.values():
+                self._pending.setdefault(row[0], row)
+            return 0
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self) -> None:
+        """
+        Start flushing in the background.
+        """
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """
+        Stop the background flushing and write everything still pending.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+# Optional queue for city subscription writes, enabled with WRITE_BEHIND_ENABLED
+write_behind = WriteBehindQueue(WRITE_BEHIND_INTERVAL, WRITE_BEHIND_BATCH) if WRITE_BEHIND_ENABLED else None
+
+async def get_user_city(user_id: int):
+    """
+    Retrieve the saved city of a user.
+
+    Parameters:
+    - user_id (int): The Telegram user id
+
+    Returns:
+    - city (str or None): The saved city, or None if the user has not chosen one
+    """
+    pending = write_behind.get(user_id) if write_behind else None
+    if pending:
+        return pending[3]
+    result = await execute_prepared_async("select_user_city", (int(user_id),))
+    return result[0][0] if result else None
+
+async def get_user_location(user_id: int):
+    """
+    Retrieve the saved location of a user.
+
+    Parameters:
+    - user_id (int): The Telegram user id
+
+    Returns:
+    - location (tuple or None): The (lat, lon, city) row, or None if the user has not chosen a city
+    """
+    pending = write_behind.get(user_id) if write_behind else None
+    if pending:
+        return pending[1:4]
+    result = await execute_prepared_async("select_user_location", (int(user_id),))
+    return result[0] if result else None
+
+async def save_user_city(user_id: int, lat: float, lon: float, city: str, location_id: int = None) -> None:
+    """
+    Save the city of a user, updating an existing entry or creating a new one.
+
+    With write-behind enabled the write is queued and flushed with others.
+
+    Parameters:
+    - user_id (int): The Telegram user id
+    - lat (float): The latitude of the city
+    - lon (float): The longitude of the city
+    - city (str): The name of the city
+    - location_id (int): The id of the city in the location registry
+    """
+    if write_behind:
+        write_behind.put(user_id, lat, lon, city, location_id)
+    else:
+        await execute_prepared_async("upsert_user", (int(user_id), lat, lon, city, location_id))
+
+async def deactivate_user(user_id: int) -> bool:
+    """
+    Cancel a user's subscription, keeping the saved city.
+
+    Parameters:
+    - user_id (int): The Telegram user id
+
+    Returns:
+    - deleted (bool): True if the user was subscribed
+    """
+    discarded = await write_behind.discard(user_id) if write_behind else False
+    result = await execute_prepared_async("deactivate_user", (int(user_id),))
+    return bool(result) or discarded
+
+def close_database() -> None:
+    """
+    Wait for running queries and close all pooled connections.
+    """
+    db_executor.shutdown(wait=True)
+    db_pool.closeall()
+
+async def iter_users_with_daily_updates(batch_size: int = SUBSCRIBER_BATCH_SIZE, bucket: tuple = None,
+                                        after_user_id: int = -1):
+    """
+    Iterate over users with daily updates in batches ordered by user_id.
+
+    Each batch is a separate keyset query (WHERE user_id > last seen id), so
+    only one batch is held in memory and no cursor stays open between batches.
+    Unlike the other helpers, errors are raised, so a failed query is never
+    taken for the last batch; iteration can resume with after_user_id.
+
+    Parameters:
+    - batch_size (int): The maximum number of rows per batch
+    - bucket (tuple): Optional (timezone, "HH:MM") delivery bucket the users must belong to
+    - after_user_id (int): Only users with a greater user_id are returned
+
+    Yields:
+    - batch (list): A list of (user_id, lat, lon, city, cell lat, cell lon) rows
+    """
+    if bucket is None:
+        query = ("SELECT user_id, lat, lon, city, cell_lat::float8, cell_lon::float8 FROM telegram_users.users "
+                 "WHERE active AND user_id > %s ORDER BY user_id LIMIT %s")
+    else:
+        query = ("SELECT user_id, lat, lon, city, cell_lat::float8, cell_lon::float8 FROM telegram_users.users WHERE active "
+                 "AND timezone = %s AND delivery_time = %s::time AND user_id > %s ORDER BY user_id LIMIT %s")
+    last_user_id = after_user_id
+    while True:
+        params = (last_user_id, batch_size) if bucket is None else (*bucket, last_user_id, batch_size)
+
+        def fetch_batch(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+        batch = await execute_transaction_async(fetch_batch)
+        if not batch:
+            return
+        yield batch
+        if len(batch) < batch_size:
+            return
+        last_user_id = batch[-1][0]
+
+async def get_subscribed_locations(bucket: tuple = None) -> list:
+    """
+    Retrieve the distinct locations users are subscribed to, aggregated on the indexed grid cell columns.
+
+    Parameters:
+    - bucket (tuple): Optional (timezone, "HH:MM") delivery bucket the users must belong to
+
+    Returns:
+    - result (list): The list of (cell lat, cell lon, city, subscribers) rows
+    """
+    query = "SELECT cell_lat::float8, cell_lon::float8, city, COUNT(*) FROM telegram_users.users WHERE active "
+    if bucket is None:
+        params = None
+    else:
+        query += "AND timezone = %s AND delivery_time = %s::time "
+        params = bucket
+    query += "GROUP BY cell_lat, cell_lon, city"
+    result = await execute_query_async(query, params)
+    return result if result else []
+
+async def get_subscribed_cities() -> list:
+    """
+    Retrieve the distinct cities users are subscribed to, with their exact coordinates.
+
+    Returns:
+    - result (list): The list of (city, lat, lon, subscribers) rows
+    """
+    query = "SELECT city, lat, lon, COUNT(*) FROM telegram_users.users WHERE active GROUP BY city, lat, lon"
+    result = await execute_query_async(query)
+    return result if result else []
+
+async def get_delivery_buckets() -> list:
+    """
+    Retrieve the delivery buckets that have subscribers.
+
+    Returns:
+    - result (list): The list of (timezone, "HH:MM", subscribers) rows
+    """
+    query = ("SELECT timezone, to_char(delivery_time, 'HH24:MI'), COUNT(*) FROM telegram_users.users "
+             "WHERE active GROUP BY timezone, delivery_time")
+    result = await execute_query_async(query)
+    return result if result else []
+
+async def count_bucket_subscribers(timezone: str, delivery_time: str) -> int:
+    """
+    Count the active subscribers of a delivery bucket.
+
+    Unlike the other helpers, errors are raised, so a failed query is never
+    taken for an empty bucket.
+
+    Parameters:
+    - timezone (str): The time zone name of the bucket
+    - delivery_time (str): The "HH:MM" delivery time of the bucket
+
+    Returns:
+    - subscribers (int): The number of active subscribers
+    """
+    def count(cursor):
+        cursor.execute("SELECT COUNT(*) FROM telegram_users.users WHERE active AND timezone = %s "
+                       "AND delivery_time = %s::time", (timezone, delivery_time))
+        return cursor.fetchone()[0]
+
+    return await execute_transaction_async(count)
+
+async def get_user_delivery(user_id: int):
+    """
+    Retrieve the delivery time zone and time of a user.
+
+    Parameters:
+    - user_id (int): The Telegram user id
+
+    Returns:
+    - delivery (tuple or None): The (timezone, "HH:MM") row, or None if the user is not stored yet
+    """
+    result = await execute_prepared_async("select_user_delivery", (int(user_id),))
+    return result[0] if result else None
+
+async def set_user_delivery(user_id: int, timezone: str = None, delivery_time: str = None):
+    """
+    Change the delivery time zone and/or time of a subscribed user.
+
+    Parameters:
+    - user_id (int): The Telegram user id
+    - timezone (str): The new time zone name, or None to keep the current one
+    - delivery_time (str): The new "HH:MM" delivery time, or None to keep the current one
+
+    Returns:
+    - delivery (tuple or None): The new (timezone, "HH:MM") row, or None if the user is not subscribed
+    """
+    if write_behind and write_behind.get(user_id):
+        # The subscription must reach the table before it can be updated
+        await write_behind.flush()
+    result = await execute_prepared_async("update_user_delivery", (int(user_id), timezone, delivery_time))
+    return result[0] if result else None
+
+async def intern_location(name: str, lat: float, lon: float):
+    """
+    Get the id of a location, storing the location first if it is new.
+
+    Parameters:
+    - name (str): The display name of the location
+    - lat (float): The latitude of the location
+    - lon (float): The longitude of the location
+
+    Returns:
+    - location_id (int or None): The id of the location, or None if it could not be stored
+    """
+    result = await execute_prepared_async("intern_location", (name, lat, lon))
+    return result[0][0] if result else None
+
+async def get_location(location_id: int):
+    """
+    Retrieve a stored location.
+
+    Parameters:
+    - location_id (int): The id of the location
+
+    Returns:
+    - location (tuple or None): The (location_id, name, lat, lon) row
+    """
+    result = await execute_prepared_async("select_location", (int(location_id),))
+    return result[0] if result else None
+
+async def load_locations(limit: int) -> list:
+    """
+    Retrieve the most recently created locations.
+
+    Parameters:
+    - limit (int): The maximum number of locations to return
+
+    Returns:
+    - result (list): The list of (location_id, name, lat, lon) rows
+    """
+    query = "SELECT location_id, name, lat, lon FROM telegram_users.locations ORDER BY location_id DESC LIMIT %s"
+    result = await execute_query_async(query, (limit,))
+    return result if result else []
+
+async def load_geocoding_cache(max_age: float, limit: int) -> list:
+    """
+    Retrieve the most recently stored geocoding results.
+
+    Parameters:
+    - max_age (float): The maximum age of the returned entries in seconds
+    - limit (int): The maximum number of entries to return
+
+    Returns:
+    - result (list): The list of (query, data, age in seconds) rows
+    """
+    query = ("SELECT query, data, EXTRACT(EPOCH FROM now() - updated_at) FROM telegram_users.geocoding_cache "
+             "WHERE updated_at > now() - make_interval(secs => %s) ORDER BY updated_at DESC LIMIT %s")
+    result = await execute_query_async(query, (max_age, limit))
+    return result if result else []
+
+async def get_geocoding_result(key: str, max_age: float):
+    """
+    Retrieve a stored geocoding result.
+
+    Parameters:
+    - key (str): The normalised city query
+    - max_age (float): The maximum age of the entry in seconds
+
+    Returns:
+    - result (tuple or None): The (data, age in seconds) pair, or None if missing or expired
+    """
+    query = ("SELECT data, EXTRACT(EPOCH FROM now() - updated_at) FROM telegram_users.geocoding_cache "
+             "WHERE query= %s AND updated_at > now() - make_interval(secs => %s)")
+    result = await execute_query_async(query, (key, max_age))
+    return result[0] if result else None
+
+async def save_geocoding_result(key: str, data: list) -> None:
+    """
+    Store a geocoding result, replacing any previous entry for the same query.
+
+    Parameters:
+    - key (str): The normalised city query
+    - data (list): The geocoding API response
+    """
+    query = ("INSERT INTO telegram_users.geocoding_cache (query, data, updated_at) VALUES (%s, %s, now()) "
+             "ON CONFLICT (query) DO UPDATE SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at")
+    await execute_query_async(query, (key, json.dumps(data)), WRITE)
+
+async def load_conversations(name: str, max_idle: float) -> list:
+    """
+    Retrieve the stored states of a conversation handler.
+
+    Parameters:
+    - name (str): The name of the conversation handler
+    - max_idle (float): Seconds since the last change after which a conversation has ended
+
+    Returns:
+    - result (list): The list of (key, state) rows of active conversations
+    """
+    query = ("SELECT key, state FROM telegram_users.conversations WHERE name= %s AND state IS NOT NULL "
+             "AND updated_at > now() - make_interval(secs => %s)")
+    result = await execute_query_async(query, (name, max_idle))
+    return result if result else []
+
+async def get_conversation_state(name: str, key: str, max_idle: float):
+    """
+    Retrieve the stored state of one conversation.
+
+    Parameters:
+    - name (str): The name of the conversation handler
+    - key (str): The conversation key
+    - max_idle (float): Seconds since the last change after which the conversation has ended
+
+    Returns:
+    - state (int or None): The state, or None if the conversation is not active
+    """
+    query = ("SELECT state FROM telegram_users.conversations WHERE name= %s AND key= %s "
+             "AND updated_at > now() - make_interval(secs => %s)")
+    result = await execute_query_async(query, (name, key, max_idle))
+    return result[0][0] if result else None
+
+async def save_conversations(rows: list) -> bool:
+    """
+    Store many conversation states at once.
+
+    Parameters:
+    - rows (list): The (name, key, state) rows, state None ends the conversation
+
+    Returns:
+    - success (bool): True if the rows were written
+    """
+    query = ("INSERT INTO telegram_users.conversations (name, key, state) VALUES %s "
+             "ON CONFLICT (name, key) DO UPDATE SET state = EXCLUDED.state, updated_at = now()")
+    return await execute_batch_async(query, rows)
+
+async def get_user_data(user_id: int):
+    """
+    Retrieve the stored data of one user.
+
+    Parameters:
+    - user_id (int): The Telegram user id
+
+    Returns:
+    - data (dict or None): The user data, or None if nothing is stored
+    """
+    query = "SELECT data FROM telegram_users.user_data WHERE user_id= %s"
+    result = await execute_query_async(query, (int(user_id),))
+    return result[0][0] if result else None
+
+async def save_user_data(rows: list) -> bool:
+    """
+    Store the data of many users at once.
+
+    Parameters:
+    - rows (list): The (user_id, data) rows
+
+    Returns:
+    - success (bool): True if the rows were written
+    """
+    query = ("INSERT INTO telegram_users.user_data (user_id, data) VALUES %s "
+             "ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = now()")
+    return await execute_batch_async(query, [(int(user_id), json.dumps(data)) for user_id, data in rows])
+
+async def delete_user_data(user_id: int) -> None:
+    """
+    Delete the stored data of one user.
+
+    Parameters:
+    - user_id (int): The Telegram user id
+    """
+    await execute_query_async("DELETE FROM telegram_users.user_data WHERE user_id= %s", (int(user_id),), WRITE)
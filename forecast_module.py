@@ -0,0 +1,266 @@
+import json
+import sys
+import time
+from array import array
+from cache_module import TTLCache
+from config import *
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+# Number of days the forecast is split into and 3-hour entries per full day
+FORECAST_DAYS = 5
+ENTRIES_PER_DAY = 8
+
+# Markdown block of one 3-hour entry
+ENTRY_TEMPLATE = (
+    "_• %s:00_\n"
+    "*🌡️  Temperature:* %.2f°C\n"
+    "*💓  Feels Like:* %.2f°C\n"
+    "*📰  Description:* %s\n"
+    "*🌬️  Wind Speed:* %s m/s\n"
+    "*💦  Humidity:* %s%%\n\n"
+)
+
+def is_stale(fetched_at: float) -> bool:
+    """
+    Check whether a forecast is older than the forecast cache TTL.
+
+    Parameters:
+    - fetched_at (float): The time the forecast was fetched, None if unknown
+
+    Returns:
+    - stale (bool): True if the forecast has expired
+    """
+    return fetched_at is not None and time.time() - fetched_at > FORECAST_CACHE_TTL
+
+def stale_marker(fetched_at: float) -> str:
+    """
+    Get the line marking a forecast that is older than the forecast cache TTL.
+
+    Parameters:
+    - fetched_at (float): The time the forecast was fetched, None if unknown
+
+    Returns:
+    - marker (str): The "as of HH:MM" line, or an empty string for fresh forecasts
+    """
+    if not is_stale(fetched_at):
+        return ""
+    return f"_⏳ Data as of {time.strftime('%H:%M', time.gmtime(fetched_at))} UTC_\n\n"
+
+# Weather descriptions are shared by all forecasts and stored as indices into this table, capitalised for display
+_descriptions = []
+_description_ids = {}
+
+def _description_id(description: str) -> int:
+    description_id = _description_ids.get(description)
+    if description_id is None:
+        description_id = _description_ids[description] = len(_descriptions)
+        _descriptions.append(description.capitalize())
+    return description_id
+
+
+class CompactForecast:
+    """
+    Forecast held in typed arrays with one slot per 3-hour entry.
+
+    Only the fields shown to users are kept: the timestamp, temperature and
+    feels-like temperature in Celsius, description, wind speed and humidity.
+
+    Parameters:
+    - dt (array): Entry timestamps in UTC seconds
+    - temp (array): Temperatures in Celsius
+    - feels_like (array): Feels-like temperatures in Celsius
+    - description (array): Indices into the shared description table
+    - wind_speed (array): Wind speeds in m/s
+    - humidity (array): Humidity in percent
+    - fetched_at (float): The time the forecast was fetched
+    """
+
+    __slots__ = ("dt", "temp", "feels_like", "description", "wind_speed", "humidity", "first_day_idx", "fetched_at")
+
+    def __init__(self, dt, temp, feels_like, description, wind_speed, humidity, fetched_at: float = None):
+        self.dt = dt
+        self.temp = temp
+        self.feels_like = feels_like
+        self.description = description
+        self.wind_speed = wind_speed
+        self.humidity = humidity
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+        self.first_day_idx = len(dt)
+        for i, timestamp in enumerate(dt):
+            if timestamp // 3600 % 24 == 21:
+                self.first_day_idx = i + 1
+                break
+
+    @classmethod
+    def from_payload(cls, geo_data: dict) -> "CompactForecast":
+        """
+        Build a compact forecast from the decoded OpenWeather forecast response, requested with units=metric.
+
+        Parameters:
+        - geo_data (dict): The weather information
+
+        Returns:
+        - forecast (CompactForecast): The compact forecast
+        """
+        entries = geo_data['list']
+        return cls(
+            array('q', [entry['dt'] for entry in entries]),
+            array('d', [entry['main']['temp'] for entry in entries]),
+            array('d', [entry['main']['feels_like'] for entry in entries]),
+            array('H', [_description_id(entry['weather'][0]['description']) for entry in entries]),
+            array('d', [entry['wind']['speed'] for entry in entries]),
+            array('B', [entry['main']['humidity'] for entry in entries]),
+        )
+
+    def __len__(self) -> int:
+        return len(self.dt)
+
+    def date_of(self, i: int) -> str:
+        """
+        Get the UTC date of an entry as YYYY-MM-DD.
+        """
+        return time.strftime("%Y-%m-%d", time.gmtime(self.dt[i]))
+
+    def day_range(self, n_of_day: int) -> range:
+        """
+        Get the entry indices of a day (0 for current day).
+
+        Parameters:
+        - n_of_day (int): The day number
+
+        Returns:
+        - indices (range): The indices of the day's entries
+        """
+        if n_of_day == 0:
+            return range(0, self.first_day_idx)
+        start = self.first_day_idx + (n_of_day - 1) * ENTRIES_PER_DAY
+        return range(min(start, len(self)), min(start + ENTRIES_PER_DAY, len(self)))
+
+    def day_labels(self, days: int = FORECAST_DAYS) -> list:
+        """
+        Get the date shown on the button of each day.
+
+        Parameters:
+        - days (int): The number of days
+
+        Returns:
+        - labels (list): The YYYY-MM-DD date of each day
+        """
+        return [self.date_of(min(n * ENTRIES_PER_DAY, len(self) - 1)) for n in range(days)]
+
+    def nbytes(self) -> int:
+        """
+        Estimate the memory held by this forecast in bytes.
+        """
+        return sys.getsizeof(self) + sum(sys.getsizeof(getattr(self, name))
+                                         for name in ("dt", "temp", "feels_like", "description", "wind_speed", "humidity"))
+
+
+def decode_forecast(content: bytes) -> CompactForecast:
+    """
+    Decode an OpenWeather forecast response body straight into a compact forecast.
+
+    Everything but the rendered fields is dropped here, so the decoded
+    payload never outlives the call.
+
+    Parameters:
+    - content (bytes): The JSON response body
+
+    Returns:
+    - forecast (CompactForecast): The compact forecast
+    """
+    return CompactForecast.from_payload(loads(content))
+
+
+def render_day(forecast: CompactForecast, city: str, n_of_day: int) -> str:
+    """
+    Format the weather information of one day of a compact forecast as a message.
+
+    Parameters:
+    - forecast (CompactForecast): The weather information
+    - city (str): The name of the city shown in the header
+    - n_of_day (int): The day for which to retrieve information (0 for current day)
+
+    Returns:
+    - message (str): The formatted weather information
+    """
+    parts = [f"*Weather Forecast for {city} \n {forecast.date_of(0)}* 🌐\n\n" + stale_marker(forecast.fetched_at)]
+    dt, temp, feels_like, description = forecast.dt, forecast.temp, forecast.feels_like, forecast.description
+    wind_speed, humidity = forecast.wind_speed, forecast.humidity
+    for i in forecast.day_range(n_of_day):
+        # UTC hour of the entry, timestamps are whole seconds since the epoch
+        parts.append(ENTRY_TEMPLATE % (
+            "%02d" % (dt[i] // 3600 % 24),
+            temp[i],
+            feels_like[i],
+            _descriptions[description[i]],
+            # JSON integers are stored as floats, print them without ".0" as they came
+            int(wind_speed[i]) if wind_speed[i].is_integer() else wind_speed[i],
+            humidity[i],
+        ))
+    return "".join(parts)
+
+
+class ForecastStore:
+    """
+    Compact forecasts shared between users, keyed by location and forecast timestamp.
+
+    Users keep only the key returned by put and render days on demand.
+
+    Parameters:
+    - maxsize (int): The maximum number of forecasts kept in memory
+    - ttl (float): The number of seconds a forecast is kept
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize, ttl)
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def put(self, location, forecast: CompactForecast) -> tuple:
+        """
+        Store a forecast unless the same forecast of the location is already stored.
+
+        Parameters:
+        - location: The location key, e.g. rounded coordinates
+        - forecast (CompactForecast): The forecast to store
+
+        Returns:
+        - key (tuple): The key of the stored forecast
+        """
+        key = (location, forecast.dt[0] if len(forecast) else 0)
+        if self._cache.get(key) is None:
+            self._cache.set(key, forecast)
+        return key
+
+    def get(self, key: tuple):
+        """
+        Get a stored forecast.
+
+        Parameters:
+        - key (tuple): The key returned by put
+
+        Returns:
+        - forecast (CompactForecast or None): The forecast, or None if it expired or was evicted
+        """
+        return self._cache.get(key)
+
+    def memory_usage(self) -> int:
+        """
+        Estimate the memory held by the stored forecasts in bytes.
+        """
+        return sum(forecast.nbytes() for forecast in self._cache.values())
+
+    def stats(self) -> dict:
+        """
+        Get the store counters including its estimated memory usage.
+        """
+        stats = self._cache.stats()
+        stats["memory_bytes"] = self.memory_usage()
+        return stats
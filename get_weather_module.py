@@ -1,95 +1,439 @@
-import requests
-from config import *
-
-def _check_response(endpoint: str) -> dict:
-    """
-    Check the response from the API endpoint and handle errors.
-
-    Parameters:
-    - endpoint (str): The API endpoint to check
-
-    Returns:
-    - geo_data (dict): The data from the API response
-    """
-    geo_data = {"err": False, "err_msg": -1}
-    try:
-        response = requests.get(endpoint)
-        response.raise_for_status()
-    except requests.exceptions.ConnectionError:
-        geo_data["err"] = True
-        geo_data["err_msg"] = "Your internet connection is bad, try again later."
-    except requests.exceptions.HTTPError:
-        geo_data["err"] = True
-        geo_data["err_msg"] = "There is something wrong with the server, please try again later."
-    geo_data = response.json()
-    return geo_data
-
-def process_information(city: str) -> dict:
-    """
-    Process location information for a given city.
-
-    Parameters:
-    - city (str): The name of the city
-
-    Returns:
-    - geo_data (dict): The location information
-    """
-    geo_endpoint = f"http://api.openweathermap.org/geo/1.0/direct?q={city}&limit=5&appid={API_KEY}"
-    geo_data = _check_response(geo_endpoint)
-    return geo_data
-
-def weather_by_coord(lat: str, lon: str) -> str:
-    """
-    Get weather information based on coordinates.
-
-    Parameters:
-    - lat (str): The latitude of the location
-    - lon (str): The longitude of the location
-
-    Returns:
-    - geo_data (str): The weather information
-    """
-    geo_endpoint = f"https://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&appid={API_KEY}"
-    geo_data = _check_response(geo_endpoint)
-    return geo_data
-
-def parse_weather(geo_data: dict, city:str, n_of_day: int) -> str:
-    """
-    Parse weather information and format it as a message.
-
-    Parameters:
-    - geo_data (dict): The weather information
-    - n_of_day (int): The day for which to retrieve information (0 for current day)
-
-    Returns:
-    - message (str): The formatted weather information
-    """
-    geo_data = geo_data['list']
-    first_day_idx = 0
-    while geo_data[first_day_idx]['dt_txt'][11:13] != '21':
-        first_day_idx += 1
-    first_day_idx += 1
-    
-    start_idx = first_day_idx + (n_of_day - 1) * 8 if n_of_day != 0 else 0
-    end_idx = start_idx + 8 if n_of_day != 0 else first_day_idx
-    weather_dict = geo_data[start_idx:end_idx]
-    date_only = geo_data[0]['dt_txt'].split()[0]
-    message = f"*Weather Forecast for {city} \n {date_only}* 🌐\n\n"
-    for weather_data in weather_dict:
-        time_only = weather_data['dt_txt'].split()[1]
-        hour_only = time_only.split(":")[0] + ":00"
-        temp = "{:.2f}".format(weather_data['main']['temp'] - 273.15)
-        feels_like = "{:.2f}".format(weather_data['main']['feels_like'] - 273.15)
-        description = weather_data['weather'][0]['description']
-        wind_speed = weather_data['wind']['speed']
-        humidity = weather_data['main']['humidity']
-        # Format the message using Markdown
-        message += (
-            f"_• {hour_only}_\n"
-            f"*🌡️  Temperature:* {temp}°C\n"
-            f"*💓  Feels Like:* {feels_like}°C\n"
-            f"*📰  Description:* {description.capitalize()}\n"
-            f"*🌬️  Wind Speed:* {wind_speed} m/s\n"
-            f"*💦  Humidity:* {humidity}%\n\n"
-        )
-    return message
+import asyncio
+import logging
+import os
+import random
+import time
+import httpx
+import db_module
+from cache_module import TTLCache
+from city_index_module import CityIndex, normalize_city
+from rate_limit_module import CallAccounting, CircuitBreaker, PriorityTokenBucket
+from forecast_module import decode_forecast, loads
+from metrics_module import Counter, Histogram
+from config import *
+
+logger = logging.getLogger(__name__)
+
+# Shared keep-alive client for the async API helpers, created on first use
+_http_client = None
+
+# Forecasts keyed by rounded coordinates, shared by every user in the same area
+forecast_cache = TTLCache(FORECAST_CACHE_SIZE, FORECAST_CACHE_TTL, max_stale=FORECAST_MAX_STALE)
+
+# Geocoding results keyed by normalised city name, backed by telegram_users.geocoding_cache
+geocoding_cache = TTLCache(GEOCODING_CACHE_SIZE, GEOCODING_CACHE_TTL)
+
+# Optional offline city index answering lookups before the geocoding API, loaded by load_city_index
+city_index = None
+
+owm_request_seconds = Histogram("owm_request_duration_seconds", "Duration of OpenWeather requests.", ("endpoint",))
+owm_responses = Counter("owm_responses_total", "OpenWeather responses by status code or transport error.",
+                        ("endpoint", "status"))
+
+
+class SingleFlight:
+    """
+    Lets concurrent callers asking for the same key share one in-flight fetch.
+
+    The first caller starts the fetch, later callers with the same key wait for
+    it and receive the same result or exception. The fetch runs as its own task,
+    so a cancelled caller does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.calls = 0
+        self.deduplicated = 0
+
+    def _done(self, key, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved in case every caller was cancelled
+            task.exception()
+
+    async def do(self, key, fetch):
+        """
+        Run fetch for the key unless a fetch for it is already in flight.
+
+        Parameters:
+        - key: The normalised request key
+        - fetch: A coroutine function taking no arguments
+
+        Returns:
+        - result: The result of the shared fetch
+        """
+        self.calls += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        else:
+            self.deduplicated += 1
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        """
+        Get the deduplication counters.
+
+        Returns:
+        - stats (dict): Calls, deduplicated calls and fetches currently in flight
+        """
+        return {"calls": self.calls, "deduplicated": self.deduplicated, "inflight": len(self._inflight)}
+
+
+# Concurrent lookups of the same city or forecast share one upstream request
+geocoding_flight = SingleFlight()
+forecast_flight = SingleFlight()
+
+CONNECTION_ERROR_MSG = "Your internet connection is bad, try again later."
+SERVER_ERROR_MSG = "There is something wrong with the server, please try again later."
+QUOTA_ERROR_MSG = "The weather service is busy right now, please try again later."
+
+# Request priorities, user requests are served before broadcast and prefetch traffic
+INTERACTIVE, BACKGROUND = 0, 1
+
+# Per-endpoint call rates and daily accounting of the OpenWeather plan
+rate_limits = {
+    "geocoding": PriorityTokenBucket(OWM_GEOCODING_PER_MINUTE / 60, capacity=OWM_BURST),
+    "forecast": PriorityTokenBucket(OWM_FORECAST_PER_MINUTE / 60, capacity=OWM_BURST),
+}
+call_accounting = CallAccounting(OWM_CALLS_PER_DAY)
+
+# Requests to an endpoint that keeps failing are refused until a probe succeeds
+circuit_breakers = {
+    "geocoding": CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT),
+    "forecast": CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT),
+}
+
+# Background refreshes of stale forecasts, referenced until they finish
+_refresh_tasks = set()
+
+def forecast_endpoint(lat, lon) -> str:
+    """
+    Build the URL of the 5 day / 3 hour forecast, asking for metric units and the 40 entries that are rendered.
+
+    Parameters:
+    - lat (str or float): The latitude of the location
+    - lon (str or float): The longitude of the location
+
+    Returns:
+    - endpoint (str): The forecast URL
+    """
+    return f"{OWM_BASE_URL}/data/2.5/forecast?lat={lat}&lon={lon}&units=metric&cnt=40&appid={API_KEY}"
+
+def is_error(result) -> bool:
+    """
+    Tell whether an API helper returned an error dict instead of data.
+
+    Parameters:
+    - result: The value returned by an API helper
+
+    Returns:
+    - error (bool): True for an error dict with "err" and "err_msg"
+    """
+    return isinstance(result, dict) and "err" in result
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Get the shared HTTP client, creating it on first use.
+
+    The client keeps HTTP/1.1 connections alive between calls, so concurrent
+    lookups reuse a bounded pool of sockets instead of reconnecting every time.
+
+    Returns:
+    - client (httpx.AsyncClient): The shared HTTP client
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http1=True,
+            http2=False,
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_SIZE,
+                max_keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        )
+    return _http_client
+
+async def close_http_client() -> None:
+    """
+    Close the shared HTTP client and release its connections.
+    """
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+def _retry_delay(response, attempt: int) -> float:
+    """
+    Get the delay before retrying a failed request.
+
+    The Retry-After header is honoured when present, otherwise the delay
+    grows exponentially with full jitter.
+
+    Parameters:
+    - response (httpx.Response or None): The failed response, None for transport errors
+    - attempt (int): The number of the failed attempt, starting at 0
+
+    Returns:
+    - delay (float): The number of seconds to wait
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), OWM_BACKOFF_MAX)
+    return random.uniform(0, min(OWM_BACKOFF_MAX, OWM_BACKOFF_BASE * 2 ** attempt))
+
+async def _check_response_async(endpoint: str, kind: str, priority: int = INTERACTIVE, decode=loads):
+    """
+    Asynchronously request the API endpoint and handle errors.
+
+    Every attempt waits for a token of the endpoint's rate limit and counts
+    against the daily quota; background requests leave OWM_INTERACTIVE_RESERVE
+    of the quota to users. Rate limited (429) and server (5xx) responses and
+    transport errors are retried with backoff. While the endpoint's circuit
+    breaker is open no request is made.
+
+    Parameters:
+    - endpoint (str): The API endpoint to check
+    - kind (str): The rate limit of the endpoint, "geocoding" or "forecast"
+    - priority (int): INTERACTIVE or BACKGROUND
+    - decode: Function turning the response body into the returned data
+
+    Returns:
+    - geo_data: The decoded API response, or an error dict with "err" and "err_msg"
+    """
+    reserve = OWM_INTERACTIVE_RESERVE if priority == BACKGROUND else 0.0
+    if not call_accounting.allow(reserve):
+        return {"err": True, "err_msg": QUOTA_ERROR_MSG}
+    breaker = circuit_breakers[kind]
+    if not breaker.allow():
+        return {"err": True, "err_msg": SERVER_ERROR_MSG}
+    probing = breaker.state == CircuitBreaker.HALF_OPEN
+    try:
+        return await _request_with_retries(endpoint, kind, priority, decode, reserve, breaker)
+    finally:
+        if probing:
+            # Leaving without an upstream result, e.g. out of quota or cancelled, must not keep the probe
+            breaker.release()
+
+async def _request_with_retries(endpoint: str, kind: str, priority: int, decode, reserve: float, breaker: CircuitBreaker):
+    """
+    Request the API endpoint, retrying failures and reporting the outcome to the circuit breaker.
+
+    Parameters:
+    - endpoint (str): The API endpoint to check
+    - kind (str): The rate limit of the endpoint, "geocoding" or "forecast"
+    - priority (int): INTERACTIVE or BACKGROUND
+    - decode: Function turning the response body into the returned data
+    - reserve (float): Fraction of the daily quota the request must leave unused
+    - breaker (CircuitBreaker): The circuit breaker of the endpoint
+
+    Returns:
+    - geo_data: The decoded API response, or an error dict with "err" and "err_msg"
+    """
+    bucket = rate_limits[kind]
+    error_msg = SERVER_ERROR_MSG
+    for attempt in range(OWM_MAX_RETRIES + 1):
+        if attempt and not call_accounting.allow(reserve):
+            return {"err": True, "err_msg": QUOTA_ERROR_MSG}
+        await bucket.acquire(priority=priority)
+        call_accounting.record(kind)
+        started = time.perf_counter()
+        try:
+            response = await get_http_client().get(endpoint)
+        except httpx.TransportError as e:
+            owm_request_seconds.observe(time.perf_counter() - started, kind)
+            owm_responses.inc(kind, type(e).__name__)
+            call_accounting.record_status(type(e).__name__)
+            response, error_msg = None, CONNECTION_ERROR_MSG
+        else:
+            owm_request_seconds.observe(time.perf_counter() - started, kind)
+            owm_responses.inc(kind, response.status_code)
+            call_accounting.record_status(response.status_code)
+            if response.status_code == 429:
+                # Hold back every request to this endpoint, not only this one
+                bucket.drain(_retry_delay(response, attempt))
+            elif response.status_code < 500:
+                # The upstream answered, even a client error proves it is reachable
+                breaker.record_success()
+                if response.is_error:
+                    return {"err": True, "err_msg": SERVER_ERROR_MSG}
+                try:
+                    return decode(response.content)
+                except (ValueError, KeyError, TypeError, IndexError) as e:
+                    logger.warning("Undecodable %s response: %s", kind, e)
+                    return {"err": True, "err_msg": SERVER_ERROR_MSG}
+            error_msg = SERVER_ERROR_MSG
+        if attempt < OWM_MAX_RETRIES:
+            await asyncio.sleep(_retry_delay(response, attempt))
+    breaker.record_failure()
+    if breaker.state == CircuitBreaker.OPEN:
+        logger.warning("OpenWeather %s endpoint is failing, circuit breaker open: %s", kind, breaker.stats())
+    return {"err": True, "err_msg": error_msg}
+
+def load_city_index(path: str = CITY_INDEX_PATH) -> int:
+    """
+    Load the offline city index if one is configured.
+
+    Parameters:
+    - path (str): The path of the index file, empty to disable the index
+
+    Returns:
+    - count (int): The number of indexed cities, 0 if there is no index
+    """
+    global city_index
+    if not path:
+        return 0
+    if not os.path.exists(path):
+        logger.warning("City index %s does not exist, city lookups use the geocoding API", path)
+        return 0
+    city_index = CityIndex(path)
+    return len(city_index)
+
+async def warm_geocoding_cache() -> int:
+    """
+    Load the most recent stored geocoding results into memory.
+
+    Returns:
+    - count (int): The number of loaded entries
+    """
+    rows = await db_module.load_geocoding_cache(GEOCODING_CACHE_TTL, GEOCODING_CACHE_SIZE)
+    # Rows are newest first, insert oldest first so the newest end up most recently used
+    for key, data, age in reversed(rows):
+        geocoding_cache.set(key, data, ttl=GEOCODING_CACHE_TTL - float(age))
+    return len(rows)
+
+async def process_information_async(city: str) -> dict:
+    """
+    Asynchronously process location information for a given city.
+
+    Results are looked up in the offline city index and the in-memory
+    geocoding cache first, then in the database, and only then requested from
+    the API. Concurrent lookups of the same city share one request.
+
+    Parameters:
+    - city (str): The name of the city
+
+    Returns:
+    - geo_data (dict): The location information
+    """
+    key = normalize_city(city)
+    if city_index is not None:
+        geo_data = city_index.exact(key)
+        if geo_data:
+            return geo_data
+    geo_data = geocoding_cache.get(key)
+    if geo_data is not None:
+        return geo_data
+    return await geocoding_flight.do(key, lambda: _fetch_geocoding(city, key))
+
+async def _fetch_geocoding(city: str, key: str) -> dict:
+    """
+    Look up a city in the database cache and then in the geocoding API.
+
+    Parameters:
+    - city (str): The name of the city
+    - key (str): The normalised city name
+
+    Returns:
+    - geo_data (dict): The location information
+    """
+    stored = await db_module.get_geocoding_result(key, GEOCODING_CACHE_TTL)
+    if stored:
+        geo_data, age = stored
+        geocoding_cache.set(key, geo_data, ttl=GEOCODING_CACHE_TTL - float(age))
+        return geo_data
+
+    geo_endpoint = f"{OWM_BASE_URL}/geo/1.0/direct?q={city}&limit=5&appid={API_KEY}"
+    geo_data = await _check_response_async(geo_endpoint, "geocoding")
+    if "err" not in geo_data:
+        geocoding_cache.set(key, geo_data)
+        if geo_data:
+            await db_module.save_geocoding_result(key, geo_data)
+    return geo_data
+
+def coord_key(lat, lon, precision: int = COORD_PRECISION) -> tuple:
+    """
+    Build a cache key from coordinates rounded to the given precision.
+
+    Parameters:
+    - lat (str or float): The latitude of the location
+    - lon (str or float): The longitude of the location
+    - precision (int): The number of decimal places to keep
+
+    Returns:
+    - key (tuple): The rounded (lat, lon) pair
+    """
+    return round(float(lat), precision), round(float(lon), precision)
+
+async def weather_by_coord_async(lat: str, lon: str, priority: int = INTERACTIVE, allow_stale: bool = True) -> dict:
+    """
+    Asynchronously get weather information based on coordinates.
+
+    Forecasts are served from the forecast cache when a fresh entry exists for
+    the rounded coordinates; error responses are never cached. Concurrent
+    requests for the same coordinates share one upstream call. A forecast
+    that expired less than FORECAST_MAX_STALE seconds ago is returned right
+    away while a fresh one is fetched in the background, which also covers
+    upstream outages; its "fetched_at" time marks it as stale when rendered.
+    With allow_stale=False the fresh forecast is awaited instead and the
+    expired one is only returned when that fetch fails.
+
+    Parameters:
+    - lat (str): The latitude of the location
+    - lon (str): The longitude of the location
+    - priority (int): INTERACTIVE for user requests, BACKGROUND for broadcasts and prefetching
+    - allow_stale (bool): Whether an expired forecast may be returned before fetching a fresh one
+
+    Returns:
+    - forecast (CompactForecast or dict): The weather information, or an error dict
+    """
+    key = coord_key(lat, lon)
+    forecast = forecast_cache.get(key)
+    if forecast is not None:
+        return forecast
+    stale = forecast_cache.get_stale(key)
+    if stale is not None and allow_stale:
+        _refresh_forecast(lat, lon, key, priority)
+        return stale
+    forecast = await forecast_flight.do(key, lambda: _fetch_forecast(lat, lon, key, priority))
+    if is_error(forecast) and stale is not None:
+        return stale
+    return forecast
+
+def _refresh_forecast(lat: str, lon: str, key: tuple, priority: int) -> None:
+    """
+    Fetch a forecast in the background, sharing a refresh already in flight.
+
+    Parameters:
+    - lat (str): The latitude of the location
+    - lon (str): The longitude of the location
+    - key (tuple): The forecast cache key
+    - priority (int): INTERACTIVE or BACKGROUND
+    """
+    task = asyncio.ensure_future(forecast_flight.do(key, lambda: _fetch_forecast(lat, lon, key, priority)))
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+async def _fetch_forecast(lat: str, lon: str, key: tuple, priority: int = INTERACTIVE) -> dict:
+    """
+    Request a forecast from the API and cache it.
+
+    Parameters:
+    - lat (str): The latitude of the location
+    - lon (str): The longitude of the location
+    - key (tuple): The forecast cache key
+    - priority (int): INTERACTIVE or BACKGROUND
+
+    Returns:
+    - forecast (CompactForecast or dict): The weather information, or an error dict
+    """
+    forecast = await _check_response_async(forecast_endpoint(lat, lon), "forecast", priority, decode_forecast)
+    if not is_error(forecast):
+        forecast_cache.set(key, forecast)
+    return forecast
@@ -0,0 +1,109 @@
+import db_module
+from cache_module import TTLCache
+from config import *
+
+
+class Location:
+    """
+    A geocoded place with its registry id.
+
+    Parameters:
+    - location_id (int): The id of the location
+    - name (str): The display name, e.g. "Paris, Ile-de-France, FR"
+    - lat (float): The latitude
+    - lon (float): The longitude
+    """
+
+    __slots__ = ("id", "name", "lat", "lon")
+
+    def __init__(self, location_id: int, name: str, lat: float, lon: float):
+        self.id = location_id
+        self.name = name
+        self.lat = lat
+        self.lon = lon
+
+    def __repr__(self) -> str:
+        return f"Location({self.id}, {self.name!r}, {self.lat}, {self.lon})"
+
+
+class LocationRegistry:
+    """
+    Gives every geocoded place a small integer id shared by all bot workers.
+
+    Locations are stored in telegram_users.locations and kept in memory both
+    by id and by (name, lat, lon), so the same place is stored once and
+    callback data only has to carry its id. Only the maxsize most recently
+    used locations stay in memory, others are read from the database again.
+
+    Parameters:
+    - maxsize (int): The maximum number of locations kept in memory
+    """
+
+    def __init__(self, maxsize: int = LOCATION_REGISTRY_SIZE):
+        # Locations never change, so entries only leave the caches when evicted
+        self._by_id = TTLCache(maxsize, float("inf"))
+        self._by_key = TTLCache(maxsize, float("inf"))
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def _add(self, location_id: int, name: str, lat: float, lon: float) -> Location:
+        location = Location(location_id, name, float(lat), float(lon))
+        self._by_id.set(location.id, location)
+        self._by_key.set((location.name, location.lat, location.lon), location)
+        return location
+
+    async def load(self, limit: int = LOCATION_REGISTRY_PRELOAD) -> int:
+        """
+        Load the most recently created locations into memory.
+
+        Parameters:
+        - limit (int): The maximum number of locations to load
+
+        Returns:
+        - count (int): The number of loaded locations
+        """
+        rows = await db_module.load_locations(min(limit, self._by_id.maxsize))
+        for row in rows:
+            self._add(*row)
+        return len(rows)
+
+    async def intern(self, name: str, lat: float, lon: float):
+        """
+        Get the location of a place, registering it first if it is new.
+
+        Parameters:
+        - name (str): The display name of the place
+        - lat (float): The latitude of the place
+        - lon (float): The longitude of the place
+
+        Returns:
+        - location (Location or None): The location, or None if it could not be stored
+        """
+        location = self._by_key.get((name, float(lat), float(lon)))
+        if location is not None:
+            return location
+        location_id = await db_module.intern_location(name, float(lat), float(lon))
+        if location_id is None:
+            return None
+        return self._add(location_id, name, lat, lon)
+
+    async def get(self, location_id: int):
+        """
+        Get a location by id, loading it if another worker registered it.
+
+        Parameters:
+        - location_id (int): The id of the location
+
+        Returns:
+        - location (Location or None): The location, or None if the id is unknown
+        """
+        location = self._by_id.get(location_id)
+        if location is not None:
+            return location
+        row = await db_module.get_location(location_id)
+        return self._add(*row) if row else None
+
+
+# Registry shared by the handlers and the subscriber table
+location_registry = LocationRegistry()
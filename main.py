@@ -1,567 +1,1173 @@
-"""
-WeatherBot Telegram Bot
-
-This script implements a Telegram bot to provide weather information to users based on their chosen city.
-
-Author: iliaVrtn
-Date: 12.10.2023
-"""
-
-import logging
-from datetime import time
-import pytz
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, Update, Bot
-from telegram.constants import ParseMode
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    ContextTypes,
-    ConversationHandler,
-    MessageHandler,
-    CallbackQueryHandler,
-    filters,
-)
-import db_module
-from get_weather_module import process_information, weather_by_coord, parse_weather
-from config import *
-
-# Enable logging
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
-# Set higher logging level for httpx to avoid all GET and POST requests being logged
-logging.getLogger("httpx").setLevel(logging.WARNING)
-
-logger = logging.getLogger(__name__)
-
-# Define conversation states
-CHOOSING, TYPING_REPLY, UPDATE_TYPING_REPLY, DAILY_WEATHER = range(4)
-
-# List to store daily weather information
-daily_weather_info = {}
-
-# Keyboard layout for the main menu
-main_menu_keyboard = [
-    ["Update my city", "Cancel updates", "My city weather"],
-    ["Choose city"],
-    ["Done"],
-]
-
-main_menu_markup = ReplyKeyboardMarkup(main_menu_keyboard, one_time_keyboard=True, resize_keyboard=True)
-
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """
-    Start command handler. Displays initial message with options.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    int: The next conversation state
-    """
-    # Greet the user and provide information about their current city if available
-    reply_text = "Hi! I'm here to provide you weather information about your city! "
-    user_id = update.message.from_user.id
-    user_data = (int(user_id),)
-    result = db_module.execute_query(f"SELECT city FROM telegram_users.users WHERE user_id= %s", user_data)
-    if result:
-        reply_text += f"Your current city is {result[0][0]} 😃"
-    else:
-        reply_text += f"You can choose *Update my city* to get daily weather information at 7:00 ⌚"
-    
-    # Send the initial message with options
-    await update.message.reply_text(reply_text, reply_markup=main_menu_markup, parse_mode=ParseMode.MARKDOWN)
-    return CHOOSING
-
-
-async def update_my_city_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """
-    Prompt user to enter the city for daily weather updates.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    int: The next conversation state
-    """
-    reply_text = "Enter the city for which you want to receive daily weather updates 💌"
-    await update.message.reply_text(reply_text, reply_markup=ReplyKeyboardRemove())
-    return UPDATE_TYPING_REPLY
-
-
-async def update_city_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """
-    Handler for updating the user's city based on the provided input.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    int: The next conversation state
-    """
-    await search_city(update, context)
-    return UPDATE_TYPING_REPLY
-
-
-async def other_city_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """
-    Handler for searching and displaying the available cities based on user input.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    int: The next conversation state
-    """
-    await search_city(update, context)
-    return TYPING_REPLY
-
-
-async def search_city(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """
-    Searches for the entered city and displays available options for selection.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    int: The next conversation state
-    """
-    city = update.message.text.capitalize()
-    geo_data = process_information(city)
-    if "err" in geo_data:
-        await update.message.reply_text(text=geo_data["err_msg"], reply_markup=ReplyKeyboardRemove())
-        return ConversationHandler.END
-    if len(geo_data) == 0:
-        reply_text = f"I didn't find such a city 😔 Check if you typed it correctly and try again."
-        await update.message.reply_text(reply_text, reply_markup=ReplyKeyboardRemove())
-    else:
-        keyboard = list_of_cities(geo_data, city)
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("Which city is yours?\n", reply_markup=reply_markup)
-    return TYPING_REPLY
-
-
-async def other_city_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """
-    Prompt user to enter the city for weather information.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    int: The next conversation state
-    """
-    reply_text = "Enter city that you want to get weather information about 🌇"
-    await update.message.reply_text(reply_text, reply_markup=ReplyKeyboardRemove())
-    return TYPING_REPLY
-
-
-async def my_city_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """
-    Handler for displaying weather information for the user's saved city.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    int: The next conversation state
-    """
-    user_id = update.message.from_user.id
-    user_data = (int(user_id),)
-    data = db_module.execute_query(f'SELECT lat,lon,city FROM telegram_users.users WHERE user_id= %s', user_data)
-    if data:
-        lat, lon = data[0][0], data[0][1]
-        city = data[0][2]
-        geo_data = weather_by_coord(lat, lon)
-        if 'err' in geo_data:
-            await update.message.reply_text(text=geo_data['err_msg'], reply_markup=ReplyKeyboardRemove())
-            return ConversationHandler.END
-        daily_weather_info[user_id] = ["", "", "", "", ""]
-        for i in range(5):
-            daily_weather_info[user_id][i] = parse_weather(geo_data, city, i)
-        inline_keyboard = [
-            [InlineKeyboardButton("Today, " + geo_data['list'][0]['dt_txt'][:10], callback_data="0"),
-             InlineKeyboardButton("Tomorrow, " + geo_data['list'][1 * 8]['dt_txt'][:10], callback_data="1")
-             ],
-            [InlineKeyboardButton(geo_data['list'][2 * 8]['dt_txt'][:10], callback_data="2"),
-             InlineKeyboardButton(geo_data['list'][3 * 8]['dt_txt'][:10], callback_data="3")
-             ],
-            [InlineKeyboardButton(geo_data['list'][4 * 8]['dt_txt'][:10], callback_data="4")]
-        ]
-        reply_markup = InlineKeyboardMarkup(inline_keyboard)
-        await update.message.reply_text(
-            text="Choose a day you want to get weather information 📆",
-            reply_markup=reply_markup,
-            parse_mode=ParseMode.MARKDOWN
-        )
-        return DAILY_WEATHER
-    await update.message.reply_text(
-        text="You have not chosen the city yet, choose *Update my city* to do it 😸",
-        reply_markup=main_menu_markup,
-        parse_mode=ParseMode.MARKDOWN
-    )
-    return CHOOSING
-
-
-def list_of_cities(geo_data: list, city: str) -> list:
-    """
-    Generates a list of cities for display in inline keyboard.
-
-    Parameters:
-    - geo_data (list): List of geographic data for cities
-    - city (str): The user's selected city
-
-    Returns:
-    list: List of keyboard options
-    """
-    country_arr = [list([item['state'], item['country']]) if 'state' in item else list(["", item['country']])
-                   for item in geo_data]
-    keyboard = []
-    cities=[]
-    for i in range(len(country_arr)):
-        city_name = ", ".join([city, country_arr[i][0], country_arr[i][1]])
-        if city_name not in cities:
-            cities.append(city_name)
-            if city_name.find(", , ") > 0:  # some cities does not have states 
-                city_name = city_name.replace(", ", "", 1)
-            callback_data = city_name + ':' + ','.join([str(geo_data[i]['lon']), str(geo_data[i]['lat'])])
-            keyboard.append([InlineKeyboardButton(city_name, callback_data=callback_data)])
-    return keyboard
-
-
-async def choose_city_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """
-    Handler for selecting a city from the displayed options.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-    """
-    query = update.callback_query
-    user_id = query.from_user.id
-    await query.answer()
-
-    index = query.data.find(':')
-    city = query.data[:index]
-    lon_index = query.data.find(',', index)
-    lon = query.data[index + 1:lon_index]
-    lat = query.data[lon_index + 1:]
-    geo_data = weather_by_coord(lat, lon)
-    if 'err' in geo_data:
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text=geo_data['err_msg'],
-            reply_markup=ReplyKeyboardRemove()
-        )
-        return ConversationHandler.END
-    daily_weather_info[user_id] = ["", "", "", "", ""]
-    for i in range(5):
-        daily_weather_info[user_id][i] = parse_weather(geo_data, city, i)
-    inline_keyboard = [
-        [InlineKeyboardButton("Today, " + geo_data['list'][0]['dt_txt'][:10], callback_data="0"),
-         InlineKeyboardButton("Tomorrow, " + geo_data['list'][1 * 8]['dt_txt'][:10], callback_data="1")
-         ],
-        [InlineKeyboardButton(geo_data['list'][2 * 8]['dt_txt'][:10], callback_data="2"),
-         InlineKeyboardButton(geo_data['list'][3 * 8]['dt_txt'][:10], callback_data="3")
-         ],
-        [InlineKeyboardButton(geo_data['list'][4 * 8]['dt_txt'][:10], callback_data="4")]
-    ]
-    reply_markup = InlineKeyboardMarkup(inline_keyboard)
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text="Choose a day you want to get weather information 📆",
-        reply_markup=reply_markup,
-        parse_mode=ParseMode.MARKDOWN
-    )
-    return DAILY_WEATHER
-
-async def save_my_city_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """
-    Callback handler for saving the user's city button.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    None
-    """
-    query = update.callback_query
-    await query.answer()
-
-    # Extracting information from the callback data
-    index = query.data.find(':')
-    lon_index = query.data.find(',', index)
-    user_id = query.from_user.id
-    new_lat = query.data[lon_index + 1:]
-    new_lon = query.data[index + 1:lon_index]
-    my_city = query.data[:index]
-
-    user_data = (int(user_id),)
-    result = db_module.execute_query(f"SELECT user_id FROM telegram_users.users WHERE user_id= %s", user_data)
-
-    # Update or insert user's city information in the database
-    if result:
-        user_data = (new_lat, new_lon, my_city, int(user_id))
-        db_module.execute_query(f"UPDATE telegram_users.users SET lat= %s, lon= %s, city= %s WHERE user_id= %s", user_data)
-    else:
-        user_data = (int(user_id), new_lat, new_lon, my_city)
-        db_module.execute_query(f"INSERT INTO telegram_users.users VALUES (%s, %s, %s, %s)", user_data)
-
-    # Confirmation messages
-    reply_text = f"Your city has been changed to {my_city}!😃"
-    await context.bot.send_message(chat_id=query.message.chat_id, text=reply_text, reply_markup=ReplyKeyboardRemove())
-    await context.bot.send_message(chat_id=query.message.chat_id, text="Is there anything else I can help with? 😇", reply_markup=main_menu_markup)
-    return CHOOSING
-
-
-async def daily_weather(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """
-    Callback handler for daily weather updates.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    None
-    """
-    query = update.callback_query
-    user_id = query.from_user.id
-    await query.answer()
-    text = ""
-
-    # Matching query data to display corresponding weather information
-    match query.data:
-        case "0":
-            text += daily_weather_info[user_id][0]
-        case "1":
-            text += daily_weather_info[user_id][1]
-        case "2":
-            text += daily_weather_info[user_id][2]
-        case "3":
-            text += daily_weather_info[user_id][3]
-        case "4":
-            text += daily_weather_info[user_id][4]
-    # Sending weather information to the user
-    await context.bot.send_message(chat_id=query.message.chat_id, text=text, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
-    await context.bot.send_message(chat_id=query.message.chat_id, text="Is there anything else I can help with? 😇", reply_markup=main_menu_markup)
-    return CHOOSING
-
-
-async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """
-    Handler for unknown commands.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    int: The next conversation state
-    """
-    await update.message.reply_text("Unknown command. Please choose the options below 👇", reply_markup=main_menu_markup)
-    return CHOOSING
-
-async def outside_conv_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """
-    Handler for messages outside the conversation.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    None
-    """
-    await update.message.reply_text("Type /start to start the conversation 🏃")
-
-
-async def start_in_conv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """
-    Handler for starting a conversation when already in a conversation.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    None
-    """
-    await update.message.reply_text("You are already in conversation, choose the options below 👇", reply_markup=main_menu_markup)
-    return CHOOSING
-
-
-async def done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """
-    Handler for ending the conversation.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    None
-    """
-    await update.message.reply_text("See you next time! 👋", reply_markup=ReplyKeyboardRemove())
-    try:
-        del daily_weather_info[update.message.from_user.id]
-    except:
-        print("Key Not Present!")
-    return ConversationHandler.END
-
-async def timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """
-    Handler for timeout the conversation.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    None
-    """
-    await context.bot.send_message(chat_id=update.message.from_user.id, text="See you next time! 👋", reply_markup=ReplyKeyboardRemove())
-    try:
-        del daily_weather_info[update.message.from_user.id]
-    except:
-        print("Key Not Present!")
-    
-
-
-async def send_daily_updates(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """
-    Function to send daily weather updates to subscribed users.
-
-    Parameters:
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    None
-    """
-    users = db_module.get_users_with_daily_updates()
-
-    if users:
-        for user in users:
-            geo_data = weather_by_coord(user[1], user[2])
-            city = user[3] + '\n\n'
-            message = parse_weather(geo_data, city, 0)
-            await context.bot.send_message(chat_id=user[0], text=message, parse_mode=ParseMode.MARKDOWN)
-
-
-async def cancel_daily_updates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """
-    Handler for canceling daily weather updates subscription.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    int: The next conversation state
-    """
-    user_id = update.message.from_user.id
-    user_data = (int(user_id),)
-    result = db_module.execute_query(f"SELECT user_id FROM telegram_users.users WHERE user_id= %s", user_data)
-
-    if result:
-        db_module.execute_query(f"DELETE FROM telegram_users.users WHERE user_id= %s", user_data)
-        await update.message.reply_text(text="You unsubscribed successfully!", reply_markup=main_menu_markup)
-    else:
-        await update.message.reply_text("You are not subscribed to daily updates yet 😞. Choose *Update my city* to get daily updates.", parse_mode=ParseMode.MARKDOWN)
-
-    return CHOOSING
-
-
-async def help_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """
-    Handler for providing help information to the user.
-
-    Parameters:
-    - update (Update): The incoming Telegram update
-    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
-
-    Returns:
-    int: The next conversation state
-    """
-    reply_text = """
-    *Update my city*: Set your city to get updates ☀️\n
-    *Cancel updates*: Temporarily pause weather notifications 🌤 \n
-    *My city weather*: Receive instant weather details for your saved city 🌦 \n
-    *Choose city*: Explore and select a new location ⛈ \n
-    *Done*: End conversation, or type /start at any time to return to the main menu 🌈 \n
-    */help*: Access a quick guide to commands and usage ❄️ \n
-    */start*: Begin your weather journey with Weather Bot 💦"""
-    await update.message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN, reply_markup=main_menu_markup)
-    return CHOOSING
-
-
-def main() -> None:
-
-    application = Application.builder().token(BOT_TOKEN).build()
-
-    outside_conversation_message = MessageHandler(filters.TEXT | filters.COMMAND, outside_conv_message)
-    unknown_message = MessageHandler(filters.TEXT, unknown)
-    unknown_command = MessageHandler(filters.COMMAND, unknown)
-    done_message = MessageHandler(filters.Regex("^Done$"), done)
-    start_command = MessageHandler(filters.Regex("^/start$"), start_in_conv)
-    help_command = CommandHandler("help", help_user)
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
-        states={
-            CHOOSING: [
-                help_command,
-                MessageHandler(filters.Regex("^Update my city$"), update_my_city_choice),
-                MessageHandler(filters.Regex("^Cancel updates$"), cancel_daily_updates),
-                MessageHandler(filters.Regex("^My city weather$"), my_city_choice),
-                MessageHandler(filters.Regex("Choose city$"), other_city_choice),
-                start_command,
-                done_message,
-                unknown_message,
-                unknown_command
-            ],
-
-            TYPING_REPLY: [
-                help_command,
-                CallbackQueryHandler(choose_city_button),
-                MessageHandler(filters.Regex("^[A-Za-z\s\-\'\.]+$"), other_city_handler),
-                start_command,
-                done_message,
-                unknown_message,
-                unknown_command
-            ],
-            UPDATE_TYPING_REPLY: [
-                help_command,
-                CallbackQueryHandler(save_my_city_button),
-                MessageHandler(filters.Regex("^[A-Za-z\s\-\'\.]+$"), update_city_handler),
-                start_command
-            ],
-            DAILY_WEATHER: [
-                help_command,
-                CallbackQueryHandler(daily_weather),
-                start_command,
-                done_message,
-                unknown_message,
-                unknown_command
-            ],
-            ConversationHandler.TIMEOUT: [MessageHandler(filters.TEXT | filters.COMMAND, timeout)],
-        },
-        conversation_timeout=120,
-        fallbacks=[done]
-    )
-
-    application.add_handler(conv_handler)
-    application.add_handler(outside_conversation_message)
-    application.add_handler(help_command)
-    application.job_queue.run_daily(send_daily_updates, time=time(hour=7, minute=00, tzinfo=pytz.timezone('Asia/Tel_Aviv')))
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
-
-if __name__ == "__main__":
-    main()
+"""
+WeatherBot Telegram Bot
+
+This script implements a Telegram bot to provide weather information to users based on their chosen city.
+
+Author: iliaVrtn
+Date: 12.10.2023
+"""
+
+import asyncio
+import logging
+from datetime import datetime, time, timedelta
+import pytz
+import telegram
+from telegram import (
+    ReplyKeyboardMarkup,
+    ReplyKeyboardRemove,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    Update,
+    Bot,
+)
+from telegram.constants import ParseMode
+from telegram.ext import (
+    Application,
+    CommandHandler,
+    ContextTypes,
+    ConversationHandler,
+    JobQueue,
+    MessageHandler,
+    CallbackQueryHandler,
+    InlineQueryHandler,
+    TypeHandler,
+    filters,
+)
+import db_module
+from broadcast_module import Broadcaster, group_by_location
+from persistence_module import PostgresPersistence
+from autocomplete_module import city_autocomplete, autocomplete_candidates
+from location_module import Location, location_registry
+from metrics_module import Gauge, instrument_handlers, start_metrics_server, stop_metrics_server
+from migrations_module import migrate
+from update_processor_module import PerUserUpdateProcessor
+from prefetch_module import prerendered_messages, daily_message, prefetch_subscribed_locations
+from cache_module import TTLCache
+from forecast_module import CompactForecast, ForecastStore, render_day
+from get_weather_module import (
+    process_information_async,
+    weather_by_coord_async,
+    is_error,
+    close_http_client,
+    warm_geocoding_cache,
+    load_city_index,
+    coord_key,
+    forecast_cache,
+    geocoding_cache,
+    forecast_flight,
+    geocoding_flight,
+    call_accounting,
+    circuit_breakers,
+    BACKGROUND,
+    SERVER_ERROR_MSG,
+)
+from config import *
+
+# Enable logging
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+# Set higher logging level for httpx to avoid all GET and POST requests being logged
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+logger = logging.getLogger(__name__)
+
+# Update types the handlers consume, nothing else is requested from Telegram
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.INLINE_QUERY]
+
+# Define conversation states
+CHOOSING, TYPING_REPLY, UPDATE_TYPING_REPLY, DAILY_WEATHER = range(4)
+
+# Compact forecasts shared by all users browsing the same location
+forecast_store = ForecastStore(FORECAST_STORE_SIZE, FORECAST_STORE_TTL)
+
+# Gauges read when the metrics page is scraped
+cache_entries = Gauge("bot_cache_entries", "Entries held by the in-memory caches.", ("cache",),
+                      function=lambda: {("forecast",): len(forecast_cache), ("geocoding",): len(geocoding_cache),
+                                        ("forecast_store",): len(forecast_store),
+                                        ("prerendered",): len(prerendered_messages)})
+browsing_users = Gauge("bot_browsing_users", "Users holding a reference to a forecast they browse day by day.")
+
+# Time zone names accepted by /timezone, looked up case-insensitively
+TIMEZONES = {name.lower(): name for name in pytz.all_timezones}
+
+# Name of the main conversation in the persistence layer
+CONVERSATION_NAME = "weather_conversation"
+# Major python-telegram-bot version whose ConversationHandler internals the shared conversation states rely on
+SUPPORTED_PTB_MAJOR = 20
+
+# Keyboard layout for the main menu
+main_menu_keyboard = [
+    ["Update my city", "Cancel updates", "My city weather"],
+    ["Choose city"],
+    ["Done"],
+]
+
+main_menu_markup = ReplyKeyboardMarkup(main_menu_keyboard, one_time_keyboard=True, resize_keyboard=True)
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Start command handler. Displays initial message with options.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    int: The next conversation state
+    """
+    # Greet the user and provide information about their current city if available
+    reply_text = "Hi! I'm here to provide you weather information about your city! "
+    user_id = update.message.from_user.id
+    city = await db_module.get_user_city(user_id)
+    if city:
+        reply_text += f"Your current city is {city} 😃"
+    else:
+        reply_text += f"You can choose *Update my city* to get daily weather information at {DEFAULT_DELIVERY_TIME} ⌚"
+    
+    # Send the initial message with options
+    await update.message.reply_text(reply_text, reply_markup=main_menu_markup, parse_mode=ParseMode.MARKDOWN)
+    return CHOOSING
+
+
+async def update_my_city_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Prompt user to enter the city for daily weather updates.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    int: The next conversation state
+    """
+    reply_text = "Enter the city for which you want to receive daily weather updates 💌\nOr type @" + context.bot.username + " and the first letters of the city to pick it from a list"
+    await update.message.reply_text(reply_text, reply_markup=ReplyKeyboardRemove())
+    return UPDATE_TYPING_REPLY
+
+
+async def update_city_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handler for updating the user's city based on the provided input.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    int: The next conversation state
+    """
+    await search_city(update, context)
+    return UPDATE_TYPING_REPLY
+
+
+async def other_city_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handler for searching and displaying the available cities based on user input.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    int: The next conversation state
+    """
+    await search_city(update, context)
+    return TYPING_REPLY
+
+
+async def search_city(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Searches for the entered city and displays available options for selection.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    int: The next conversation state
+    """
+    city = update.message.text.capitalize()
+    geo_data = await process_information_async(city)
+    if "err" in geo_data:
+        await update.message.reply_text(text=geo_data["err_msg"], reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
+    if len(geo_data) == 0:
+        reply_text = f"I didn't find such a city 😔 Check if you typed it correctly and try again."
+        await update.message.reply_text(reply_text, reply_markup=ReplyKeyboardRemove())
+    else:
+        keyboard = await list_of_cities(geo_data, city)
+        if not keyboard:
+            # No city could be registered, e.g. the database is unreachable
+            await update.message.reply_text(text=SERVER_ERROR_MSG, reply_markup=ReplyKeyboardRemove())
+            return ConversationHandler.END
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await update.message.reply_text("Which city is yours?\n", reply_markup=reply_markup)
+    return TYPING_REPLY
+
+
+async def other_city_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Prompt user to enter the city for weather information.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    int: The next conversation state
+    """
+    reply_text = "Enter city that you want to get weather information about 🌇\nOr type @" + context.bot.username + " and the first letters of the city to pick it from a list"
+    await update.message.reply_text(reply_text, reply_markup=ReplyKeyboardRemove())
+    return TYPING_REPLY
+
+
+async def my_city_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handler for displaying weather information for the user's saved city.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    int: The next conversation state
+    """
+    user_id = update.message.from_user.id
+    data = await db_module.get_user_location(user_id)
+    if data:
+        lat, lon, city = data
+        forecast = await weather_by_coord_async(lat, lon)
+        if is_error(forecast):
+            await update.message.reply_text(text=forecast['err_msg'], reply_markup=ReplyKeyboardRemove())
+            return ConversationHandler.END
+        reply_markup = browse_forecast(context, lat, lon, city, forecast)
+        await update.message.reply_text(
+            text="Choose a day you want to get weather information 📆",
+            reply_markup=reply_markup,
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return DAILY_WEATHER
+    await update.message.reply_text(
+        text="You have not chosen the city yet, choose *Update my city* to do it 😸",
+        reply_markup=main_menu_markup,
+        parse_mode=ParseMode.MARKDOWN
+    )
+    return CHOOSING
+
+
+def day_keyboard(forecast: CompactForecast) -> InlineKeyboardMarkup:
+    """
+    Generates the inline keyboard for choosing one of the forecast days.
+
+    Parameters:
+    - forecast (CompactForecast): The weather information
+
+    Returns:
+    InlineKeyboardMarkup: The keyboard with one button per day
+    """
+    labels = forecast.day_labels()
+    inline_keyboard = [
+        [InlineKeyboardButton("Today, " + labels[0], callback_data="0"),
+         InlineKeyboardButton("Tomorrow, " + labels[1], callback_data="1")
+         ],
+        [InlineKeyboardButton(labels[2], callback_data="2"),
+         InlineKeyboardButton(labels[3], callback_data="3")
+         ],
+        [InlineKeyboardButton(labels[4], callback_data="4")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard)
+
+
+def browse_forecast(context: ContextTypes.DEFAULT_TYPE, lat: str, lon: str, city: str, forecast: CompactForecast) -> InlineKeyboardMarkup:
+    """
+    Stores the forecast a user is about to browse and generates the day keyboard.
+
+    The shared forecast goes to the forecast store, the user's data only keeps
+    a small reference to it so it can be persisted and shared between workers.
+
+    Parameters:
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+    - lat (str): The latitude of the city
+    - lon (str): The longitude of the city
+    - city (str): The name of the city
+    - forecast (CompactForecast): The weather information
+
+    Returns:
+    InlineKeyboardMarkup: The keyboard with one button per day
+    """
+    key = forecast_store.put(coord_key(lat, lon), forecast)
+    context.user_data["browsing"] = {
+        "lat": str(lat), "lon": str(lon), "city": city, "dt": key[1], "at": datetime.now().timestamp()
+    }
+    return day_keyboard(forecast)
+
+
+async def list_of_cities(geo_data: list, city: str) -> list:
+    """
+    Generates a list of cities for display in inline keyboard.
+
+    Every city is registered in the location registry, all at once, and its
+    button only carries the location id. Cities that could not be registered
+    get no button.
+
+    Parameters:
+    - geo_data (list): List of geographic data for cities
+    - city (str): The user's selected city
+
+    Returns:
+    list: List of keyboard options
+    """
+    country_arr = [list([item['state'], item['country']]) if 'state' in item else list(["", item['country']])
+                   for item in geo_data]
+    places = []
+    cities=[]
+    for i in range(len(country_arr)):
+        city_name = ", ".join([city, country_arr[i][0], country_arr[i][1]])
+        if city_name not in cities:
+            cities.append(city_name)
+            if city_name.find(", , ") > 0:  # some cities does not have states 
+                city_name = city_name.replace(", ", "", 1)
+            places.append((city_name, geo_data[i]['lat'], geo_data[i]['lon']))
+    locations = await asyncio.gather(*[location_registry.intern(*place) for place in places])
+    return [[InlineKeyboardButton(place[0], callback_data=f"loc:{location.id}")]
+            for place, location in zip(places, locations) if location is not None]
+
+
+async def callback_location(data: str):
+    """
+    Get the location a city button refers to.
+
+    Parameters:
+    - data (str): The callback data of the button
+
+    Returns:
+    - location (Location or None): The location, or None if the button is not a city button
+    """
+    if not data.startswith("loc:") or not data[4:].isdigit():
+        return None
+    return await location_registry.get(int(data[4:]))
+
+
+async def choose_city_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handler for selecting a city from the displayed options.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+    """
+    query = update.callback_query
+    user_id = query.from_user.id
+    await query.answer()
+
+    location = await callback_location(query.data)
+    if location is None:
+        await context.bot.send_message(chat_id=query.message.chat_id, text="This list of cities is no longer available, type the city again 🔄")
+        return TYPING_REPLY
+    return await show_location_forecast(context, query.message.chat_id, location)
+
+
+async def show_location_forecast(context: ContextTypes.DEFAULT_TYPE, chat_id: int, location: Location) -> int:
+    """
+    Fetches the forecast of a chosen location and shows the day keyboard.
+
+    Parameters:
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+    - chat_id (int): The chat to answer in
+    - location (Location): The chosen location
+
+    Returns:
+    int: The next conversation state
+    """
+    lat, lon, city = location.lat, location.lon, location.name
+    forecast = await weather_by_coord_async(lat, lon)
+    if is_error(forecast):
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=forecast['err_msg'],
+            reply_markup=ReplyKeyboardRemove()
+        )
+        return ConversationHandler.END
+    reply_markup = browse_forecast(context, lat, lon, city, forecast)
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text="Choose a day you want to get weather information 📆",
+        reply_markup=reply_markup,
+        parse_mode=ParseMode.MARKDOWN
+    )
+    return DAILY_WEATHER
+
+async def save_my_city_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Callback handler for saving the user's city button.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    None
+    """
+    query = update.callback_query
+    await query.answer()
+
+    # Looking up the location of the chosen button
+    user_id = query.from_user.id
+    location = await callback_location(query.data)
+    if location is None:
+        await context.bot.send_message(chat_id=query.message.chat_id, text="This list of cities is no longer available, type the city again 🔄")
+        return UPDATE_TYPING_REPLY
+    return await save_location(context, query.message.chat_id, user_id, location)
+
+
+async def save_location(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, location: Location) -> int:
+    """
+    Saves a chosen location as the user's city for daily updates.
+
+    Parameters:
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+    - chat_id (int): The chat to answer in
+    - user_id (int): The Telegram user id
+    - location (Location): The chosen location
+
+    Returns:
+    int: The next conversation state
+    """
+    my_city = location.name
+
+    # Update or insert user's city information in the database
+    await db_module.save_user_city(user_id, location.lat, location.lon, my_city, location.id)
+    delivery = await db_module.get_user_delivery(user_id) or (DEFAULT_TIMEZONE, DEFAULT_DELIVERY_TIME)
+    schedule_delivery(context.job_queue, *delivery)
+
+    # Confirmation messages
+    reply_text = f"Your city has been changed to {my_city}!😃"
+    await context.bot.send_message(chat_id=chat_id, text=reply_text, reply_markup=ReplyKeyboardRemove())
+    await context.bot.send_message(chat_id=chat_id, text="Is there anything else I can help with? 😇", reply_markup=main_menu_markup)
+    return CHOOSING
+
+
+async def inline_city_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Inline query handler suggesting cities while the user types "@bot city".
+
+    Cached queries are answered right away, others only once the user has
+    stopped typing for the debounce time.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object
+
+    Returns:
+    None
+    """
+    query = update.inline_query
+    suggestions = city_autocomplete.cached(query.query)
+    if suggestions is None:
+        if not query.query.strip() or not await city_autocomplete.settled(query.from_user.id, query.id):
+            return
+        suggestions = city_autocomplete.complete(query.query)
+    results = [
+        InlineQueryResultArticle(id=str(i), title=name, input_message_content=InputTextMessageContent(name))
+        for i, (name, lat, lon) in enumerate(suggestions)
+    ]
+    await query.answer(results, cache_time=int(AUTOCOMPLETE_CACHE_TTL), is_personal=False)
+
+
+async def suggested_location(text: str):
+    """
+    Get the location of a city the user picked from the inline suggestions.
+
+    Parameters:
+    - text (str): The text of the message sent through the inline query
+
+    Returns:
+    - location (Location or None): The location, or None if the city was not suggested
+    """
+    suggestion = city_autocomplete.resolve(text)
+    return await location_registry.intern(*suggestion) if suggestion else None
+
+
+async def suggested_city_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handler for a city picked from the inline suggestions, showing its forecast right away.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    int: The next conversation state
+    """
+    location = await suggested_location(update.message.text)
+    if location is None:
+        return await other_city_handler(update, context)
+    return await show_location_forecast(context, update.message.chat_id, location)
+
+
+async def suggested_update_city_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handler for a city picked from the inline suggestions while updating the user's city.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    int: The next conversation state
+    """
+    location = await suggested_location(update.message.text)
+    if location is None:
+        return await update_city_handler(update, context)
+    return await save_location(context, update.message.chat_id, update.message.from_user.id, location)
+
+
+async def refresh_autocomplete(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job rebuilding the city autocomplete from the geocoding cache and the subscribed cities.
+
+    Parameters:
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the job
+
+    Returns:
+    None
+    """
+    city_autocomplete.rebuild(await autocomplete_candidates())
+
+
+async def daily_weather(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Callback handler for daily weather updates.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    None
+    """
+    query = update.callback_query
+    user_id = query.from_user.id
+    await query.answer()
+
+    browsing = context.user_data.get("browsing")
+    if browsing is None or datetime.now().timestamp() - browsing["at"] > BROWSING_STATE_TTL or query.data not in ("0", "1", "2", "3", "4"):
+        await context.bot.send_message(chat_id=query.message.chat_id, text="This forecast is no longer available, choose the city again 🔄", reply_markup=main_menu_markup)
+        return CHOOSING
+    lat, lon, city = browsing["lat"], browsing["lon"], browsing["city"]
+    forecast = forecast_store.get((coord_key(lat, lon), browsing["dt"]))
+    if forecast is None:
+        # The shared forecast was evicted, fetch it again for this location
+        forecast = await weather_by_coord_async(lat, lon)
+        if is_error(forecast):
+            await context.bot.send_message(chat_id=query.message.chat_id, text=forecast['err_msg'], reply_markup=ReplyKeyboardRemove())
+            return ConversationHandler.END
+        browse_forecast(context, lat, lon, city, forecast)
+        forecast = forecast_store.get((coord_key(lat, lon), context.user_data["browsing"]["dt"]))
+
+    # Rendering the chosen day of the forecast
+    text = render_day(forecast, city, int(query.data))
+    # Sending weather information to the user
+    await context.bot.send_message(chat_id=query.message.chat_id, text=text, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+    await context.bot.send_message(chat_id=query.message.chat_id, text="Is there anything else I can help with? 😇", reply_markup=main_menu_markup)
+    return CHOOSING
+
+
+async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handler for unknown commands.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    int: The next conversation state
+    """
+    await update.message.reply_text("Unknown command. Please choose the options below 👇", reply_markup=main_menu_markup)
+    return CHOOSING
+
+async def outside_conv_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handler for messages outside the conversation.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    None
+    """
+    await update.message.reply_text("Type /start to start the conversation 🏃")
+
+
+async def start_in_conv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handler for starting a conversation when already in a conversation.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    None
+    """
+    await update.message.reply_text("You are already in conversation, choose the options below 👇", reply_markup=main_menu_markup)
+    return CHOOSING
+
+
+async def done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handler for ending the conversation.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    None
+    """
+    await update.message.reply_text("See you next time! 👋", reply_markup=ReplyKeyboardRemove())
+    context.user_data.pop("browsing", None)
+    return ConversationHandler.END
+
+async def timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handler for timeout the conversation.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    None
+    """
+    await context.bot.send_message(chat_id=update.message.from_user.id, text="See you next time! 👋", reply_markup=ReplyKeyboardRemove())
+    context.user_data.pop("browsing", None)
+    
+
+
+async def send_daily_updates(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Function to send daily weather updates to the subscribed users of one delivery bucket.
+
+    Subscribers are streamed from the database in batches and grouped by
+    location, so every distinct forecast is fetched and rendered once per
+    broadcast and the message is sent to all users of that location. Sending
+    starts with the first batch while later batches are still being loaded.
+    Messages pre-rendered by the prefetch job are sent as they are, only
+    locations it missed are fetched here, fresh unless the refresh fails. A
+    failed subscriber query is retried from the last loaded user. The jobs of a bucket that has no
+    subscribers left are removed, once a count confirms it is empty.
+
+    Parameters:
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    None
+    """
+    bucket = context.job.data
+    semaphore = asyncio.Semaphore(BROADCAST_FETCH_CONCURRENCY)
+    forecasts = {}
+    messages = {}
+
+    async def fetch_location(user: tuple) -> dict:
+        async with semaphore:
+            return await weather_by_coord_async(user[1], user[2], BACKGROUND, allow_stale=False)
+
+    async def subscriber_batches():
+        # A failed query is retried from the last loaded user, then the rest of the bucket is given up
+        last_user_id, attempt = -1, 0
+        while True:
+            try:
+                async for batch in db_module.iter_users_with_daily_updates(bucket=bucket, after_user_id=last_user_id):
+                    attempt = 0
+                    last_user_id = batch[-1][0]
+                    yield batch
+                return
+            except Exception as e:
+                attempt += 1
+                if attempt > SUBSCRIBER_BATCH_RETRIES:
+                    logger.error("Daily updates of %s stopped after user %s, the subscribers could not be loaded: %s",
+                                 bucket, last_user_id, e)
+                    return
+                logger.warning("Loading the subscribers of %s after user %s failed, retrying: %s", bucket, last_user_id, e)
+                await asyncio.sleep(2 ** (attempt - 1))
+
+    async def daily_messages():
+        async for batch in subscriber_batches():
+            locations = group_by_location(batch)
+            for cell, members in locations.items():
+                for user in members:
+                    key = (cell, user[3])
+                    if key not in messages and (message := prerendered_messages.get(key)) is not None:
+                        messages[key] = message
+                if cell not in forecasts and any((cell, user[3]) not in messages for user in members):
+                    forecasts[cell] = asyncio.ensure_future(fetch_location(members[0]))
+            for cell, members in locations.items():
+                for user in members:
+                    key = (cell, user[3])
+                    if key not in messages:
+                        forecast = await forecasts[cell]
+                        if is_error(forecast):
+                            logger.warning("Skipping daily update for user %s: %s", user[0], forecast['err_msg'])
+                            continue
+                        messages[key] = daily_message(forecast, user[3])
+                    yield user[0], messages[key]
+
+    broadcaster = Broadcaster(context.bot, parse_mode=ParseMode.MARKDOWN)
+    stats = await broadcaster.run(daily_messages())
+    logger.info("Daily updates of %s used %d messages, %d locations were not prefetched", bucket, len(messages), len(forecasts))
+    if not stats.queued:
+        # Nothing is queued when the subscriber query or every forecast failed too, only an empty bucket is removed
+        try:
+            subscribers = await db_module.count_bucket_subscribers(*bucket)
+        except Exception as e:
+            logger.warning("Keeping daily updates of %s, its subscribers could not be counted: %s", bucket, e)
+            return
+        if not subscribers:
+            unschedule_delivery(context.job_queue, *bucket)
+
+
+async def prefetch_daily_updates(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job warming the forecasts and daily messages of a delivery bucket's locations before its broadcast.
+
+    Parameters:
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the job
+
+    Returns:
+    None
+    """
+    await prefetch_subscribed_locations(context.job.data)
+
+
+def lead_time(delivery: time, minutes: int) -> time:
+    """
+    Get the time of day a number of minutes before a delivery time.
+
+    Parameters:
+    - delivery (time): The delivery time, with its time zone
+    - minutes (int): The lead time in minutes
+
+    Returns:
+    - start (time): The earlier time of day, in the same time zone
+    """
+    start = datetime.combine(datetime.min, delivery.replace(tzinfo=None)) + timedelta(days=1) - timedelta(minutes=minutes)
+    return start.time().replace(tzinfo=delivery.tzinfo)
+
+
+def schedule_delivery(job_queue: JobQueue, timezone: str, delivery_time: str) -> bool:
+    """
+    Schedule the daily prefetch and broadcast jobs of a delivery bucket unless they exist already.
+
+    Workers started with RUN_JOBS=0 schedule nothing, the worker running the
+    jobs picks up buckets created elsewhere with sync_delivery_jobs.
+
+    Parameters:
+    - job_queue (JobQueue): The application's job queue
+    - timezone (str): The time zone name of the bucket
+    - delivery_time (str): The "HH:MM" delivery time of the bucket
+
+    Returns:
+    - scheduled (bool): True if the jobs were created
+    """
+    name = f"daily_updates:{timezone}:{delivery_time}"
+    if not RUN_JOBS or job_queue.get_jobs_by_name(name):
+        return False
+    delivery = datetime.strptime(delivery_time, "%H:%M").time().replace(tzinfo=pytz.timezone(timezone))
+    bucket = (timezone, delivery_time)
+    job_queue.run_daily(prefetch_daily_updates, time=lead_time(delivery, PREFETCH_LEAD_MINUTES), data=bucket,
+                        name=f"prefetch:{timezone}:{delivery_time}")
+    job_queue.run_daily(send_daily_updates, time=delivery, data=bucket, name=name)
+    return True
+
+
+def unschedule_delivery(job_queue: JobQueue, timezone: str, delivery_time: str) -> None:
+    """
+    Remove the daily prefetch and broadcast jobs of a delivery bucket.
+
+    Parameters:
+    - job_queue (JobQueue): The application's job queue
+    - timezone (str): The time zone name of the bucket
+    - delivery_time (str): The "HH:MM" delivery time of the bucket
+    """
+    for name in (f"prefetch:{timezone}:{delivery_time}", f"daily_updates:{timezone}:{delivery_time}"):
+        for job in job_queue.get_jobs_by_name(name):
+            job.schedule_removal()
+
+
+async def schedule_delivery_buckets(job_queue: JobQueue) -> int:
+    """
+    Schedule the jobs of every delivery bucket that has subscribers.
+
+    Parameters:
+    - job_queue (JobQueue): The application's job queue
+
+    Returns:
+    - count (int): The number of newly scheduled buckets
+    """
+    buckets = await db_module.get_delivery_buckets()
+    return sum(schedule_delivery(job_queue, timezone, delivery_time) for timezone, delivery_time, subscribers in buckets)
+
+
+async def sync_delivery_jobs(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job scheduling the delivery buckets created by users served by other workers.
+
+    Parameters:
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the job
+
+    Returns:
+    None
+    """
+    scheduled = await schedule_delivery_buckets(context.job_queue)
+    if scheduled:
+        logger.info("Scheduled daily updates for %d new delivery buckets", scheduled)
+
+
+async def log_cache_stats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job logging the size and memory usage of the forecast caches.
+
+    Parameters:
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the job
+
+    Returns:
+    None
+    """
+    browsing = sum(1 for user_data in context.application.user_data.values() if "browsing" in user_data)
+    logger.info("Forecast store: %s, browsing users: %d, forecast cache: %s, forecast single-flight: %s, geocoding single-flight: %s",
+                forecast_store.stats(), browsing, forecast_cache.stats(), forecast_flight.stats(), geocoding_flight.stats())
+    logger.info("City autocomplete: %s", city_autocomplete.stats())
+    logger.info("OpenWeather calls: %s, circuit breakers: %s", call_accounting.stats(),
+                {kind: breaker.stats() for kind, breaker in circuit_breakers.items()})
+
+
+async def cancel_daily_updates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handler for canceling daily weather updates subscription.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    int: The next conversation state
+    """
+    user_id = update.message.from_user.id
+
+    if await db_module.deactivate_user(user_id):
+        await update.message.reply_text(text="You unsubscribed successfully!", reply_markup=main_menu_markup)
+    else:
+        await update.message.reply_text("You are not subscribed to daily updates yet 😞. Choose *Update my city* to get daily updates.", parse_mode=ParseMode.MARKDOWN)
+
+    return CHOOSING
+
+
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handler for the /timezone command changing the time zone of the user's daily updates.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    int: The next conversation state
+    """
+    user_id = update.message.from_user.id
+    timezone = TIMEZONES.get(context.args[0].lower()) if len(context.args) == 1 else None
+    if timezone is None:
+        await update.message.reply_text("Send your time zone like this: /timezone Europe/London 🌍", reply_markup=main_menu_markup)
+        return CHOOSING
+    delivery = await db_module.set_user_delivery(user_id, timezone=timezone)
+    if delivery is None:
+        await update.message.reply_text("You are not subscribed to daily updates yet 😞. Choose *Update my city* to get daily updates.", parse_mode=ParseMode.MARKDOWN)
+        return CHOOSING
+    schedule_delivery(context.job_queue, *delivery)
+    await update.message.reply_text(f"You will get daily updates at {delivery[1]} {delivery[0]} time ⌚", reply_markup=main_menu_markup)
+    return CHOOSING
+
+
+async def set_delivery_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handler for the /time command changing the time of the user's daily updates.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    int: The next conversation state
+    """
+    user_id = update.message.from_user.id
+    try:
+        delivery_time = datetime.strptime(context.args[0], "%H:%M").strftime("%H:%M") if len(context.args) == 1 else None
+    except ValueError:
+        delivery_time = None
+    if delivery_time is None:
+        await update.message.reply_text("Send the time like this: /time 07:30 ⏰", reply_markup=main_menu_markup)
+        return CHOOSING
+    delivery = await db_module.set_user_delivery(user_id, delivery_time=delivery_time)
+    if delivery is None:
+        await update.message.reply_text("You are not subscribed to daily updates yet 😞. Choose *Update my city* to get daily updates.", parse_mode=ParseMode.MARKDOWN)
+        return CHOOSING
+    schedule_delivery(context.job_queue, *delivery)
+    await update.message.reply_text(f"You will get daily updates at {delivery[1]} {delivery[0]} time ⌚", reply_markup=main_menu_markup)
+    return CHOOSING
+
+
+async def help_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handler for providing help information to the user.
+
+    Parameters:
+    - update (Update): The incoming Telegram update
+    - context (ContextTypes.DEFAULT_TYPE): The context object for the conversation
+
+    Returns:
+    int: The next conversation state
+    """
+    reply_text = """
+    *Update my city*: Set your city to get updates ☀️\n
+    *Cancel updates*: Temporarily pause weather notifications 🌤 \n
+    */time HH:MM*: Choose when your daily update arrives ⏰ \n
+    */timezone Area/City*: Set the time zone of your daily update, e.g. /timezone Europe/London 🌍 \n
+    *My city weather*: Receive instant weather details for your saved city 🌦 \n
+    *Choose city*: Explore and select a new location ⛈ \n
+    *Done*: End conversation, or type /start at any time to return to the main menu 🌈 \n
+    */help*: Access a quick guide to commands and usage ❄️ \n
+    */start*: Begin your weather journey with Weather Bot 💦"""
+    await update.message.reply_text(text=reply_text, parse_mode=ParseMode.MARKDOWN, reply_markup=main_menu_markup)
+    return CHOOSING
+
+
+async def post_init(application: Application) -> None:
+    """
+    Prepare the database and warm the caches before the bot starts serving.
+
+    Parameters:
+    - application (Application): The running application
+    """
+    await start_metrics_server()
+    await migrate()
+    if db_module.write_behind:
+        db_module.write_behind.start()
+    logger.info("Loaded %d geocoding cache entries", await warm_geocoding_cache())
+    logger.info("Loaded %d registered locations", await location_registry.load())
+    logger.info("Loaded %d cities from the offline city index", load_city_index())
+    if RUN_JOBS:
+        logger.info("Scheduled daily updates for %d delivery buckets", await schedule_delivery_buckets(application.job_queue))
+    else:
+        logger.info("RUN_JOBS is 0, daily updates are sent by another worker")
+
+
+async def post_shutdown(application: Application) -> None:
+    """
+    Release shared resources when the application stops.
+
+    Parameters:
+    - application (Application): The running application
+    """
+    await close_http_client()
+    if db_module.write_behind:
+        await db_module.write_behind.stop()
+    db_module.close_database()
+    await stop_metrics_server()
+
+
+def conversation_states(conv_handler: ConversationHandler) -> dict:
+    """
+    Get the dict holding the state of every conversation of a handler, keyed by (chat_id, user_id).
+
+    ConversationHandler has no public API to set a state, this reads its
+    private _conversations attribute, which is only known to work with
+    python-telegram-bot 20.x. Other versions are refused rather than risking
+    a silently broken sync.
+
+    Parameters:
+    - conv_handler (ConversationHandler): The conversation handler
+
+    Returns:
+    - conversations (dict): The handler's own tracking dict
+    """
+    if telegram.__version_info__[0] != SUPPORTED_PTB_MAJOR or not hasattr(conv_handler, "_conversations"):
+        raise RuntimeError(f"Shared conversation states need python-telegram-bot {SUPPORTED_PTB_MAJOR}.x, "
+                           f"found {telegram.__version__}")
+    return conv_handler._conversations
+
+
+def conversation_state_sync(conv_handler: ConversationHandler):
+    """
+    Creates a handler loading the current conversation state of a user before the conversation handler runs.
+
+    Another worker may have moved the conversation on since this worker last
+    saw the user. The stored state replaces the local one unless the local
+    state changed since the last sync, which means this worker moved the
+    conversation on and the change is still on its way to the database. A
+    conversation idle for CONVERSATION_TIMEOUT seconds is read back as ended
+    by the persistence, which replaces the timeout jobs of unshared
+    conversations.
+
+    Parameters:
+    - conv_handler (ConversationHandler): The persistent conversation handler
+
+    Returns:
+    The handler callback
+    """
+    conversations = conversation_states(conv_handler)
+    # Stored state seen at the last sync of each user and the time of that sync
+    synced_states = TTLCache(PERSISTENCE_CACHE_SIZE, BROWSING_STATE_TTL)
+
+    async def sync_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if update.effective_chat is None or update.effective_user is None:
+            return
+        key = (update.effective_chat.id, update.effective_user.id)
+        now = datetime.now().timestamp()
+        local_state = conversations.get(key)
+        synced = synced_states.get(key)
+        # A local change older than the timeout has been written long ago, the stored state decides if it timed out
+        if synced is not None and synced[0] != local_state and now - synced[1] < CONVERSATION_TIMEOUT:
+            synced_states.set(key, (local_state, now))
+            return
+        state = await context.application.persistence.get_conversation_state(CONVERSATION_NAME, key)
+        if state != local_state:
+            if state is None:
+                conversations.pop(key, None)
+            else:
+                conversations[key] = state
+        synced_states.set(key, (state, now))
+
+    return sync_state
+
+
+def build_application() -> Application:
+    """
+    Build the application with every handler and recurring job registered, without starting it.
+
+    Every handler callback is instrumented, see metrics_module.instrument_callback.
+
+    Returns:
+    - application (Application): The configured application
+    """
+    builder = Application.builder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown)
+    if BOT_API_BASE_URL:
+        # e.g. a local Bot API server or a fake one used in tests
+        builder = builder.base_url(f"{BOT_API_BASE_URL}/bot").base_file_url(f"{BOT_API_BASE_URL}/file/bot")
+    if PERSISTENCE_ENABLED:
+        builder = builder.persistence(PostgresPersistence())
+    if CONCURRENT_UPDATES > 1:
+        # Conversation states need the updates of a user in order
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+    application = builder.build()
+
+    outside_conversation_message = MessageHandler(filters.TEXT | filters.COMMAND, outside_conv_message)
+    unknown_message = MessageHandler(filters.TEXT, unknown)
+    unknown_command = MessageHandler(filters.COMMAND, unknown)
+    done_message = MessageHandler(filters.Regex("^Done$"), done)
+    start_command = MessageHandler(filters.Regex("^/start$"), start_in_conv)
+    help_command = CommandHandler("help", help_user)
+    timezone_command = CommandHandler("timezone", set_timezone)
+    time_command = CommandHandler("time", set_delivery_time)
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("start", start)],
+        states={
+            CHOOSING: [
+                help_command,
+                MessageHandler(filters.Regex("^Update my city$"), update_my_city_choice),
+                MessageHandler(filters.Regex("^Cancel updates$"), cancel_daily_updates),
+                MessageHandler(filters.Regex("^My city weather$"), my_city_choice),
+                MessageHandler(filters.Regex("Choose city$"), other_city_choice),
+                MessageHandler(filters.VIA_BOT & filters.TEXT, suggested_city_handler),
+                timezone_command,
+                time_command,
+                start_command,
+                done_message,
+                unknown_message,
+                unknown_command
+            ],
+
+            TYPING_REPLY: [
+                help_command,
+                CallbackQueryHandler(choose_city_button),
+                MessageHandler(filters.VIA_BOT & filters.TEXT, suggested_city_handler),
+                MessageHandler(filters.Regex("^[A-Za-z\s\-\'\.]+$"), other_city_handler),
+                start_command,
+                done_message,
+                unknown_message,
+                unknown_command
+            ],
+            UPDATE_TYPING_REPLY: [
+                help_command,
+                CallbackQueryHandler(save_my_city_button),
+                MessageHandler(filters.VIA_BOT & filters.TEXT, suggested_update_city_handler),
+                MessageHandler(filters.Regex("^[A-Za-z\s\-\'\.]+$"), update_city_handler),
+                start_command
+            ],
+            DAILY_WEATHER: [
+                help_command,
+                CallbackQueryHandler(daily_weather),
+                start_command,
+                done_message,
+                unknown_message,
+                unknown_command
+            ],
+            ConversationHandler.TIMEOUT: [MessageHandler(filters.TEXT | filters.COMMAND, timeout)],
+        },
+        # Timeout jobs live in the job queue of one worker, which could end a conversation another
+        # worker is serving, so shared conversations time out through their stored state instead
+        conversation_timeout=None if PERSISTENCE_ENABLED else CONVERSATION_TIMEOUT,
+        fallbacks=[done],
+        name=CONVERSATION_NAME,
+        persistent=PERSISTENCE_ENABLED
+    )
+
+    if PERSISTENCE_ENABLED:
+        application.add_handler(TypeHandler(Update, conversation_state_sync(conv_handler)), group=-1)
+    application.add_handler(conv_handler)
+    application.add_handler(outside_conversation_message)
+    application.add_handler(help_command)
+    application.add_handler(InlineQueryHandler(inline_city_search, block=False))
+    application.add_handler(timezone_command)
+    application.add_handler(time_command)
+    application.job_queue.run_repeating(log_cache_stats, interval=600)
+    application.job_queue.run_repeating(refresh_autocomplete, interval=AUTOCOMPLETE_REFRESH_INTERVAL, first=1)
+    if RUN_JOBS:
+        application.job_queue.run_repeating(sync_delivery_jobs, interval=DELIVERY_SYNC_INTERVAL, first=DELIVERY_SYNC_INTERVAL)
+    for handlers in application.handlers.values():
+        instrument_handlers(handlers)
+    browsing_users.function = lambda: sum("browsing" in data for data in application.user_data.values())
+    return application
+
+
+def main() -> None:
+    run_application(build_application())
+
+
+def run_application(application: Application) -> None:
+    """
+    Serve updates through a webhook when WEBHOOK_URL is set, otherwise by long polling.
+
+    Parameters:
+    - application (Application): The configured application
+    """
+    if WEBHOOK_URL:
+        if not WEBHOOK_SECRET:
+            logger.warning("WEBHOOK_SECRET is not set, webhook requests will not be authenticated")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=False
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from telegram import Update
+from telegram.ext import BaseHandler, ConversationHandler
+from config import *
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Every metric by name, in creation order, rendered by render_metrics
+registry = {}
+
+# Server of the /metrics endpoint, started by start_metrics_server
+_metrics_server = None
+
+# Seconds a scraper has to send its request before the connection is dropped
+METRICS_REQUEST_TIMEOUT = 5
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    """
+    Base of the metric types, registered by name on creation.
+
+    Label values are passed positionally in the order of the label names, so
+    recording a sample is a tuple lookup. Samples may be recorded from any
+    thread.
+
+    Parameters:
+    - name (str): The metric name
+    - documentation (str): The help text
+    - labels (tuple): The label names
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        if name in registry:
+            raise ValueError(f"Metric {name} is already registered")
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry[name] = self
+
+    def samples(self) -> list:
+        """
+        Get the samples of the metric.
+
+        Returns:
+        - samples (list): (name suffix, label values, extra label, value) tuples
+        """
+        with self._lock:
+            return [("", key, "", value) for key, value in self._values.items()]
+
+    def render(self) -> str:
+        """
+        Render the metric in the Prometheus text exposition format.
+
+        Returns:
+        - text (str): The HELP and TYPE lines followed by one line per sample
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labels, key, extra)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count, e.g. of requests or errors.
+    """
+
+    kind = "counter"
+
+    def inc(self, *values, amount: float = 1) -> None:
+        """
+        Increase the counter of a label combination.
+
+        Parameters:
+        - values: The label values
+        - amount (float): The increment
+        """
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down, either set directly or read from a function when scraped.
+
+    Parameters:
+    - name (str): The metric name
+    - documentation (str): The help text
+    - labels (tuple): The label names
+    - function: Optional function returning the value, or a dict of values keyed by label value tuples
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value: float, *values) -> None:
+        """
+        Set the gauge of a label combination.
+
+        Parameters:
+        - value (float): The new value
+        - values: The label values
+        """
+        with self._lock:
+            self._values[values] = value
+
+    def samples(self) -> list:
+        if self.function is None:
+            return super().samples()
+        try:
+            value = self.function()
+        except Exception:
+            logger.exception("Could not read gauge %s", self.name)
+            return []
+        if isinstance(value, dict):
+            return [("", key, "", sample) for key, sample in value.items()]
+        return [("", (), "", value)]
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, e.g. durations, in cumulative buckets.
+
+    Parameters:
+    - name (str): The metric name
+    - documentation (str): The help text
+    - labels (tuple): The label names
+    - buckets (tuple): The increasing upper bounds of the buckets, +Inf is added
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *values) -> None:
+        """
+        Record an observation.
+
+        Parameters:
+        - value (float): The observed value
+        - values: The label values
+        """
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(values)
+            if state is None:
+                # Per bucket counts, the last one being +Inf, then the sum
+                state = self._values[values] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[i] += 1
+            state[-1] += value
+
+    def samples(self) -> list:
+        with self._lock:
+            states = [(key, list(state)) for key, state in self._values.items()]
+        samples = []
+        for key, state in states:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append(("_bucket", key, f'le="{le}"', cumulative))
+            samples.append(("_sum", key, "", state[-1]))
+            samples.append(("_count", key, "", cumulative))
+        return samples
+
+
+def render_metrics() -> str:
+    """
+    Render every registered metric in the Prometheus text exposition format.
+
+    Returns:
+    - text (str): The metrics page
+    """
+    return "\n".join(metric.render() for metric in registry.values()) + "\n"
+
+
+handler_seconds = Histogram("bot_handler_duration_seconds", "Time spent in update handler callbacks.", ("handler",))
+handler_errors = Counter("bot_handler_errors_total", "Exceptions raised by update handler callbacks.",
+                         ("handler", "error"))
+
+
+def _describe_update(update) -> str:
+    if not isinstance(update, Update):
+        return "update_id=None user_id=None"
+    user = update.effective_user
+    return f"update_id={update.update_id} user_id={user.id if user else None}"
+
+
+def instrument_callback(callback, name: str = None):
+    """
+    Wrap a handler callback to record its duration and errors and log it when slow.
+
+    Parameters:
+    - callback: The coroutine function of the handler
+    - name (str): The handler label, the function name by default
+
+    Returns:
+    - timed: The wrapped callback, or the callback itself if it is already wrapped
+    """
+    if getattr(callback, "instrumented", False):
+        return callback
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception as e:
+            handler_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            handler_seconds.observe(duration, name)
+            if duration >= SLOW_HANDLER_SECONDS:
+                logger.warning("slow_handler handler=%s duration=%.3f %s", name, duration, _describe_update(update))
+
+    timed.instrumented = True
+    return timed
+
+
+def instrument_handlers(handlers) -> int:
+    """
+    Instrument the callbacks of handlers, including the ones nested in conversation handlers.
+
+    A handler registered in several places is wrapped once.
+
+    Parameters:
+    - handlers: An iterable of handlers
+
+    Returns:
+    - count (int): The number of handlers visited
+    """
+    count = 0
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            nested = list(handler.entry_points) + list(handler.fallbacks)
+            for state_handlers in handler.states.values():
+                nested.extend(state_handlers)
+            count += instrument_handlers(nested)
+        elif isinstance(handler, BaseHandler):
+            handler.callback = instrument_callback(handler.callback)
+            count += 1
+    return count
+
+
+async def _read_request_line(reader: asyncio.StreamReader) -> bytes:
+    request_line = await reader.readline()
+    while (await reader.readline()).strip():
+        pass
+    return request_line
+
+
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(_read_request_line(reader), METRICS_REQUEST_TIMEOUT)
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", render_metrics().encode()
+        else:
+            status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"Not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.TimeoutError, ValueError):
+        # ValueError is raised by readline for lines over the stream limit
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> bool:
+    """
+    Serve the metrics page on http://host:port/metrics if a port is configured.
+
+    Parameters:
+    - host (str): The address to listen on
+    - port (int): The port to listen on, 0 disables the endpoint
+
+    Returns:
+    - started (bool): True if the endpoint is served
+    """
+    global _metrics_server
+    if not port:
+        return False
+    _metrics_server = await asyncio.start_server(_serve_metrics, host, port, limit=8192)
+    logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return True
+
+
+async def stop_metrics_server() -> None:
+    """
+    Stop serving the metrics page.
+    """
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+        _metrics_server = None
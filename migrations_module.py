@@ -0,0 +1,114 @@
+import logging
+import db_module
+from config import *
+
+logger = logging.getLogger(__name__)
+
+# Advisory lock serialising workers that start at the same time
+MIGRATION_LOCK = "telegram_users.schema_migrations"
+
+# Schema versions in order, each applied once and recorded in telegram_users.schema_migrations.
+# Never edit an applied migration, add a new one instead.
+MIGRATIONS = [
+    (1, "Baseline tables", [
+        "CREATE SCHEMA IF NOT EXISTS telegram_users",
+        """CREATE TABLE IF NOT EXISTS telegram_users.users (
+            user_id BIGINT NOT NULL,
+            lat TEXT,
+            lon TEXT,
+            city TEXT
+        )""",
+        # The original SELECT-then-INSERT could store a user twice, keep the row written last
+        """DELETE FROM telegram_users.users older USING telegram_users.users newer
+            WHERE older.user_id = newer.user_id AND older.ctid < newer.ctid""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_user_id_key ON telegram_users.users (user_id)",
+        f"ALTER TABLE telegram_users.users ADD COLUMN IF NOT EXISTS timezone TEXT NOT NULL DEFAULT '{DEFAULT_TIMEZONE}'",
+        f"ALTER TABLE telegram_users.users ADD COLUMN IF NOT EXISTS delivery_time TIME NOT NULL DEFAULT '{DEFAULT_DELIVERY_TIME}'",
+        "CREATE INDEX IF NOT EXISTS users_delivery_bucket ON telegram_users.users (timezone, delivery_time, user_id)",
+        """CREATE TABLE IF NOT EXISTS telegram_users.locations (
+            location_id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            lat DOUBLE PRECISION NOT NULL,
+            lon DOUBLE PRECISION NOT NULL,
+            UNIQUE (name, lat, lon)
+        )""",
+        "ALTER TABLE telegram_users.users ADD COLUMN IF NOT EXISTS location_id INTEGER REFERENCES telegram_users.locations",
+        """CREATE TABLE IF NOT EXISTS telegram_users.geocoding_cache (
+            query TEXT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )""",
+        """CREATE TABLE IF NOT EXISTS telegram_users.conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state INTEGER,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (name, key)
+        )""",
+        """CREATE TABLE IF NOT EXISTS telegram_users.user_data (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )""",
+    ]),
+    (2, "Primary key, typed coordinates, grid cells and active subscriptions", [
+        """DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                           WHERE conrelid = 'telegram_users.users'::regclass AND contype = 'p') THEN
+                ALTER TABLE telegram_users.users ALTER COLUMN user_id SET NOT NULL;
+                ALTER TABLE telegram_users.users ADD CONSTRAINT users_pkey PRIMARY KEY USING INDEX users_user_id_key;
+            END IF;
+        END $$""",
+        """ALTER TABLE telegram_users.users
+            ALTER COLUMN lat TYPE DOUBLE PRECISION USING lat::double precision,
+            ALTER COLUMN lon TYPE DOUBLE PRECISION USING lon::double precision,
+            ADD COLUMN IF NOT EXISTS active BOOLEAN NOT NULL DEFAULT true""",
+        # Cells of 0.01 degrees grouping subscribers for the daily broadcast and its prefetch
+        """ALTER TABLE telegram_users.users
+            ADD COLUMN cell_lat NUMERIC GENERATED ALWAYS AS (round(lat::numeric, 2)) STORED,
+            ADD COLUMN cell_lon NUMERIC GENERATED ALWAYS AS (round(lon::numeric, 2)) STORED""",
+        "CREATE INDEX users_cell ON telegram_users.users (cell_lat, cell_lon, city) WHERE active",
+        "DROP INDEX telegram_users.users_delivery_bucket",
+        "CREATE INDEX users_delivery_bucket ON telegram_users.users (timezone, delivery_time, user_id) WHERE active",
+    ]),
+]
+
+
+def _apply_pending(cursor) -> list:
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (MIGRATION_LOCK,))
+    cursor.execute("""CREATE TABLE IF NOT EXISTS telegram_users.schema_migrations (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )""")
+    cursor.execute("SELECT version FROM telegram_users.schema_migrations")
+    applied = {row[0] for row in cursor.fetchall()}
+    versions = []
+    for version, description, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.execute("INSERT INTO telegram_users.schema_migrations (version, description) VALUES (%s, %s)",
+                       (version, description))
+        versions.append(version)
+    return versions
+
+
+async def migrate() -> list:
+    """
+    Bring the database schema up to date.
+
+    All pending migrations run in one transaction holding an advisory lock,
+    so workers starting together apply them once and a failing migration
+    leaves the schema untouched.
+
+    Returns:
+    - versions (list): The versions applied by this call
+    """
+    await db_module.execute_query_async("CREATE SCHEMA IF NOT EXISTS telegram_users", kind=db_module.WRITE)
+    versions = await db_module.execute_transaction_async(_apply_pending)
+    if versions:
+        logger.info("Applied schema migrations %s", versions)
+    return versions
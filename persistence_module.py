@@ -0,0 +1,166 @@
+import asyncio
+import json
+from copy import deepcopy
+from telegram.ext import BasePersistence, PersistenceInput
+import db_module
+from cache_module import TTLCache
+from config import *
+
+
+def _encode_key(key: tuple) -> str:
+    return json.dumps(list(key))
+
+
+def _decode_key(text: str) -> tuple:
+    return tuple(json.loads(text))
+
+
+class PostgresPersistence(BasePersistence):
+    """
+    Stores conversation states and user data in PostgreSQL so several bot workers can share them.
+
+    Writes are collected and flushed in batches shortly after python-telegram-bot
+    hands them over. Reads go through a small in-process cache whose TTL bounds
+    how long a change made by another worker can stay unseen. A conversation
+    whose state has not been written for conversation_timeout seconds is read
+    back as ended, which times conversations out without per-worker jobs.
+
+    Parameters:
+    - update_interval (float): Seconds between python-telegram-bot's persistence updates
+    - cache_ttl (float): Seconds a loaded conversation state or user data is trusted
+    - flush_delay (float): Seconds writes are collected before they are flushed together
+    - conversation_timeout (float): Seconds without a state change after which a conversation has ended
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_INTERVAL, cache_ttl: float = PERSISTENCE_CACHE_TTL,
+                 flush_delay: float = PERSISTENCE_FLUSH_DELAY, conversation_timeout: float = CONVERSATION_TIMEOUT):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.flush_delay = flush_delay
+        self.conversation_timeout = conversation_timeout
+        self._user_cache = TTLCache(PERSISTENCE_CACHE_SIZE, cache_ttl)
+        self._conversation_cache = TTLCache(PERSISTENCE_CACHE_SIZE, cache_ttl)
+        # Last known serialised data of recently active users, used to tell local changes from remote ones.
+        # A forgotten version only costs one extra write or reload of that user's data.
+        self._user_versions = TTLCache(PERSISTENCE_CACHE_SIZE, BROWSING_STATE_TTL)
+        self._pending_users = {}
+        self._pending_conversations = {}
+        self._flush_task = None
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        await self._write_pending()
+
+    async def _write_pending(self) -> None:
+        if self._pending_conversations:
+            pending, self._pending_conversations = self._pending_conversations, {}
+            rows = [(name, key, state) for (name, key), state in pending.items()]
+            if not await db_module.save_conversations(rows):
+                for name_key, state in pending.items():
+                    self._pending_conversations.setdefault(name_key, state)
+        if self._pending_users:
+            pending, self._pending_users = self._pending_users, {}
+            if not await db_module.save_user_data(list(pending.items())):
+                for user_id, data in pending.items():
+                    self._pending_users.setdefault(user_id, data)
+
+    async def get_user_data(self) -> dict:
+        # User data is loaded lazily per user in refresh_user_data
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {_decode_key(key): state for key, state in await db_module.load_conversations(name, self.conversation_timeout)}
+
+    async def get_conversation_state(self, name: str, key: tuple):
+        """
+        Get the current state of one conversation, as possibly changed by another worker or timed out.
+
+        Parameters:
+        - name (str): The name of the conversation handler
+        - key (tuple): The conversation key
+
+        Returns:
+        - state (int or None): The state, or None if the conversation is not active
+        """
+        cache_key = (name, _encode_key(key))
+        if cache_key in self._pending_conversations:
+            return self._pending_conversations[cache_key]
+        state = self._conversation_cache.get(cache_key)
+        if state is None:
+            state = await db_module.get_conversation_state(*cache_key, self.conversation_timeout)
+            # None is cached as -1 so inactive conversations are not queried on every update
+            self._conversation_cache.set(cache_key, -1 if state is None else state)
+        return None if state == -1 else state
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        cache_key = (name, _encode_key(key))
+        self._pending_conversations[cache_key] = new_state
+        self._conversation_cache.set(cache_key, -1 if new_state is None else new_state)
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        version = json.dumps(data, sort_keys=True)
+        if self._user_versions.get(user_id) == version:
+            return
+        self._user_versions.set(user_id, version)
+        self._user_cache.set(user_id, deepcopy(data))
+        self._pending_users[user_id] = deepcopy(data)
+        self._schedule_flush()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._pending_users:
+            return
+        data = self._user_cache.get(user_id)
+        if data is None:
+            data = await db_module.get_user_data(user_id) or {}
+            self._user_cache.set(user_id, data)
+        version = json.dumps(data, sort_keys=True)
+        if self._user_versions.get(user_id) != version:
+            # Another worker changed the data since this one last saw it
+            self._user_versions.set(user_id, version)
+            user_data.clear()
+            user_data.update(deepcopy(data))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending_users.pop(user_id, None)
+        self._user_versions.pop(user_id, None)
+        self._user_cache.pop(user_id)
+        await db_module.delete_user_data(user_id)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_pending()
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+import db_module
+from cache_module import TTLCache
+from forecast_module import CompactForecast, is_stale, render_day
+from get_weather_module import weather_by_coord_async, is_error, BACKGROUND
+from config import *
+
+logger = logging.getLogger(__name__)
+
+# Reason reported for cells that only have an expired forecast
+STALE_FORECAST_MSG = "Only a stale forecast is available"
+
+# Day-0 messages rendered ahead of the daily broadcast, keyed by (grid cell, city)
+prerendered_messages = TTLCache(PREFETCH_CACHE_SIZE, PREFETCH_LEAD_MINUTES * 60 + PREFETCH_MESSAGE_TTL)
+
+
+def daily_message(forecast: CompactForecast, city: str) -> str:
+    """
+    Format the daily update message of a city.
+
+    Parameters:
+    - forecast (CompactForecast): The weather information
+    - city (str): The name of the city
+
+    Returns:
+    - message (str): The formatted weather information of the current day
+    """
+    return render_day(forecast, city + '\n\n', 0)
+
+
+async def prefetch_locations(locations: list, concurrency: int = PREFETCH_CONCURRENCY) -> dict:
+    """
+    Fetch the forecasts of the given locations and pre-render their daily messages.
+
+    Forecasts are requested with background priority, so the OpenWeather rate
+    limits keep the pace and user requests go first. Expired cache entries are
+    refreshed first; cells whose refresh fails are reported as failed and no
+    message is rendered for them.
+
+    Parameters:
+    - locations (list): Rows of (lat, lon, city, subscribers)
+    - concurrency (int): The maximum number of forecasts fetched at once
+
+    Returns:
+    - report (dict): Counts of locations, warmed cells and rendered messages, the failed
+      (lat, lon, city, subscribers, error) rows and the duration in seconds
+    """
+    started_at = time.monotonic()
+    cells = {}
+    for location in locations:
+        # Locations are already cells, see db_module.get_subscribed_locations
+        cells.setdefault((location[0], location[1]), []).append(location)
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = []
+    warmed = 0
+    rendered = 0
+
+    async def warm(cell: tuple, members: list) -> None:
+        nonlocal warmed, rendered
+        async with semaphore:
+            forecast = await weather_by_coord_async(members[0][0], members[0][1], BACKGROUND, allow_stale=False)
+        if is_error(forecast):
+            failed.extend((*member, forecast['err_msg']) for member in members)
+            return
+        if is_stale(forecast.fetched_at):
+            # The refresh failed, the broadcast tries again instead of sending the expired forecast
+            failed.extend((*member, STALE_FORECAST_MSG) for member in members)
+            return
+        warmed += 1
+        for member in members:
+            if prerendered_messages.get((cell, member[2])) is None:
+                prerendered_messages.set((cell, member[2]), daily_message(forecast, member[2]))
+                rendered += 1
+
+    await asyncio.gather(*[warm(cell, members) for cell, members in cells.items()])
+    return {
+        "locations": len(locations),
+        "cells": len(cells),
+        "warmed_cells": warmed,
+        "rendered": rendered,
+        "failed": failed,
+        "duration": round(time.monotonic() - started_at, 3),
+    }
+
+
+async def prefetch_subscribed_locations(bucket: tuple = None) -> dict:
+    """
+    Warm the forecast cache and pre-render the daily messages of every subscribed location.
+
+    Parameters:
+    - bucket (tuple): Optional (timezone, "HH:MM") delivery bucket to warm the locations of
+
+    Returns:
+    - report (dict): The prefetch report, see prefetch_locations
+    """
+    report = await prefetch_locations(await db_module.get_subscribed_locations(bucket))
+    if report["failed"]:
+        logger.warning("Prefetch of %s could not warm %d locations: %s", bucket or "all users", len(report["failed"]),
+                       [(row[2], row[3]) for row in report["failed"]])
+    logger.info("Prefetch of %s finished: %s", bucket or "all users",
+                {key: value for key, value in report.items() if key != "failed"})
+    return report
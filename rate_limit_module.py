@@ -0,0 +1,277 @@
+import asyncio
+import heapq
+import itertools
+import time
+from datetime import datetime, timezone
+
+
+class TokenBucket:
+    """
+    Asynchronous token bucket limiting how often an operation may run.
+
+    Parameters:
+    - rate (float): The number of tokens added per second
+    - capacity (float): The maximum number of tokens, i.e. the allowed burst
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """
+        Take tokens from the bucket without waiting.
+
+        Parameters:
+        - tokens (float): The number of tokens to take
+
+        Returns:
+        - acquired (bool): True if the tokens were taken
+        """
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def drain(self, seconds: float) -> None:
+        """
+        Empty the bucket so no tokens are available for the given time.
+
+        Parameters:
+        - seconds (float): The number of seconds before the next token
+        """
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+    async def acquire(self, tokens: float = 1) -> None:
+        """
+        Wait until tokens are available and take them.
+
+        Callers are served in arrival order.
+
+        Parameters:
+        - tokens (float): The number of tokens to take
+        """
+        async with self._lock:
+            while not self.try_acquire(tokens):
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class PriorityTokenBucket(TokenBucket):
+    """
+    Token bucket serving waiting callers by priority instead of arrival order.
+
+    Lower priority numbers are served first, callers with equal priority in
+    arrival order.
+
+    Parameters:
+    - rate (float): The number of tokens added per second
+    - capacity (float): The maximum number of tokens, i.e. the allowed burst
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        super().__init__(rate, capacity)
+        self._waiters = []
+        self._order = itertools.count()
+        self._dispatcher = None
+
+    def __len__(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, tokens: float = 1, priority: int = 0) -> None:
+        """
+        Wait until tokens are available and take them.
+
+        Parameters:
+        - tokens (float): The number of tokens to take
+        - priority (int): The priority of the caller, lower is served first
+        """
+        if not self._waiters and self.try_acquire(tokens):
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), tokens, future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self) -> None:
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                # The caller was cancelled while waiting
+                heapq.heappop(self._waiters)
+            elif self.try_acquire(tokens):
+                heapq.heappop(self._waiters)
+                future.set_result(None)
+            else:
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class CallAccounting:
+    """
+    Counts upstream calls per minute, per UTC day, per endpoint and per response status.
+
+    Parameters:
+    - per_day_limit (int): The number of calls allowed per UTC day
+    """
+
+    def __init__(self, per_day_limit: int):
+        self.per_day_limit = per_day_limit
+        self._minute = None
+        self._day = None
+        self.minute_calls = 0
+        self.day_calls = 0
+        self.by_endpoint = {}
+        self.by_status = {}
+        self.rejected = 0
+
+    def _roll(self) -> None:
+        now = datetime.now(timezone.utc)
+        minute, day = now.strftime("%Y-%m-%d %H:%M"), now.date()
+        if minute != self._minute:
+            self._minute, self.minute_calls = minute, 0
+        if day != self._day:
+            self._day, self.day_calls = day, 0
+
+    def allow(self, reserve: float = 0.0) -> bool:
+        """
+        Check whether the daily quota allows another call.
+
+        Parameters:
+        - reserve (float): Fraction of the daily quota the caller must leave unused
+
+        Returns:
+        - allowed (bool): True if the call may be made
+        """
+        self._roll()
+        if self.day_calls < self.per_day_limit * (1 - reserve):
+            return True
+        self.rejected += 1
+        return False
+
+    def record(self, endpoint: str) -> None:
+        """
+        Count a call made to an endpoint.
+
+        Parameters:
+        - endpoint (str): The name of the endpoint
+        """
+        self._roll()
+        self.minute_calls += 1
+        self.day_calls += 1
+        self.by_endpoint[endpoint] = self.by_endpoint.get(endpoint, 0) + 1
+
+    def record_status(self, status) -> None:
+        """
+        Count a response status, or a transport error.
+
+        Parameters:
+        - status (int or str): The HTTP status code or the error name
+        """
+        self.by_status[status] = self.by_status.get(status, 0) + 1
+
+    def stats(self) -> dict:
+        """
+        Get the call counters.
+
+        Returns:
+        - stats (dict): Calls this minute and today, per endpoint and per status, and rejected calls
+        """
+        self._roll()
+        return {
+            "minute": self.minute_calls,
+            "day": self.day_calls,
+            "day_limit": self.per_day_limit,
+            "by_endpoint": dict(self.by_endpoint),
+            "by_status": dict(self.by_status),
+            "rejected": self.rejected,
+        }
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing upstream and lets a single probe through once in a while.
+
+    After failure_threshold consecutive failures the circuit opens and calls
+    are refused. After reset_timeout seconds one probe call is allowed: its
+    success closes the circuit, its failure opens it again. A probe that ends
+    without a result must be released, and one that never reports back is
+    replaced by a new probe after reset_timeout seconds.
+
+    Parameters:
+    - failure_threshold (int): Consecutive failures that open the circuit
+    - reset_timeout (float): Seconds before a probe is allowed through an open circuit
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        """
+        Check whether a call may go upstream.
+
+        Returns:
+        - allowed (bool): True if the call may be made
+        """
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if (self.state == self.OPEN and now - self.opened_at >= self.reset_timeout
+                or self.state == self.HALF_OPEN and now - self.probe_started_at >= self.reset_timeout):
+            self.state = self.HALF_OPEN
+            self.probe_started_at = now
+            return True
+        self.rejected += 1
+        return False
+
+    def release(self) -> None:
+        """
+        Give up a probe that ended without an upstream result, so the next call may probe again.
+        """
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+    def record_success(self) -> None:
+        """
+        Record a successful call, closing the circuit.
+        """
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        """
+        Record a failed call, opening the circuit after too many failures or a failed probe.
+        """
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.times_opened += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        """
+        Get the breaker state and counters.
+
+        Returns:
+        - stats (dict): State, consecutive failures, times opened and rejected calls
+        """
+        return {"state": self.state, "failures": self.failures, "times_opened": self.times_opened, "rejected": self.rejected}
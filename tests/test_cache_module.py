@@ -0,0 +1,114 @@
+import types
+import pytest
+import cache_module
+from cache_module import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(cache_module, "time", types.SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def test_get_returns_fresh_values(clock):
+    cache = TTLCache(10, 60)
+    cache.set("paris", 1)
+    assert cache.get("paris") == 1
+    assert cache.get("london") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = TTLCache(10, 60)
+    cache.set("paris", 1)
+    clock.now += 59
+    assert cache.get("paris") == 1
+    clock.now += 1
+    assert cache.get("paris") is None
+    assert len(cache) == 0
+    assert cache.expirations == 1
+
+
+def test_ttl_can_be_set_per_entry(clock):
+    cache = TTLCache(10, 60)
+    cache.set("paris", 1, ttl=5)
+    cache.set("london", 2)
+    clock.now += 10
+    assert cache.get("paris") is None
+    assert cache.get("london") == 2
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = TTLCache(2, 60)
+    cache.set("paris", 1)
+    cache.set("london", 2)
+    # Reading paris makes london the least recently used entry
+    assert cache.get("paris") == 1
+    cache.set("berlin", 3)
+    assert cache.get("london") is None
+    assert cache.get("paris") == 1
+    assert cache.get("berlin") == 3
+    assert cache.evictions == 1
+
+
+def test_set_replaces_and_refreshes_an_entry(clock):
+    cache = TTLCache(2, 60)
+    cache.set("paris", 1)
+    cache.set("london", 2)
+    cache.set("paris", 3)
+    cache.set("berlin", 4)
+    assert len(cache) == 2
+    assert cache.get("paris") == 3
+    assert cache.get("london") is None
+
+
+def test_get_stale_serves_expired_entries_for_max_stale(clock):
+    cache = TTLCache(10, 60, max_stale=30)
+    cache.set("paris", 1)
+    assert cache.get_stale("paris") is None
+    clock.now += 60
+    assert cache.get("paris") is None
+    assert cache.get_stale("paris") == 1
+    clock.now += 30
+    assert cache.get_stale("paris") is None
+    assert cache.get("paris") is None
+    assert len(cache) == 0
+
+
+def test_entries_are_dropped_at_expiry_without_max_stale(clock):
+    cache = TTLCache(10, 60)
+    cache.set("paris", 1)
+    clock.now += 60
+    assert cache.get_stale("paris") is None
+    assert cache.get("paris") is None
+    assert len(cache) == 0
+
+
+def test_values_skip_expired_entries(clock):
+    cache = TTLCache(10, 60)
+    cache.set("paris", 1, ttl=5)
+    cache.set("london", 2)
+    clock.now += 10
+    assert cache.values() == [2]
+
+
+def test_pop_and_clear(clock):
+    cache = TTLCache(10, 60)
+    cache.set("paris", 1)
+    cache.set("london", 2)
+    assert cache.pop("paris") == 1
+    assert cache.pop("paris", "missing") == "missing"
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_stats(clock):
+    cache = TTLCache(10, 60)
+    cache.set("paris", 1)
+    cache.get("paris")
+    cache.get("london")
+    stats = cache.stats()
+    assert stats["size"] == 1
+    assert stats["maxsize"] == 10
+    assert stats["hit_ratio"] == 0.5
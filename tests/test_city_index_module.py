@@ -0,0 +1,78 @@
+import pytest
+from city_index_module import CityIndex, build_index, normalize_city
+
+# GeoNames dump rows: id, name, ascii name, alternate names, lat, lon, feature class and code,
+# country, cc2, admin1 code, admin2 to admin4 codes and population
+DUMP_ROWS = [
+    ("2988507", "Paris", "Paris", "", "48.85341", "2.3488", "P", "PPLC", "FR", "", "11", "75", "", "", "2138551"),
+    ("4717560", "Paris", "Paris", "", "33.66094", "-95.55551", "P", "PPLA2", "US", "", "TX", "277", "", "", "24782"),
+    ("2657896", "Zürich", "Zurich", "", "47.36667", "8.55", "P", "PPLA", "CH", "", "ZH", "112", "", "", "341730"),
+    ("2988506", "Parisot", "Parisot", "", "44.26", "1.85", "P", "PPL", "FR", "", "76", "82", "", "", "500"),
+    ("2643743", "London", "London", "", "51.50853", "-0.12574", "P", "PPLC", "GB", "", "ENG", "GLA", "", "", "8961989"),
+]
+
+ADMIN1_ROWS = [
+    ("FR.11", "Ile-de-France", "Ile-de-France", "3012874"),
+    ("US.TX", "Texas", "Texas", "4736286"),
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    dump = tmp_path / "cities.txt"
+    dump.write_text("".join("\t".join(row) + "\n" for row in DUMP_ROWS), encoding="utf-8")
+    admin1 = tmp_path / "admin1.txt"
+    admin1.write_text("".join("\t".join(row) + "\n" for row in ADMIN1_ROWS), encoding="utf-8")
+    path = tmp_path / "cities.idx"
+    build_index(str(dump), str(path), min_population=1000, admin1_path=str(admin1))
+    index = CityIndex(str(path))
+    yield index
+    index.close()
+
+
+def test_normalize_city_ignores_case_spacing_and_diacritics():
+    assert normalize_city("  Tel   Aviv ") == "tel aviv"
+    assert normalize_city("Zürich") == normalize_city("zurich")
+
+
+def test_small_cities_are_left_out(index):
+    # Zürich is indexed under "zurich" only, its two names normalise the same
+    assert len(index) == 4
+    assert index.exact("parisot") == []
+
+
+def test_exact_returns_the_most_populous_city_first(index):
+    cities = index.exact("paris")
+    assert [(city["country"], city.get("state")) for city in cities] == [("FR", "Ile-de-France"), ("US", "Texas")]
+    assert cities[0] == {"name": "Paris", "lat": 48.85341, "lon": 2.3488, "country": "FR", "state": "Ile-de-France",
+                         "population": 2138551}
+
+
+def test_exact_respects_the_limit(index):
+    assert len(index.exact("paris", limit=1)) == 1
+
+
+def test_exact_finds_names_with_diacritics(index):
+    assert [city["name"] for city in index.exact(normalize_city("Zurich"))] == ["Zürich"]
+
+
+def test_exact_miss_and_stats(index):
+    assert index.exact("berlin") == []
+    assert index.exact("london")[0]["country"] == "GB"
+    assert index.stats() == {"cities": 4, "hits": 1, "misses": 1}
+
+
+def test_prefix_orders_by_population(index):
+    assert [city["country"] for city in index.prefix("par")] == ["FR", "US"]
+    assert [city["name"] for city in index.prefix("l")] == ["London"]
+    assert index.prefix("x") == []
+
+
+def test_empty_index_file(tmp_path):
+    path = tmp_path / "empty.idx"
+    path.write_bytes(b"")
+    index = CityIndex(str(path))
+    assert len(index) == 0
+    assert index.exact("paris") == []
+    assert index.prefix("pa") == []
+    index.close()
@@ -0,0 +1,161 @@
+import asyncio
+import threading
+import pytest
+import db_module
+
+SUBSCRIBERS = [(user_id, 32.08, 34.78, "Tel Aviv", 32.08, 34.78) for user_id in range(1, 6)]
+
+
+class FakeCursor:
+    # Answers the keyset query of iter_users_with_daily_updates from SUBSCRIBERS
+    def execute(self, query, params):
+        self.params = params
+
+    def fetchall(self):
+        last_user_id, batch_size = self.params[-2:]
+        return [row for row in SUBSCRIBERS if row[0] > last_user_id][:batch_size]
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = {"queries": 0, "fail_on": None}
+
+    async def transaction(work):
+        database["queries"] += 1
+        if database["queries"] == database["fail_on"]:
+            raise ConnectionError("server closed the connection")
+        return work(FakeCursor())
+
+    monkeypatch.setattr(db_module, "execute_transaction_async", transaction)
+    return database
+
+
+def collect(**kwargs) -> list:
+    async def run():
+        return [batch async for batch in db_module.iter_users_with_daily_updates(**kwargs)]
+
+    return asyncio.run(run())
+
+
+def test_subscribers_are_loaded_in_batches(database):
+    batches = collect(batch_size=2)
+    assert [[row[0] for row in batch] for batch in batches] == [[1, 2], [3, 4], [5]]
+    assert database["queries"] == 3
+
+
+def test_failed_batch_is_raised_and_iteration_resumes(database):
+    database["fail_on"] = 2
+    batches = []
+
+    async def run():
+        async for batch in db_module.iter_users_with_daily_updates(batch_size=2):
+            batches.append(batch)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(run())
+    assert [[row[0] for row in batch] for batch in batches] == [[1, 2]]
+    resumed = collect(batch_size=2, after_user_id=batches[-1][-1][0])
+    assert [[row[0] for row in batch] for batch in resumed] == [[3, 4], [5]]
+
+
+def test_calls_wait_for_a_free_slot_and_time_out(monkeypatch):
+    monkeypatch.setattr(db_module, "db_pool", db_module.ConnectionPool(0, 1, 0.05, 0, 0))
+    # Holds the only slot until the call is let go
+    release = threading.Event()
+
+    def blocking():
+        release.wait(1)
+        return "done"
+
+    async def run():
+        first = asyncio.ensure_future(db_module._run_in_pool(blocking))
+        await asyncio.sleep(0.01)
+        with pytest.raises(db_module.PoolTimeout):
+            await db_module._run_in_pool(blocking)
+        assert await db_module.execute_query_async("SELECT 1") is None
+        waiting = asyncio.ensure_future(db_module._run_in_pool(lambda: "next"))
+        await asyncio.sleep(0.01)
+        release.set()
+        return await first, await waiting
+
+    assert asyncio.run(run()) == ("done", "next")
+    stats = db_module.db_pool.stats()
+    assert (stats["waits"], stats["timeouts"]) == (2, 2)
+    assert stats["max_wait"] >= 0.01
+
+
+@pytest.fixture
+def flushes(monkeypatch):
+    # Batch writes that wait until the test lets them finish, with the result the test sets
+    flushes = {"started": None, "finish": None, "result": True, "log": []}
+
+    async def execute_batch(query, rows):
+        flushes["started"].set()
+        await flushes["finish"].wait()
+        flushes["log"].append(("written" if flushes["result"] else "failed", rows))
+        return flushes["result"]
+
+    monkeypatch.setattr(db_module, "execute_batch_async", execute_batch)
+    return flushes
+
+
+def run_during_flush(flushes, during):
+    async def run():
+        queue = db_module.WriteBehindQueue(flush_interval=60, max_batch=100)
+        flushes["started"], flushes["finish"] = asyncio.Event(), asyncio.Event()
+        queue.put(42, 32.08, 34.78, "Tel Aviv")
+        flush = asyncio.ensure_future(queue.flush())
+        await flushes["started"].wait()
+        result = asyncio.ensure_future(during(queue))
+        await asyncio.sleep(0)
+        flushes["finish"].set()
+        await flush
+        return queue, await result
+
+    return asyncio.run(run())
+
+
+def test_discard_during_a_successful_flush_waits_for_it(flushes):
+    async def discard(queue):
+        discarded = await queue.discard(42)
+        flushes["log"].append("discarded")
+        return discarded
+
+    queue, discarded = run_during_flush(flushes, discard)
+    assert discarded
+    # The caller's deactivation runs after the flushed row is written
+    assert flushes["log"] == [("written", [(42, 32.08, 34.78, "Tel Aviv", None)]), "discarded"]
+    assert queue.get(42) is None
+
+
+def test_discard_during_a_failed_flush_is_not_requeued(flushes):
+    flushes["result"] = False
+
+    async def discard(queue):
+        return await queue.discard(42)
+
+    queue, discarded = run_during_flush(flushes, discard)
+    assert discarded
+    assert queue.get(42) is None
+    assert len(queue) == 0
+
+
+def test_newer_write_wins_over_a_failed_flush(flushes):
+    flushes["result"] = False
+
+    async def put(queue):
+        queue.put(42, 51.51, -0.13, "London")
+
+    queue, _ = run_during_flush(flushes, put)
+    assert queue.get(42) == (42, 51.51, -0.13, "London", None)
+    assert len(queue) == 1
+
+
+def test_failed_flush_is_requeued(flushes):
+    flushes["result"] = False
+
+    async def nothing(queue):
+        pass
+
+    queue, _ = run_during_flush(flushes, nothing)
+    assert queue.get(42) == (42, 32.08, 34.78, "Tel Aviv", None)
@@ -0,0 +1,89 @@
+import json
+import time
+from datetime import datetime, timedelta, timezone
+import pytest
+from forecast_module import FORECAST_DAYS, CompactForecast, decode_forecast, render_day
+
+
+def sample_forecast(start_hour: int, kelvin: bool = False) -> dict:
+    start = datetime(2023, 10, 12, start_hour, tzinfo=timezone.utc)
+    offset = 273.15 if kelvin else 0
+    entries = []
+    for i in range(40):
+        moment = start + timedelta(hours=3 * i)
+        temp, feels_like = round(17 + (i % 8) * 0.73, 2), round(16.25 + (i % 5) * 0.61, 2)
+        entries.append({
+            "dt": int(moment.timestamp()),
+            "main": {"temp": temp + offset, "feels_like": feels_like + offset, "humidity": 40 + i % 50},
+            "weather": [{"description": ("clear sky", "light rain", "overcast clouds")[i % 3]}],
+            # OpenWeather sends whole wind speeds as JSON integers
+            "wind": {"speed": 4 if i % 4 == 0 else 3.1 + (i % 4) * 0.5},
+            "dt_txt": moment.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+    return {"list": entries}
+
+
+def legacy_parse_weather(geo_data: dict, city: str, n_of_day: int) -> str:
+    # The renderer render_day replaced, working on the Kelvin payload
+    geo_data = geo_data['list']
+    first_day_idx = 0
+    while geo_data[first_day_idx]['dt_txt'][11:13] != '21':
+        first_day_idx += 1
+    first_day_idx += 1
+
+    start_idx = first_day_idx + (n_of_day - 1) * 8 if n_of_day != 0 else 0
+    end_idx = start_idx + 8 if n_of_day != 0 else first_day_idx
+    message = f"*Weather Forecast for {city} \n {geo_data[0]['dt_txt'].split()[0]}* 🌐\n\n"
+    for weather_data in geo_data[start_idx:end_idx]:
+        hour_only = weather_data['dt_txt'].split()[1].split(":")[0] + ":00"
+        temp = "{:.2f}".format(weather_data['main']['temp'] - 273.15)
+        feels_like = "{:.2f}".format(weather_data['main']['feels_like'] - 273.15)
+        message += (
+            f"_• {hour_only}_\n"
+            f"*🌡️  Temperature:* {temp}°C\n"
+            f"*💓  Feels Like:* {feels_like}°C\n"
+            f"*📰  Description:* {weather_data['weather'][0]['description'].capitalize()}\n"
+            f"*🌬️  Wind Speed:* {weather_data['wind']['speed']} m/s\n"
+            f"*💦  Humidity:* {weather_data['main']['humidity']}%\n\n"
+        )
+    return message
+
+
+@pytest.mark.parametrize("start_hour", range(0, 24, 3))
+def test_render_day_matches_the_old_renderer(start_hour):
+    forecast = CompactForecast.from_payload(sample_forecast(start_hour))
+    kelvin = sample_forecast(start_hour, kelvin=True)
+    for n_of_day in range(FORECAST_DAYS):
+        assert render_day(forecast, "Tel Aviv", n_of_day) == legacy_parse_weather(kelvin, "Tel Aviv", n_of_day)
+
+
+def test_whole_wind_speeds_are_printed_without_decimals():
+    message = render_day(CompactForecast.from_payload(sample_forecast(0)), "Tel Aviv", 0)
+    assert "*🌬️  Wind Speed:* 4 m/s\n" in message
+    assert "*🌬️  Wind Speed:* 3.6 m/s\n" in message
+
+
+def test_decode_forecast_matches_from_payload():
+    payload = sample_forecast(9)
+    decoded = decode_forecast(json.dumps(payload).encode())
+    built = CompactForecast.from_payload(payload)
+    for name in ("dt", "temp", "feels_like", "description", "wind_speed", "humidity"):
+        assert getattr(decoded, name) == getattr(built, name)
+
+
+def test_days_split_after_the_21_00_entry():
+    forecast = CompactForecast.from_payload(sample_forecast(9))
+    # 09:00 to 21:00 on the first day, then full days from midnight
+    assert forecast.day_range(0) == range(0, 5)
+    assert forecast.day_range(1) == range(5, 13)
+    assert forecast.day_range(5) == range(37, 40)
+    assert forecast.day_labels() == ["2023-10-12", "2023-10-13", "2023-10-14", "2023-10-15", "2023-10-16"]
+
+
+def test_stale_forecast_is_marked():
+    payload = sample_forecast(9)
+    fresh = CompactForecast.from_payload(payload)
+    assert "Data as of" not in render_day(fresh, "Tel Aviv", 1)
+    stale = CompactForecast(fresh.dt, fresh.temp, fresh.feels_like, fresh.description, fresh.wind_speed,
+                            fresh.humidity, fetched_at=time.time() - 10 ** 6)
+    assert "_⏳ Data as of " in render_day(stale, "Tel Aviv", 1)
@@ -0,0 +1,123 @@
+import asyncio
+import pytest
+import get_weather_module
+from get_weather_module import BACKGROUND, QUOTA_ERROR_MSG, SingleFlight
+from rate_limit_module import CallAccounting, CircuitBreaker
+
+
+def test_concurrent_callers_share_one_fetch():
+    flight = SingleFlight()
+    fetches = 0
+
+    async def fetch():
+        nonlocal fetches
+        fetches += 1
+        await asyncio.sleep(0.01)
+        return {"city": "Paris"}
+
+    async def run():
+        return await asyncio.gather(*[flight.do("paris", fetch) for _ in range(5)])
+
+    results = asyncio.run(run())
+    assert fetches == 1
+    assert all(result is results[0] for result in results)
+    assert flight.stats() == {"calls": 5, "deduplicated": 4, "inflight": 0}
+
+
+def test_different_keys_fetch_separately():
+    flight = SingleFlight()
+
+    async def run():
+        async def fetch(city):
+            await asyncio.sleep(0.01)
+            return city
+        return await asyncio.gather(flight.do("paris", lambda: fetch("paris")), flight.do("london", lambda: fetch("london")))
+
+    assert asyncio.run(run()) == ["paris", "london"]
+    assert flight.deduplicated == 0
+
+
+def test_later_callers_fetch_again():
+    flight = SingleFlight()
+    fetches = 0
+
+    async def fetch():
+        nonlocal fetches
+        fetches += 1
+        return fetches
+
+    async def run():
+        return await flight.do("paris", fetch), await flight.do("paris", fetch)
+
+    assert asyncio.run(run()) == (1, 2)
+
+
+def test_exception_is_raised_to_every_caller():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def run():
+        return await asyncio.gather(flight.do("paris", fetch), flight.do("paris", fetch), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flight.stats()["inflight"] == 0
+
+
+def test_cancelled_caller_does_not_cancel_the_fetch():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "forecast"
+
+    async def run():
+        first = asyncio.ensure_future(flight.do("paris", fetch))
+        second = asyncio.ensure_future(flight.do("paris", fetch))
+        await asyncio.sleep(0.005)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == "forecast"
+
+
+@pytest.fixture
+def probing_breaker(monkeypatch):
+    # A forecast breaker whose reset timeout has passed, so the next call is its probe
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    monkeypatch.setitem(get_weather_module.circuit_breakers, "forecast", breaker)
+    monkeypatch.setattr(get_weather_module, "call_accounting", CallAccounting(per_day_limit=10))
+    return breaker
+
+
+def test_background_call_over_the_reserve_does_not_take_the_probe(probing_breaker):
+    for _ in range(10):
+        get_weather_module.call_accounting.record("forecast")
+    result = asyncio.run(get_weather_module._check_response_async("endpoint", "forecast", BACKGROUND))
+    assert result == {"err": True, "err_msg": QUOTA_ERROR_MSG}
+    assert probing_breaker.state == CircuitBreaker.OPEN
+
+
+def test_probe_without_upstream_result_is_released(probing_breaker, monkeypatch):
+    async def request(*args):
+        await asyncio.sleep(1)
+
+    monkeypatch.setattr(get_weather_module, "_request_with_retries", request)
+
+    async def run():
+        call = asyncio.ensure_future(get_weather_module._check_response_async("endpoint", "forecast"))
+        await asyncio.sleep(0.01)
+        assert probing_breaker.state == CircuitBreaker.HALF_OPEN
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+
+    asyncio.run(run())
+    assert probing_breaker.state == CircuitBreaker.OPEN
+    assert probing_breaker.allow()
@@ -0,0 +1,67 @@
+import asyncio
+import types
+import pytest
+import main
+
+KEY = (42, 42)
+
+
+class FakeHandler:
+    def __init__(self):
+        self._conversations = {}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(main, "datetime", types.SimpleNamespace(now=lambda: types.SimpleNamespace(timestamp=lambda: clock.now)))
+    return clock
+
+
+@pytest.fixture
+def sync(clock):
+    # The stored states persistence would answer with, timed out conversations read back as None
+    stored = {}
+
+    async def get_conversation_state(name, key):
+        return stored.get(key)
+
+    handler = FakeHandler()
+    sync_state = main.conversation_state_sync(handler)
+    update = types.SimpleNamespace(effective_chat=types.SimpleNamespace(id=KEY[0]), effective_user=types.SimpleNamespace(id=KEY[1]))
+    persistence = types.SimpleNamespace(get_conversation_state=get_conversation_state)
+    context = types.SimpleNamespace(application=types.SimpleNamespace(persistence=persistence))
+    return types.SimpleNamespace(run=lambda: asyncio.run(sync_state(update, context)), stored=stored,
+                                 conversations=handler._conversations)
+
+
+def test_stored_state_replaces_the_local_one(sync):
+    sync.stored[KEY] = main.TYPING_REPLY
+    sync.run()
+    assert sync.conversations[KEY] == main.TYPING_REPLY
+
+
+def test_local_change_waiting_to_be_written_is_kept(sync, clock):
+    sync.stored[KEY] = main.CHOOSING
+    sync.run()
+    sync.conversations[KEY] = main.TYPING_REPLY
+    clock.now += 1
+    sync.run()
+    assert sync.conversations[KEY] == main.TYPING_REPLY
+
+
+def test_idle_conversation_ends_when_its_stored_state_timed_out(sync, clock):
+    sync.stored[KEY] = main.CHOOSING
+    sync.run()
+    sync.conversations[KEY] = main.TYPING_REPLY
+    # The change was written and has timed out since
+    sync.stored.pop(KEY)
+    clock.now += main.CONVERSATION_TIMEOUT
+    sync.run()
+    assert KEY not in sync.conversations
+
+
+def test_unsupported_telegram_version_is_refused(monkeypatch):
+    monkeypatch.setattr(main.telegram, "__version_info__", (21, 0, 0, "final", 0))
+    with pytest.raises(RuntimeError):
+        main.conversation_states(FakeHandler())
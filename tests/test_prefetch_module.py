@@ -0,0 +1,62 @@
+import asyncio
+import time
+import pytest
+import get_weather_module
+import prefetch_module
+from cache_module import TTLCache
+from forecast_module import CompactForecast
+from get_weather_module import SERVER_ERROR_MSG
+from tests.test_forecast_module import sample_forecast
+
+LOCATIONS = [(32.08, 34.78, "Tel Aviv", 3)]
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    # Forecast cache holding an expired forecast of the location, and an API whose answers the test sets
+    cache = TTLCache(10, 60, max_stale=600)
+    stale = CompactForecast.from_payload(sample_forecast(9))
+    stale.fetched_at = time.time() - 10 ** 6
+    cache.set(get_weather_module.coord_key(32.08, 34.78), stale, ttl=0)
+    monkeypatch.setattr(get_weather_module, "forecast_cache", cache)
+    monkeypatch.setattr(prefetch_module, "prerendered_messages", TTLCache(10, 60))
+    upstream = {"response": {"err": True, "err_msg": SERVER_ERROR_MSG}, "calls": 0}
+
+    async def fetch(lat, lon, key, priority):
+        upstream["calls"] += 1
+        return upstream["response"]
+
+    monkeypatch.setattr(get_weather_module, "_fetch_forecast", fetch)
+    upstream["stale"] = stale
+    return upstream
+
+
+def test_stale_cell_with_failing_refresh_is_reported_as_failed(upstream):
+    report = asyncio.run(prefetch_module.prefetch_locations(LOCATIONS))
+    assert upstream["calls"] == 1
+    assert report["warmed_cells"] == 0
+    assert report["rendered"] == 0
+    assert report["failed"] == [(*LOCATIONS[0], prefetch_module.STALE_FORECAST_MSG)]
+    assert len(prefetch_module.prerendered_messages) == 0
+
+
+def test_stale_cell_is_refreshed_before_rendering(upstream):
+    upstream["response"] = CompactForecast.from_payload(sample_forecast(9))
+    report = asyncio.run(prefetch_module.prefetch_locations(LOCATIONS))
+    assert (report["warmed_cells"], report["rendered"], report["failed"]) == (1, 1, [])
+    message = prefetch_module.prerendered_messages.values()[0]
+    assert "Data as of" not in message
+
+
+def test_stale_forecast_is_returned_at_once_unless_fresh_only(upstream):
+    async def run():
+        forecast = await get_weather_module.weather_by_coord_async(32.08, 34.78)
+        # Let the background refresh run
+        await asyncio.sleep(0)
+        return forecast
+
+    assert asyncio.run(run()) is upstream["stale"]
+    assert upstream["calls"] == 1
+    fallback = asyncio.run(get_weather_module.weather_by_coord_async(32.08, 34.78, allow_stale=False))
+    assert fallback is upstream["stale"]
+    assert upstream["calls"] == 2
@@ -0,0 +1,147 @@
+import asyncio
+import types
+import pytest
+import rate_limit_module
+from rate_limit_module import CircuitBreaker, PriorityTokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(rate_limit_module, "time", types.SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def test_try_acquire_takes_up_to_the_capacity():
+    bucket = PriorityTokenBucket(rate=1, capacity=2)
+    assert bucket.try_acquire()
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+
+
+def test_drain_holds_back_tokens():
+    bucket = PriorityTokenBucket(rate=1000, capacity=5)
+    bucket.drain(10)
+    assert not bucket.try_acquire()
+
+
+def test_waiters_are_served_by_priority_then_arrival():
+    async def run():
+        bucket = PriorityTokenBucket(rate=20, capacity=1)
+        assert bucket.try_acquire()
+        order = []
+
+        async def acquire(name, priority):
+            await bucket.acquire(priority=priority)
+            order.append(name)
+
+        tasks = []
+        for name, priority in (("broadcast 1", 1), ("user", 0), ("broadcast 2", 1)):
+            tasks.append(asyncio.ensure_future(acquire(name, priority)))
+            # Let the waiter queue up before the next one arrives
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["user", "broadcast 1", "broadcast 2"]
+
+
+def test_acquire_does_not_wait_while_tokens_are_available():
+    async def run():
+        bucket = PriorityTokenBucket(rate=0.001, capacity=3)
+        for _ in range(3):
+            await asyncio.wait_for(bucket.acquire(), 0.1)
+        return len(bucket)
+
+    assert asyncio.run(run()) == 0
+
+
+def test_cancelled_waiter_is_skipped():
+    async def run():
+        bucket = PriorityTokenBucket(rate=100, capacity=1)
+        assert bucket.try_acquire()
+        cancelled = asyncio.ensure_future(bucket.acquire(priority=0))
+        await asyncio.sleep(0)
+        waiting = asyncio.ensure_future(bucket.acquire(priority=1))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.wait_for(waiting, 1)
+        return len(bucket)
+
+    assert asyncio.run(run()) == 0
+
+
+def open_breaker(clock) -> CircuitBreaker:
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    return breaker
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert breaker.stats() == {"state": "open", "failures": 2, "times_opened": 1, "rejected": 1}
+
+
+def test_breaker_lets_one_probe_through_after_reset_timeout(clock):
+    breaker = open_breaker(clock)
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+
+def test_successful_probe_closes_the_breaker(clock):
+    breaker = open_breaker(clock)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_failed_probe_opens_the_breaker_again(clock):
+    breaker = open_breaker(clock)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    clock.now += 30
+    assert breaker.allow()
+
+
+def test_released_probe_lets_the_next_call_probe(clock):
+    breaker = open_breaker(clock)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_release_does_not_reopen_a_closed_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.release()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_probe_that_never_reports_back_is_replaced(clock):
+    breaker = open_breaker(clock)
+    clock.now += 30
+    assert breaker.allow()
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
@@ -0,0 +1,53 @@
+import asyncio
+from datetime import datetime
+from telegram import Chat, Message, Update, User
+from update_processor_module import PerUserUpdateProcessor, update_sender
+
+
+def message_update(update_id: int, user_id: int) -> Update:
+    message = Message(update_id, datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=User(user_id, "user", False))
+    return Update(update_id, message=message)
+
+
+def test_update_sender_is_the_user():
+    assert update_sender(message_update(1, 42)) == 42
+    assert update_sender(Update(2)) is None
+    assert update_sender("not an update") is None
+
+
+def test_updates_of_one_user_are_handled_in_order():
+    async def run():
+        processor = PerUserUpdateProcessor(8)
+        handled = []
+
+        async def handle(update_id, delay):
+            handled.append(("start", update_id))
+            await asyncio.sleep(delay)
+            handled.append(("end", update_id))
+
+        await asyncio.gather(processor.process_update(message_update(1, 42), handle(1, 0.02)),
+                             processor.process_update(message_update(2, 42), handle(2, 0)))
+        return handled, processor._senders
+
+    handled, senders = asyncio.run(run())
+    assert handled == [("start", 1), ("end", 1), ("start", 2), ("end", 2)]
+    assert senders == {}
+
+
+def test_updates_of_different_users_are_handled_concurrently():
+    async def run():
+        processor = PerUserUpdateProcessor(8)
+        both_started = asyncio.Event()
+        started = []
+
+        async def handle(user_id):
+            started.append(user_id)
+            if len(started) == 2:
+                both_started.set()
+            await asyncio.wait_for(both_started.wait(), 1)
+
+        await asyncio.gather(processor.process_update(message_update(1, 42), handle(42)),
+                             processor.process_update(message_update(2, 43), handle(43)))
+        return started
+
+    assert asyncio.run(run()) == [42, 43]
@@ -0,0 +1,66 @@
+import asyncio
+from typing import Awaitable
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+def update_sender(update: object):
+    """
+    Get the id updates are ordered by: the user, or the chat for updates without a user.
+
+    Parameters:
+    - update (object): The incoming update
+
+    Returns:
+    - sender (int): The user or chat id, None if the update has neither
+    """
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different users concurrently and the updates of one user one by one.
+
+    The conversation handler keeps one state per user and expects that
+    user's updates in order, so an update waits until the user's previous
+    updates are handled. The waiting updates count towards
+    max_concurrent_updates.
+
+    Parameters:
+    - max_concurrent_updates (int): The maximum number of updates processed at the same time
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # Lock and number of pending updates of every user with updates in progress
+        self._senders = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        sender = update_sender(update)
+        if sender is None:
+            await coroutine
+            return
+        entry = self._senders.get(sender)
+        if entry is None:
+            entry = self._senders[sender] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # Lock waiters are woken in arrival order, which is the order of the updates
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._senders[sender]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass